@@ -0,0 +1,32 @@
+"""
+הרשאה ל-endpoints של ניהול (שליחה מרוכזת, מצעים שמורים, outbox)
+הבקשה צריכה לשלוח Authorization: Bearer <ADMIN_TOKEN>. בלי ADMIN_TOKEN
+ה-endpoints האלה חסומים לגמרי, כך ששרת שנפתח לרשת לא חושף אותם בטעות
+"""
+import hmac
+from typing import Optional
+
+from fastapi import Header, HTTPException
+
+from app.config import env_str
+
+
+def admin_token() -> str:
+    """
+    הטוקן של ה-admin לפי משתני הסביבה:
+        ADMIN_TOKEN: הטוקן ל-endpoints של ניהול (ברירת מחדל: ריק = ה-endpoints חסומים)
+    """
+    return env_str("ADMIN_TOKEN")
+
+
+def require_admin(authorization: Optional[str] = Header(None)):
+    """
+    dependency ל-endpoints של ניהול
+    Raises: HTTPException 403 אם ADMIN_TOKEN לא מוגדר, 401 אם הטוקן חסר או שגוי
+    """
+    expected = admin_token()
+    if not expected:
+        raise HTTPException(status_code=403, detail="admin endpoints are disabled (set ADMIN_TOKEN)")
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.strip().encode(), expected.encode()):
+        raise HTTPException(status_code=401, detail="invalid admin token", headers={"WWW-Authenticate": "Bearer"})
@@ -0,0 +1,30 @@
+"""
+קריאת הגדרות מתוך משתני סביבה
+"""
+import os
+
+
+def env_str(name: str, default: str = "") -> str:
+    """קורא משתנה סביבה טקסטואלי (מנוקה מרווחים) עם ברירת מחדל"""
+    value = os.getenv(name)
+    return value.strip() if value else default
+
+
+def env_int(name: str, default: int) -> int:
+    """קורא משתנה סביבה מספרי (int) עם ברירת מחדל"""
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def env_float(name: str, default: float) -> float:
+    """קורא משתנה סביבה מספרי (float) עם ברירת מחדל"""
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+def env_bool(name: str, default: bool = False) -> bool:
+    """קורא משתנה סביבה בוליאני (1/true/yes/on)"""
+    value = os.getenv(name)
+    if not value:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
@@ -0,0 +1,126 @@
+"""
+הגדרת לוגים מובנים (Structured Logging)
+רמות לוג, פורמט עצל, דגימה של dumps של payloads, ו-handler מבוסס תור
+כך שהכתיבה ל-stdout מתבצעת ב-thread נפרד ולא מאטה את הבקשה
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+
+from app.config import env_float, env_str
+
+# שם ה-logger הראשי של האפליקציה - כל המודולים הם ילדים שלו (app.*)
+APP_LOGGER = "app"
+
+_listener = None
+_payload_sample_rate = 1.0
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler שדוחה ל-thread של ה-listener רק את ה-serialization של payloads
+    
+    ההודעה עצמה נבנית (getMessage) ב-thread הקורא, כי ה-args יכולים להשתנות
+    עד שה-listener מגיע לרשומה. רשומה עם LazyJson נשארת כמו שהיא - ה-dumps
+    הכבד נעשה ב-listener (log_payload מעביר איתה רק מחרוזת)
+    """
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        args = record.args
+        if args and isinstance(args, tuple) and any(isinstance(arg, LazyJson) for arg in args):
+            return record
+        if args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """פורמט JSON בשורה אחת לכל רשומה (נוח ל-journald / pm2 / כלי איסוף לוגים)"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LazyJson:
+    """
+    עוטף אובייקט ומבצע json.dumps רק כשהרשומה באמת נכתבת
+    (כשהרמה כבויה - אין שום עלות serialization)
+    """
+    
+    __slots__ = ("obj",)
+    
+    def __init__(self, obj):
+        self.obj = obj
+    
+    def __str__(self) -> str:
+        try:
+            return json.dumps(self.obj, indent=2, default=str, ensure_ascii=False)
+        except (TypeError, ValueError):
+            return str(self.obj)
+
+
+def configure_logging():
+    """
+    מגדיר את ה-logger של האפליקציה לפי משתני הסביבה (פעם אחת לכל תהליך):
+        LOG_LEVEL: DEBUG / INFO / WARNING / ERROR (ברירת מחדל: DEBUG ב-test, INFO ב-prod)
+        LOG_FORMAT: text (ברירת מחדל) או json
+        LOG_PAYLOAD_SAMPLE_RATE: איזה חלק מה-payloads להדפיס ברמת DEBUG (0.0-1.0)
+    """
+    global _listener, _payload_sample_rate
+    if _listener is not None:
+        return
+    
+    environment = env_str("ENVIRONMENT", "test").lower()
+    default_level = "INFO" if environment == "prod" else "DEBUG"
+    level = getattr(logging, env_str("LOG_LEVEL", default_level).upper(), logging.INFO)
+    _payload_sample_rate = env_float("LOG_PAYLOAD_SAMPLE_RATE", 1.0)
+    
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if env_str("LOG_FORMAT", "text").lower() == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=False)
+    _listener.start()
+    atexit.register(shutdown_logging)
+    
+    logger = logging.getLogger(APP_LOGGER)
+    logger.handlers[:] = [_DeferredQueueHandler(log_queue)]
+    logger.setLevel(level)
+    logger.propagate = False
+
+
+def shutdown_logging():
+    """מרוקן את תור הלוגים ועוצר את ה-listener"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def log_payload(logger: logging.Logger, message: str, payload):
+    """
+    מדפיס payload מלא ברמת DEBUG - רק אם הרמה פעילה ורק לפי שיעור הדגימה
+    ה-serialization עצמו נדחה ל-thread של ה-listener
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    if _payload_sample_rate < 1.0 and random.random() >= _payload_sample_rate:
+        return
+    logger.debug("%s\n%s", message, LazyJson(payload))
@@ -1,312 +1,481 @@
-from fastapi import FastAPI, Request
+"""
+אפליקציית ה-FastAPI של הבוט
+create_app בונה את האפליקציה עם lifespan: הלוגים והשירותים (client של N8N,
+קבצי ה-DB, תור השיגור והמתזמנים) נוצרים ב-startup של כל worker ומנוקזים
+ונסגרים ב-shutdown, כך ש-import של המודול לא פותח חיבורים, קבצים או threads
+"""
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, FastAPI, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from app.services.whatsapp_service import whatsapp_service
-from app.services.flow_manager import flow_manager
+from fastapi.responses import PlainTextResponse
+
+from app.auth import require_admin
+from app.logging_config import configure_logging, log_payload
+from app.serialization import FastJSONResponse, dumps, loads
+from app.services.allowlist import ROUTE_MENU
+from app.services.broadcast import iter_csv_phones, iter_list
+from app.services.container import create_services
+from app.services.dispatch_queue import dispatch_queue, QueueFullError
+from app.services.flow_manager import FlowState
+from app.services.menus import compile_menu
+from app.services.metrics import metrics, WEBHOOK_EVENTS, WEBHOOK_SECONDS
+from app.services.sequencer import phone_sequencer
+from app.services.webhook_parser import parse_webhook, is_status_only, InboundMessage, InboundStatus
+
+logger = logging.getLogger(__name__)
 
-app = FastAPI()
+# השירותים של ה-worker - נוצרים בעצלות (בפועל ב-startup) ומשותפים לכל ה-endpoints
+services = create_services()
 
-# Get environment from service
-ENVIRONMENT = whatsapp_service.get_environment()
+router = APIRouter(default_response_class=FastJSONResponse)
 
-# Print environment info at startup
-print(f"Starting WhatsApp Bot in '{ENVIRONMENT}' mode")
+# endpoints של ניהול - דורשים Authorization: Bearer <ADMIN_TOKEN>
+ADMIN = [Depends(require_admin)]
 
-# רשימת מספרי טלפון לקבלת תשובה עם 3 אפשרויות
-SPECIAL_PHONE_NUMBERS = [
-    "972542202468",
-    # הוסף כאן מספרי טלפון נוספים
-]
 
-# Enable CORS to allow external requests
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # In production, replace with specific origins
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    startup: הגדרת הלוגים, יצירת השירותים והפעלת עבודות הרקע לפני שה-worker מקבל בקשות
+    shutdown: ריקון תור השיגור, עצירת השליחות והמתזמנים, סגירת ה-client של N8N
+    (וניקוז החיבורים הפתוחים) וסגירת קבצי ה-DB
+    """
+    # הגדרת הלוגים (וה-thread שכותב אותם) לפני יצירת השירותים, כדי שגם הודעות
+    # האתחול שלהם ייכתבו - וב-startup ולא ב-import
+    configure_logging()
+    try:
+        await services.start()
+        yield
+    finally:
+        await services.stop()
 
-@app.get("/")
+
+def create_app() -> FastAPI:
+    """בונה את אפליקציית ה-FastAPI (נקרא פעם אחת לכל תהליך)"""
+    app = FastAPI(default_response_class=FastJSONResponse, lifespan=lifespan)
+    # Enable CORS to allow external requests
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],  # In production, replace with specific origins
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    app.include_router(router)
+    return app
+
+@router.get("/")
 def root():
     return {"status": "ok", "message": "WhatsApp Bot is running"}
 
-@app.get("/health")
+@router.get("/health")
 def health_check():
-    return {"status": "healthy", "environment": ENVIRONMENT}
+    return {"status": "healthy", "environment": services.whatsapp.get_environment()}
 
-@app.get("/info")
+@router.get("/info")
 def get_info():
     return {
         "status": "ok",
-        "environment": ENVIRONMENT,
-        "n8n_webhook_url": whatsapp_service.get_webhook_url()
+        "environment": services.whatsapp.get_environment(),
+        "n8n_webhook_url": services.whatsapp.get_webhook_url(),
+        "n8n_endpoints": services.whatsapp.endpoint_stats(),
+        "n8n_batching": services.whatsapp.batch_stats(),
+        "n8n_rate_limit": services.whatsapp.rate_limit_stats(),
+        "state_backend": services.flow_manager.store.name,
+        "sessions": services.flow_manager.store.stats(),
+        "proposals": services.flow_manager.proposals.stats(),
+        "reminders": services.flow_manager.reminders.stats(),
+        "broadcast": services.broadcaster.stats(),
+        "active_phones": phone_sequencer.active_keys(),
+        "phone_locks": phone_sequencer.process_lock.stats() if phone_sequencer.process_lock is not None else None,
+        "allowlist": services.allowlist.stats(),
+        "dedup": services.dedup.stats(),
+        "delivery": services.delivery_tracker.stats() if services.delivery_tracker is not None else None,
+        "dispatch": dispatch_queue.stats(),
+        "outbox": services.whatsapp.outbox.stats() if services.whatsapp.outbox is not None else None
     }
 
-@app.post("/whatsapp/get_message")
-async def get_message(request: Request):
+@router.get("/queue")
+def get_queue_stats():
+    """מחזיר את מצב תור השיגור - עומק, lag ומונים"""
+    return dispatch_queue.stats()
+
+@router.get("/deliveries")
+def get_delivery_stats():
+    """מחזיר מוני status וזמני מסירה/קריאה (אם DELIVERY_TRACKING פעיל)"""
+    if services.delivery_tracker is None:
+        return {"enabled": False}
+    return {"enabled": True, **services.delivery_tracker.stats()}
+
+@router.get("/sessions")
+def get_session_stats():
+    """מחזיר את מספר הסשנים החיים והזיכרון שהם תופסים"""
+    return services.flow_manager.store.stats()
+
+@router.get("/proposals", dependencies=ADMIN)
+def find_proposals(phone: Optional[str] = None, name: Optional[str] = None,
+                   participant: Optional[str] = None, q: Optional[str] = None,
+                   limit: int = Query(20, ge=1, le=500)):
     """
-    מקבל הודעת WhatsApp נכנסת ומטפל בה
+    חיפוש מצעים שמורים (החדשים קודם): לפי מספר טלפון, שם דיון, משתתף
+    ו/או q - מילים מהשם, המשתתפים או התוכן
     """
-    data = await request.json()
-    print("=" * 50)
-    print("Incoming WhatsApp message:")
-    print(data)
-    print("=" * 50)
-    
-    # בדיקה מה webhook URL שמגיע
-    webhook_url = data.get("webhookUrl", "N/A")
-    print(f"DEBUG: webhookUrl from data: {webhook_url}")
-    print(f"DEBUG: This webhook should receive INCOMING messages")
-    
-    # הדפסת המבנה המלא של הנתונים
+    return {"proposals": services.flow_manager.proposals.find(phone, name, participant, q, limit)}
+
+@router.get("/proposals/{proposal_id}", dependencies=ADMIN)
+def get_proposal(proposal_id: int):
+    """מחזיר מצע שמור לפי מזהה"""
+    proposal = services.flow_manager.proposals.get(proposal_id)
+    if proposal is None:
+        return FastJSONResponse(status_code=404, content={"status": "error", "error": "proposal not found"})
+    return proposal
+
+@router.get("/reminders")
+def get_reminders(phone: Optional[str] = None, status: Optional[str] = "pending",
+                  limit: int = Query(20, ge=1, le=500)):
+    """
+    מצב התזכורות (ספירה לפי מצב, המועד הקרוב ומונים של ה-worker),
+    ועם phone - התזכורות של המספר לפי מועד
+    """
+    stats = services.flow_manager.reminders.stats()
+    if phone:
+        stats["list"] = services.flow_manager.reminders.store.list_for(phone, status or None, limit)
+    return stats
+
+def _broadcast_message(text: Optional[str], menu) -> tuple:
+    """
+    ההודעה של broadcast: טקסט, שם של תפריט רשום (למשל "main") או הגדרת
+    תפריט (body_text, options, button_text) שנבדקת מול מגבלות WhatsApp
+    Returns: (kind, message לשמירה, Menu או None)
+    Raises: ValueError אם אין הודעה או שהתפריט לא תקין
+    """
+    if text and menu is None:
+        return "text", text, None
+    if menu is None or text:
+        raise ValueError("Exactly one of 'text' or 'menu' is required")
+    if isinstance(menu, str):
+        compiled = services.flow_manager.menus.get(menu)
+        if compiled is None:
+            raise ValueError(f"Unknown menu '{menu}'")
+        return "menu", menu, compiled
+    if not isinstance(menu, dict):
+        raise ValueError("'menu' must be a menu name or a menu definition")
     try:
-        import json
-        print("DEBUG: Full data structure (JSON):")
-        print(json.dumps(data, indent=2, default=str, ensure_ascii=False))
-    except Exception as e:
-        print(f"DEBUG: Could not print JSON: {e}")
-
-    # חילוץ מספר הטלפון מהבקשה
-    # המבנה של WhatsApp: body['entry'][0]['changes'][0]['value']['messages'][0]['from']
-    phone_number = None
-    
-    # ניסיון לחלץ מהמבנה של WhatsApp Business API
+        compiled = compile_menu("broadcast", **menu)
+    except TypeError as e:
+        raise ValueError(f"Invalid menu definition: {e}")
+    return "menu", dumps(menu).decode("utf-8"), compiled
+
+def _bad_request(error: str):
+    return FastJSONResponse(status_code=400, content={"status": "error", "error": error})
+
+@router.post("/broadcasts", dependencies=ADMIN)
+async def create_broadcast(request: Request):
+    """
+    שליחה מרוכזת: {"recipients": [...], "text": "..."} או {"recipients": [...], "menu": ...}
+    מחזיר מיד את ה-job (id, total) - השליחה רצה ברקע
+    """
     try:
-        if "body" in data:
-            body = data["body"]
-            if "entry" in body and len(body["entry"]) > 0:
-                entry = body["entry"][0]
-                if "changes" in entry and len(entry["changes"]) > 0:
-                    changes = entry["changes"][0]
-                    if "value" in changes:
-                        value = changes["value"]
-                        # ניסיון מההודעות (incoming messages)
-                        if "messages" in value and len(value["messages"]) > 0:
-                            phone_number = value["messages"][0].get("from")
-                        # ניסיון מ-statuses (read/delivered status)
-                        if not phone_number and "statuses" in value and len(value["statuses"]) > 0:
-                            phone_number = value["statuses"][0].get("recipient_id")
-                        # ניסיון מהקontacts
-                        if not phone_number and "contacts" in value and len(value["contacts"]) > 0:
-                            phone_number = value["contacts"][0].get("wa_id")
-    except (KeyError, IndexError, TypeError) as e:
-        print(f"DEBUG: Error extracting phone from WhatsApp structure: {e}")
-    
-    # ניסיון חילוץ מהשדות הישירים (למקרה שהמבנה שונה)
-    if not phone_number:
-        phone_number = data.get("from") or data.get("phone_number") or data.get("phone") or data.get("sender")
+        body = loads(await request.body())
+        recipients = body.get("recipients")
+        if not isinstance(recipients, list):
+            raise ValueError("'recipients' must be a list of phone numbers")
+        kind, message, menu = _broadcast_message(body.get("text"), body.get("menu"))
+        job = await services.broadcaster.create(kind, message, iter_list(recipients), menu)
+    except (ValueError, AttributeError) as e:
+        return _bad_request(str(e))
+    return job
+
+@router.post("/broadcasts/csv", dependencies=ADMIN)
+async def create_broadcast_from_csv(request: Request, text: Optional[str] = None, menu: Optional[str] = None):
+    """
+    שליחה מרוכזת לנמענים מקובץ CSV שנשלח כ-body (נקרא ב-stream): עמודת
+    phone/טלפון מהכותרת, או העמודה הראשונה. ההודעה ב-query: ?text=... או ?menu=<שם תפריט>
+    """
+    try:
+        kind, message, compiled = _broadcast_message(text, menu)
+        job = await services.broadcaster.create(kind, message, iter_csv_phones(request.stream()), compiled)
+    except ValueError as e:
+        return _bad_request(str(e))
+    return job
+
+@router.get("/broadcasts", dependencies=ADMIN)
+def list_broadcasts(limit: int = Query(20, ge=1, le=200)):
+    """ה-jobs האחרונים"""
+    return {"jobs": services.broadcaster.store.jobs(limit), **services.broadcaster.stats()}
+
+@router.get("/broadcasts/{job_id}", dependencies=ADMIN)
+def get_broadcast(job_id: str):
+    """התקדמות job - ספירה לפי מצב, אחוז התקדמות וקצב"""
+    job = services.broadcaster.store.get(job_id)
+    if job is None:
+        return FastJSONResponse(status_code=404, content={"status": "error", "error": "broadcast not found"})
+    return job
+
+@router.get("/broadcasts/{job_id}/results", dependencies=ADMIN)
+def get_broadcast_results(job_id: str, status: Optional[str] = None, after: int = 0,
+                          limit: int = Query(100, ge=1, le=5000)):
+    """תוצאה לכל נמען לפי הסדר (after=<seq> לעמוד הבא), אופציונלית רק במצב status"""
+    return {"results": services.broadcaster.store.results(job_id, status, after, limit)}
+
+@router.post("/broadcasts/{job_id}/cancel", dependencies=ADMIN)
+def cancel_broadcast(job_id: str):
+    """עוצר job שרץ - נמענים שלא נשלחו נשארים pending"""
+    return {"status": "ok", "cancelled": services.broadcaster.cancel(job_id)}
+
+@router.post("/broadcasts/{job_id}/retry", dependencies=ADMIN)
+async def retry_broadcast(job_id: str):
+    """שולח שוב לנמענים שנכשלו (ולכאלה שנשארו pending אחרי ביטול)"""
+    job = services.broadcaster.store.get(job_id)
+    if job is None:
+        return FastJSONResponse(status_code=404, content={"status": "error", "error": "broadcast not found"})
+    menu = None
+    if job["kind"] == "menu":
+        menu = job["message"] if job["message"] in services.flow_manager.menus else loads(job["message"])
+    try:
+        kind, message, compiled = _broadcast_message(job["message"] if job["kind"] == "text" else None, menu)
+    except ValueError as e:
+        return _bad_request(str(e))
+    # running נתפס בעדכון מותנה אחד, כך ששתי בקשות (גם ב-workers שונים) לא שולחות פעמיים
+    retried = services.broadcaster.claim_retry(job_id)
+    if retried is None:
+        return _bad_request("broadcast is still running on a live worker (cancel it first to resume it here)")
+    services.broadcaster.start(job_id, kind, message, compiled)
+    return {"status": "ok", "retried": retried}
+
+@router.get("/outbox")
+def get_outbox_stats():
+    """מחזיר את מצב ה-outbox - מספר הודעות לפי מצב, גיל ההודעה הוותיקה ומונים"""
+    if services.whatsapp.outbox is None:
+        return {"enabled": False}
+    return {"enabled": True, **services.whatsapp.outbox.stats()}
+
+@router.get("/outbox/messages", dependencies=ADMIN)
+def list_outbox_messages(status: Optional[str] = None, recipient: Optional[str] = None,
+                         limit: int = Query(100, ge=1, le=1000)):
+    """מחזיר הודעות מה-outbox (החדשות קודם) לפי מצב (pending/sending/sent/dead) ו/או נמען"""
+    if services.whatsapp.outbox is None:
+        return FastJSONResponse(status_code=404, content={"status": "error", "error": "outbox is disabled"})
+    return {"messages": services.whatsapp.outbox.messages(status, recipient, limit)}
+
+@router.post("/outbox/replay", dependencies=ADMIN)
+def replay_outbox_messages(ids: Optional[List[int]] = Query(None), status: str = "dead"):
+    """
+    מחזיר הודעות לשליחה מיידית: ?ids=1&ids=2 להודעות מסוימות,
+    אחרת כל ההודעות במצב status (ברירת מחדל: dead)
+    """
+    if services.whatsapp.outbox is None:
+        return FastJSONResponse(status_code=404, content={"status": "error", "error": "outbox is disabled"})
+    return {"status": "ok", "replayed": services.whatsapp.outbox.replay(ids, status)}
+
+@router.get("/metrics")
+async def get_metrics():
+    """מדדים בפורמט Prometheus - מאוחדים מכל ה-workers (אם METRICS_DIR מוגדר)"""
+    return PlainTextResponse(await metrics.render_async(), media_type="text/plain; version=0.0.4")
+
+@router.post("/whatsapp/get_message")
+async def get_message(request: Request):
+    """
+    מקבל webhook נכנס של WhatsApp ומטפל בכל ההודעות שבו
+    (משלוח יכול להכיל כמה entries / changes / messages)
+    """
+    started = time.perf_counter()
+    body = await request.body()
+    outcome, response = await _handle_webhook(body)
+    WEBHOOK_SECONDS.observe(time.perf_counter() - started, outcome)
+    return response
+
+
+async def _handle_webhook(body: bytes):
+    """
+    מטפל ב-body של webhook
+    Returns: (outcome למדדים, תשובת ה-endpoint)
+    """
+    # קבלות status בלבד (רוב התעבורה) - חזרה מיד, בלי פענוח או הדפסה
+    # (אלא אם מעקב המסירה פעיל)
+    if is_status_only(body):
+        if services.delivery_tracker is not None:
+            _track_statuses(body)
+        return "status_only", {"status": "ok"}
     
-    print(f"DEBUG: Extracted phone_number: '{phone_number}'")
-    print(f"DEBUG: SPECIAL_PHONE_NUMBERS list: {SPECIAL_PHONE_NUMBERS}")
-    print(f"DEBUG: phone_number type: {type(phone_number)}")
-    if phone_number:
-        print(f"DEBUG: phone_number repr: {repr(phone_number)}")
-        for idx, special_num in enumerate(SPECIAL_PHONE_NUMBERS):
-            print(f"DEBUG: Comparing '{phone_number}' (type: {type(phone_number)}) with '{special_num}' (type: {type(special_num)}) - Match: {phone_number == special_num}")
+    # כל השולחים לא מורשים - דחייה לפני פענוח JSON, הדפסה או עבודת flow
+    if services.allowlist.rejects_all_senders(body):
+        return "ignored", {"status": "ignored"}
     
-    # בדיקה אם זו הודעת טקסט או רק status update
-    has_message = False
-    has_status = False
     try:
-        print("DEBUG: Checking data structure...")
-        print(f"DEBUG: data has 'body' key: {'body' in data}")
-        if "body" in data:
-            body = data["body"]
-            print(f"DEBUG: body type: {type(body)}")
-            print(f"DEBUG: body keys: {body.keys() if isinstance(body, dict) else 'not a dict'}")
-            if "entry" in body and len(body["entry"]) > 0:
-                entry = body["entry"][0]
-                print(f"DEBUG: entry keys: {entry.keys() if isinstance(entry, dict) else 'not a dict'}")
-                if "changes" in entry and len(entry["changes"]) > 0:
-                    changes = entry["changes"][0]
-                    print(f"DEBUG: changes keys: {changes.keys() if isinstance(changes, dict) else 'not a dict'}")
-                    if "value" in changes:
-                        value = changes["value"]
-                        print(f"DEBUG: value type: {type(value)}")
-                        print(f"DEBUG: value keys: {value.keys() if isinstance(value, dict) else 'not a dict'}")
-                        
-                        # הדפסת התוכן המלא של value
-                        print("DEBUG: Full value content:")
-                        try:
-                            import json
-                            print(json.dumps(value, indent=2, default=str, ensure_ascii=False))
-                        except:
-                            print(str(value))
-                        
-                        # בדיקה אם יש הודעת טקסט (לא רק status)
-                        if "messages" in value and len(value["messages"]) > 0:
-                            has_message = True
-                            messages = value["messages"]
-                            print(f"DEBUG: ✓✓✓ Found {len(messages)} message(s) in value")
-                            # הדפסת פרטי ההודעה הראשונה
-                            if len(messages) > 0:
-                                first_msg = messages[0]
-                                print(f"DEBUG: First message type: {first_msg.get('type', 'unknown')}")
-                                print(f"DEBUG: First message keys: {first_msg.keys() if isinstance(first_msg, dict) else 'not a dict'}")
-                                print(f"DEBUG: First message content:")
-                                try:
-                                    print(json.dumps(first_msg, indent=2, default=str, ensure_ascii=False))
-                                except:
-                                    print(str(first_msg))
-                                
-                                # טיפול בהודעה דרך flow_manager (רק אם המספר ברשימה המיוחדת)
-                                phone_number_normalized = phone_number.replace(" ", "").replace("-", "").replace("+", "")
-                                if phone_number in SPECIAL_PHONE_NUMBERS or phone_number_normalized in SPECIAL_PHONE_NUMBERS:
-                                    _handle_user_message(phone_number, first_msg)
-                        else:
-                            print("DEBUG: ✗ No 'messages' key in value or messages list is empty")
-                        
-                        # בדיקה אם יש status
-                        if "statuses" in value and len(value["statuses"]) > 0:
-                            has_status = True
-                            print(f"DEBUG: Found statuses in value, count: {len(value['statuses'])}")
-                        else:
-                            print("DEBUG: ✗ No 'statuses' key in value or statuses list is empty")
-                    else:
-                        print("DEBUG: ✗ No 'value' key in changes")
-                else:
-                    print("DEBUG: ✗ No 'changes' in entry or changes list is empty")
-            else:
-                print("DEBUG: ✗ No 'entry' in body or entry list is empty")
-        else:
-            print("DEBUG: ✗ No 'body' key in data")
-    except (KeyError, IndexError, TypeError) as e:
-        print(f"DEBUG: Error checking has_message: {e}")
-        import traceback
-        traceback.print_exc()
-    
-    print(f"DEBUG: has_message: {has_message}, has_status: {has_status}")
+        data = loads(body)
+    except ValueError:
+        return "invalid", FastJSONResponse(status_code=400, content={"status": "error", "error": "invalid JSON body"})
+    if not isinstance(data, dict):
+        return "invalid", FastJSONResponse(status_code=400, content={"status": "error", "error": "expected a JSON object"})
+    # הדפסת המבנה המלא - רק ב-DEBUG ולפי שיעור הדגימה
+    log_payload(logger, "Incoming WhatsApp webhook:", data)
     
-    # נורמליזציה של מספר הטלפון (הסרת רווחים, +, וכו')
-    if phone_number and has_message:
-        phone_number_normalized = phone_number.replace(" ", "").replace("-", "").replace("+", "")
-        print(f"DEBUG: Normalized phone_number: '{phone_number_normalized}'")
-        print(f"DEBUG: Checking if '{phone_number}' in SPECIAL_PHONE_NUMBERS: {phone_number in SPECIAL_PHONE_NUMBERS}")
-        print(f"DEBUG: Checking if '{phone_number_normalized}' in SPECIAL_PHONE_NUMBERS: {phone_number_normalized in SPECIAL_PHONE_NUMBERS}")
+    # מעבר יחיד על כל האירועים במשלוח
+    counts = {"messages": 0, "statuses": 0, "duplicates": 0, "rejected": 0}
+    for event in parse_webhook(data):
+        if isinstance(event, InboundStatus):
+            counts["statuses"] += 1
+            if services.dedup.seen(event.dedup_key):
+                counts["duplicates"] += 1
+            elif services.delivery_tracker is not None:
+                services.delivery_tracker.record(event)
+            continue
         
-        # בדיקה אם המספר ברשימה המיוחדת (גם עם וגם בלי נורמליזציה)
-        # הערה: הטיפול בהודעות מתבצע ב-_handle_user_message
-        if phone_number in SPECIAL_PHONE_NUMBERS or phone_number_normalized in SPECIAL_PHONE_NUMBERS:
-            print(f"DEBUG: ✓✓✓ Phone number {phone_number} found in SPECIAL_PHONE_NUMBERS!")
-            # הטיפול מתבצע ב-_handle_user_message
-        else:
-            print(f"DEBUG: ✗ Phone number {phone_number} NOT in SPECIAL_PHONE_NUMBERS")
-            print(f"DEBUG: Comparison details:")
-            print(f"  - phone_number: '{phone_number}' (length: {len(phone_number)})")
-            print(f"  - phone_number_normalized: '{phone_number_normalized}' (length: {len(phone_number_normalized)})")
-            print(f"  - SPECIAL_PHONE_NUMBERS contains: {SPECIAL_PHONE_NUMBERS}")
-    elif phone_number and not has_message:
-        if has_status:
-            print("DEBUG: ⚠️ Phone number found but this is a STATUS UPDATE (read/delivered), not a TEXT MESSAGE")
-            print("DEBUG: ℹ️  To trigger the interactive message, please send a NEW TEXT MESSAGE (not just read a message)")
-        else:
-            print("DEBUG: ⚠️ Phone number found but has_message is False and has_status is False - this shouldn't happen!")
-            print("DEBUG: Full data structure:")
-            try:
-                import json
-                print(json.dumps(data, indent=2, default=str))
-            except:
-                print(str(data))
+        counts["messages"] += 1
+        logger.debug("Inbound %r", event)
+        
+        # שולח לא מורשה - חיפוש אחד בטבלת הניתוב, לפני dedup ו-flow
+        route = services.allowlist.route(event.phone_number)
+        if route is None:
+            counts["rejected"] += 1
+            logger.debug("Phone number %s is not in the allowlist", event.phone_number)
+            continue
+        
+        # הודעה שכבר התקבלה (redelivery) - דילוג לפני כל עבודה נוספת
+        if services.dedup.seen(event.message_id):
+            counts["duplicates"] += 1
+            logger.debug("Duplicate message id %s, skipping", event.message_id)
+            continue
+        
+        try:
+            await _dispatch_user_message(event, route)
+        except QueueFullError as e:
+            # ההודעה לא טופלה - לא לסמן אותה כדי שה-redelivery יעובד
+            services.dedup.forget(event.message_id)
+            logger.warning("%s - asking sender to retry", e)
+            _count_events(counts)
+            return "busy", FastJSONResponse(status_code=503, content={"status": "busy"})
+        except BaseException:
+            # שגיאה בטיפול (flow, state store, N8N) - ה-webhook מחזיר 500 וה-redelivery
+            # צריך להיות מעובד. האירועים הבאים במשלוח עוד לא סומנו
+            services.dedup.forget(event.message_id)
+            raise
+    
+    logger.debug("Webhook handled: %s", counts)
+    _count_events(counts)
+    return "ok", {"status": "ok", **counts}
+
+
+def _count_events(counts: dict):
+    """מוסיף את מוני המשלוח למדדים"""
+    for kind, count in counts.items():
+        if count:
+            WEBHOOK_EVENTS.inc(kind, amount=count)
+
+
+def _track_statuses(body: bytes):
+    """מעביר את ה-statuses של משלוח ל-delivery_tracker (כפילויות מדולגות)"""
+    try:
+        data = loads(body)
+    except ValueError:
+        return
+    if not isinstance(data, dict):
+        return
+    for event in parse_webhook(data):
+        if isinstance(event, InboundStatus) and not services.dedup.seen(event.dedup_key):
+            services.delivery_tracker.record(event)
+
+
+async def _dispatch_user_message(message: InboundMessage, route: str = ROUTE_MENU):
+    """
+    מעביר את ההודעה לטיפול - ברקע דרך תור השיגור (DISPATCH_MODE=queue)
+    או ישירות בתוך הבקשה (ברירת מחדל)
+    """
+    if dispatch_queue.running:
+        await dispatch_queue.submit(_handle_queued_message, message, route)
     else:
-        print("DEBUG: No phone number found in message data")
+        await _handle_user_message(message, route)
 
-    return {"status": "ok"}
 
+async def _handle_queued_message(message: InboundMessage, route: str = ROUTE_MENU):
+    """job בתור השיגור - אם הטיפול נכשל, ההודעה לא נשארת מסומנת ככפילות"""
+    try:
+        await _handle_user_message(message, route)
+    except BaseException:
+        services.dedup.forget(message.message_id)
+        raise
 
-def _handle_user_message(phone_number: str, message: dict):
+
+async def _handle_user_message(message: InboundMessage, route: str = ROUTE_MENU):
     """
-    מטפל בהודעה מהמשתמש - חילוץ choice_id או text ושימוש ב-flow_manager
+    מטפל בהודעה מהמשתמש לפי הסדר - הודעות של אותו מספר מעובדות אחת
+    אחרי השנייה, והודעות של מספרים שונים במקביל
     """
-    from app.services.flow_manager import FlowState
-    
-    message_type = message.get("type", "")
-    choice_id = None
-    message_text = ""
-    
-    # חילוץ choice_id אם זו בחירה מ-interactive message
-    if message_type == "interactive":
-        interactive = message.get("interactive", {})
-        interactive_type = interactive.get("type", "")
-        if interactive_type == "list_reply":
-            choice_id = interactive.get("list_reply", {}).get("id")
-        elif interactive_type == "button_reply":
-            choice_id = interactive.get("button_reply", {}).get("id")
-        print(f"DEBUG: Interactive message detected, choice_id: {choice_id}")
-    
-    # חילוץ טקסט אם זו הודעת טקסט רגילה
-    elif message_type == "text":
-        message_text = message.get("text", {}).get("body", "")
-        print(f"DEBUG: Text message detected, text: '{message_text}'")
+    # חשוב: אין await לפני hold, כדי שסדר הנעילה יהיה סדר השליפה מהתור
+    async with phone_sequencer.hold(message.phone_number):
+        await _process_user_message(message, route)
+
+
+async def _process_user_message(message: InboundMessage, route: str = ROUTE_MENU):
+    """
+    מעבד הודעה מהמשתמש - שימוש ב-choice_id או ב-text דרך flow manager
+    route: הניתוב של המספר מה-allowlist - התפריט הראשי או זרימה שמתחילה ישר
+    """
+    phone_number = message.phone_number
+    choice_id = message.choice_id
+    message_text = message.text
     
     # בדיקה אם צריך להתחיל flow חדש (אם המשתמש במצב IDLE וזו הודעה חדשה)
-    current_state = flow_manager.get_user_state(phone_number)
-    print(f"DEBUG: Current user state: {current_state}, message_type: {message_type}, has_text: {bool(message_text)}")
-    
-    if current_state == FlowState.IDLE and message_type == "text" and message_text:
-        # אם המשתמש במצב IDLE ושולח הודעה, נשלח לו את הרשימה הראשונית
-        print(f"DEBUG: User in IDLE state, sending initial choices")
-        _start_choice_process(phone_number)
-        return
+    current_state = services.flow_manager.get_user_state(phone_number)
+    logger.debug("Current user state: %s, message_type: %s, has_text: %s",
+                 current_state, message.type, bool(message_text))
     
-    # אם המשתמש במצב IDLE ובחר אפשרות מה-List, זה יטופל ב-process_message
-    if current_state == FlowState.IDLE and choice_id:
-        print(f"DEBUG: User in IDLE state, processing choice: {choice_id}")
-        # ימשיך ל-process_message למטה
-    
-    # עיבוד ההודעה דרך flow_manager
-    print(f"DEBUG: Processing message through flow_manager: choice_id={choice_id}, text='{message_text}'")
-    response_text, next_payload = flow_manager.process_message(phone_number, choice_id, message_text)
+    if current_state == FlowState.IDLE and message.type == "text" and message_text:
+        if route == ROUTE_MENU:
+            # אם המשתמש במצב IDLE ושולח הודעה, נשלח לו את הרשימה הראשונית
+            logger.debug("User in IDLE state, sending initial choices")
+            await _start_choice_process(phone_number)
+            return
+        # מספר שמנותב לזרימה מסוימת - הזרימה מתחילה ישר, בלי התפריט הראשי
+        logger.debug("User in IDLE state, starting routed flow %s", route)
+        response_text, next_payload = services.flow_manager.handle_initial_choice(phone_number, route)
+    else:
+        # עיבוד ההודעה דרך flow_manager (בחירה מה-List במצב IDLE מטופלת שם)
+        logger.debug("Processing message through flow manager: choice_id=%s, text='%s'", choice_id, message_text)
+        response_text, next_payload = services.flow_manager.process_message(phone_number, choice_id, message_text)
     
     # שליחת תשובה למשתמש
     if response_text:
-        print(f"DEBUG: Sending response to user: '{response_text}'")
-        whatsapp_service.send_message(phone_number, response_text)
+        logger.debug("Sending response to user: '%s'", response_text)
+        await services.whatsapp.send_message(phone_number, response_text)
     
-    # אם יש next_payload (למשל interactive message נוסף), לשלוח אותו
+    # אם יש next_payload (תפריט מקומפל של השלב הבא), לשלוח אותו
     if next_payload:
-        print(f"DEBUG: Sending next interactive message")
-        # כאן אפשר לשלוח interactive message נוסף אם צריך
+        logger.debug("Sending next interactive message")
+        await services.whatsapp.send_menu(phone_number, next_payload["menu"])
 
 
-def _start_choice_process(phone_number: str):
+async def _start_choice_process(phone_number: str):
     """
     מתחיל תהליך בחירה בין אפשרויות למספר טלפון מיוחד
-    שולח הודעת Interactive List Message עם רשימת אפשרויות
+    שולח את התפריט הראשי (Interactive List מקומפל מראש)
     """
-    print(f"DEBUG: _start_choice_process called with phone_number: '{phone_number}'")
-    body_text = "בחר אחת מהאפשרויות הבאות:"
-    
-    # שליחת הודעת Interactive List עם כל האפשרויות
-    print(f"DEBUG: Calling send_interactive_message...")
-    result = whatsapp_service.send_interactive_message(
-        phone_number=phone_number,
-        body_text=body_text,
-        options=[
-            {"id": "proposal_for_discussion", "title": "מצע לדיון"},
-            {"id": "new_reminder", "title": "תזכורת חדשה"},
-            {"id": "control_and_monitoring", "title": "בקרה ומעקב"},
-            {"id": "new_task", "title": "משימה חדשה"}
-        ],
-        button_text="בחר אפשרות"
-    )
-    print(f"DEBUG: send_interactive_message result: {result}")
-    print(f"Sent interactive message to {phone_number}, status: {result.get('status_code', 'N/A')}")
+    logger.debug("_start_choice_process called with phone_number: '%s'", phone_number)
+    result = await services.whatsapp.send_menu(phone_number, services.flow_manager.main_menu)
+    logger.info("Sent interactive message to %s, status: %s", phone_number, result.get('status_code', 'N/A'))
     if result.get('status') == 'error':
-        print(f"ERROR: Failed to send interactive message: {result.get('error', 'Unknown error')}")
+        logger.error("Failed to send interactive message: %s", result.get('error', 'Unknown error'))
 
 
-@app.post("/whatsapp/send_message")
-def send_message():
+@router.post("/whatsapp/send_message")
+async def send_message():
     """
     שולח הודעת WhatsApp דרך שירות WhatsApp
     """
-    result = whatsapp_service.send_message("972542202468", "הודעה ישירות דרך n8n")
+    result = await services.whatsapp.send_message("972542202468", "הודעה ישירות דרך n8n")
     
     return {
         "status": result.get("status", "error"),
-        "environment": ENVIRONMENT,
-        "n8n_webhook_url": whatsapp_service.get_webhook_url(),
+        "environment": services.whatsapp.get_environment(),
+        "n8n_webhook_url": services.whatsapp.get_webhook_url(),
         "n8n_status": result.get("status_code"),
         "n8n_response": result.get("response_text")
     }
 
+
+app = create_app()
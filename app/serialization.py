@@ -0,0 +1,63 @@
+"""
+שכבת JSON אחידה (Serialization)
+משתמשת ב-orjson אם הוא מותקן (bytes פנימה / bytes החוצה, מהיר פי כמה)
+ונופלת ל-json של הספרייה הסטנדרטית אחרת. הפלט זהה בשני המקרים:
+UTF-8 קומפקטי, בלי escape לעברית
+"""
+import json
+from typing import Any, Union
+
+from fastapi.responses import JSONResponse
+
+from app.config import env_str
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _select_backend() -> str:
+    """
+    בוחר backend לפי JSON_BACKEND: auto (ברירת מחדל - orjson אם מותקן),
+    orjson או stdlib
+    """
+    requested = env_str("JSON_BACKEND", "auto").lower()
+    if requested == "stdlib":
+        return "stdlib"
+    if requested not in ("auto", "orjson"):
+        raise ValueError(f"Unknown JSON_BACKEND: {requested!r} (expected 'auto', 'orjson' or 'stdlib')")
+    if orjson is None:
+        if requested == "orjson":
+            raise ImportError("JSON_BACKEND=orjson but orjson is not installed (pip install orjson)")
+        return "stdlib"
+    return "orjson"
+
+
+BACKEND = _select_backend()
+
+if BACKEND == "orjson":
+    def dumps(obj: Any) -> bytes:
+        """מקודד ל-JSON bytes (UTF-8 קומפקטי)"""
+        return orjson.dumps(obj)
+    
+    def loads(data: Union[bytes, str]) -> Any:
+        """מפענח JSON מ-bytes או str. זורק ValueError על קלט לא תקין"""
+        return orjson.loads(data)
+else:
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+    
+    def dumps(obj: Any) -> bytes:
+        """מקודד ל-JSON bytes (UTF-8 קומפקטי)"""
+        return _encoder.encode(obj).encode("utf-8")
+    
+    def loads(data: Union[bytes, str]) -> Any:
+        """מפענח JSON מ-bytes או str. זורק ValueError על קלט לא תקין"""
+        return json.loads(data)
+
+
+class FastJSONResponse(JSONResponse):
+    """תשובת API שמקודדת דרך שכבת ה-JSON (orjson אם זמין)"""
+    
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -0,0 +1,170 @@
+"""
+רשימת מספרים מורשים וניתוב (Allowlist / Routing)
+המספרים נטענים מקובץ, מנורמלים פעם אחת לטבלת ניתוב (מספר -> זרימה)
+ונטענים מחדש כשהקובץ משתנה - בלי restart. בדיקת שולח היא חיפוש אחד ב-dict
+"""
+import logging
+import os
+import re
+import time
+from typing import Dict, Iterable, Optional
+
+from app.config import env_float, env_str
+from app.services.flow_definitions import FLOWS
+
+logger = logging.getLogger(__name__)
+
+# ניתוב ברירת מחדל - התפריט הראשי
+ROUTE_MENU = "menu"
+# שורת "*" בקובץ מתירה כל מספר
+WILDCARD = "*"
+
+_NON_DIGITS = re.compile(r"\D")
+# שולחי ההודעות ב-body הגולמי - לדחייה מוקדמת בלי לפענח את ה-JSON
+_RAW_SENDER = re.compile(rb'"from"\s*:\s*"([^"]*)"')
+
+
+def normalize_phone(phone_number: str) -> str:
+    """מסיר כל תו שאינו ספרה (רווחים, מקפים, +, סוגריים)"""
+    if phone_number.isdigit():
+        return phone_number
+    return _NON_DIGITS.sub("", phone_number)
+
+
+def parse_routes(lines: Iterable[str], source: str = "<allowlist>") -> Dict[str, str]:
+    """
+    מפענח שורות בפורמט "<מספר> [ניתוב]" לטבלת ניתוב
+    ניתוב הוא "menu" (ברירת מחדל) או שם של זרימה מ-FLOWS שתתחיל ישר.
+    שורות ריקות ו-# מדולגות; שורה לא תקינה נרשמת בלוג ומדולגת
+    """
+    routes: Dict[str, str] = {}
+    for line_number, line in enumerate(lines, start=1):
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        parts = line.split()
+        route = parts[1] if len(parts) > 1 else ROUTE_MENU
+        if route != ROUTE_MENU and route not in FLOWS:
+            logger.warning("%s:%d: unknown route %r, skipping", source, line_number, route)
+            continue
+        key = parts[0] if parts[0] == WILDCARD else normalize_phone(parts[0])
+        if not key:
+            logger.warning("%s:%d: no phone number, skipping", source, line_number)
+            continue
+        routes[key] = route
+    return routes
+
+
+class Allowlist:
+    """
+    טבלת הניתוב של המספרים המורשים
+    
+    הקובץ נבדק (os.stat) לכל היותר פעם ב-reload_interval שניות, ונטען מחדש
+    רק אם זמן השינוי שלו השתנה. הטבלה מוחלפת בשלמותה, כך שקורא אף פעם
+    לא רואה טבלה חלקית
+    """
+    
+    def __init__(self, path: str, reload_interval: float = 5.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._routes: Dict[str, str] = {}
+        self._mtime: Optional[float] = None
+        self._next_check = 0.0
+        self.reloads = 0
+        self.rejected = 0
+        self.reload()
+    
+    def reload(self) -> bool:
+        """טוען את הקובץ מחדש. Returns: True אם הטבלה הוחלפה"""
+        self._next_check = time.monotonic() + self.reload_interval
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            if self._mtime is None and self.reloads:
+                return False
+            logger.warning("Allowlist file %s not found - rejecting all senders", self.path)
+            self._routes, self._mtime = {}, None
+            self.reloads += 1
+            return True
+        if mtime == self._mtime:
+            return False
+        with open(self.path, encoding="utf-8") as f:
+            routes = parse_routes(f, self.path)
+        self._routes, self._mtime = routes, mtime
+        self.reloads += 1
+        logger.info("Loaded %d allowlist entries from %s", len(routes), self.path)
+        return True
+    
+    def _maybe_reload(self):
+        if time.monotonic() >= self._next_check:
+            self.reload()
+    
+    def route(self, phone_number: Optional[str]) -> Optional[str]:
+        """
+        מחזיר את הניתוב של המספר, או None אם הוא לא מורשה
+        """
+        if not phone_number:
+            return None
+        self._maybe_reload()
+        routes = self._routes
+        route = routes.get(phone_number)
+        if route is None:
+            route = routes.get(normalize_phone(phone_number))
+            if route is None:
+                route = routes.get(WILDCARD)
+        if route is None:
+            self.rejected += 1
+        return route
+    
+    def allows(self, phone_number: str) -> bool:
+        """האם המספר מורשה (בלי לספור דחייה) - לבדיקת נמענים של שליחה יזומה"""
+        self._maybe_reload()
+        routes = self._routes
+        return WILDCARD in routes or phone_number in routes or normalize_phone(phone_number) in routes
+    
+    def rejects_all_senders(self, body: bytes) -> bool:
+        """
+        בדיקה מהירה על ה-body הגולמי, לפני פענוח JSON: True אם יש בו הודעות
+        וכל השולחים שלהן לא מורשים, ואין בו statuses. בכל מקרה לא ודאי
+        (אין "from", יש statuses) מחזיר False והבקשה ממשיכה למסלול הרגיל
+        """
+        if b'"statuses"' in body:
+            return False
+        senders = _RAW_SENDER.findall(body)
+        if not senders:
+            return False
+        self._maybe_reload()
+        if WILDCARD in self._routes:
+            return False
+        routes = self._routes
+        for sender in senders:
+            phone_number = sender.decode("utf-8", errors="replace")
+            if phone_number in routes or normalize_phone(phone_number) in routes:
+                return False
+        self.rejected += len(senders)
+        return True
+    
+    def __len__(self) -> int:
+        return len(self._routes)
+    
+    def stats(self) -> dict:
+        """מחזיר את מצב הטבלה"""
+        return {
+            "path": self.path,
+            "entries": len(self._routes),
+            "allow_all": WILDCARD in self._routes,
+            "reloads": self.reloads,
+            "rejected": self.rejected,
+        }
+
+
+def create_allowlist() -> Allowlist:
+    """
+    יוצר את הטבלה לפי משתני הסביבה:
+        ALLOWLIST_PATH: קובץ המספרים המורשים (ברירת מחדל: config/allowlist.txt)
+        ALLOWLIST_RELOAD_SECONDS: כל כמה שניות לבדוק אם הקובץ השתנה (ברירת מחדל: 5)
+    """
+    return Allowlist(
+        env_str("ALLOWLIST_PATH", "config/allowlist.txt"),
+        reload_interval=env_float("ALLOWLIST_RELOAD_SECONDS", 5.0),
+    )
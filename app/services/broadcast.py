@@ -0,0 +1,598 @@
+"""
+שליחה מרוכזת (Broadcast)
+הודעת טקסט או תפריט אחד לרשימת נמענים (עד מאות אלפים): הנמענים נכתבים
+קודם לטבלת SQLite (גם מ-CSV שמגיע ב-stream, בלי להחזיק את כולו בזיכרון),
+ואז job ברקע שולח אותם במקביל חסום (concurrency) ובקצב מוגבל (rate).
+ההתקדמות ותוצאה לכל נמען נשמרות בטבלה, כך שכל worker יכול להציג אותן.
+ה-worker שמריץ job רושם את עצמו כבעלים ומעדכן heartbeat; job שהבעלים שלו
+מת (crash, kill -9) מסומן cancelled בעליית worker, ושליחה חוזרת יכולה לתפוס אותו
+"""
+import asyncio
+import codecs
+import csv
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
+
+from app.config import env_float, env_int, env_str
+from app.services.allowlist import Allowlist, normalize_phone
+from app.services.menus import Menu
+from app.services.metrics import pid_alive
+from app.services.rate_limiter import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# מצבי job
+RUNNING = "running"
+DONE = "done"
+CANCELLED = "cancelled"  # בוטל ידנית, או שהשרת נעצר / ה-worker מת באמצע (הנמענים שלא נשלחו נשארים pending)
+
+# מצבי נמען - sent/queued/error הם ה-status של WhatsAppService.send_message
+PENDING = "pending"
+SENT = "sent"
+QUEUED = "queued"
+ERROR = "error"
+RECIPIENT_STATUSES = (PENDING, SENT, QUEUED, ERROR)
+
+# שמות עמודה שמזוהים כעמודת הטלפון בשורת הכותרת של CSV
+PHONE_COLUMNS = ("phone", "phone_number", "number", "mobile", "טלפון", "מספר")
+
+
+def _owner_gone(owner: Optional[str], heartbeat_at: Optional[float], stale_seconds: float, me: str) -> bool:
+    """
+    האם הבעלים (host:pid:token) של job שרץ כבר לא קיים: ה-heartbeat שלו ישן,
+    או שהוא תהליך באותו host שמת (או שה-pid שלו הוא שלנו - תהליך קודם שה-pid
+    שלו מוחזר אחרי restart)
+    """
+    if heartbeat_at is None or heartbeat_at < time.time() - stale_seconds:
+        return True
+    if not owner or owner == me:
+        return False
+    host, pid, _ = owner.split(":")
+    my_host, my_pid, _ = me.split(":")
+    return host == my_host and (pid == my_pid or not pid_alive(int(pid)))
+
+
+class BroadcastStore:
+    """טבלאות ה-jobs והנמענים ב-SQLite (WAL) - משותפות לכל ה-workers"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS broadcasts ("
+            " id TEXT PRIMARY KEY,"
+            " kind TEXT NOT NULL,"
+            " message TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " total INTEGER NOT NULL DEFAULT 0,"
+            " skipped INTEGER NOT NULL DEFAULT 0,"
+            " created_at REAL NOT NULL,"
+            " finished_at REAL,"
+            " owner TEXT,"
+            " heartbeat_at REAL)"
+        )
+        # קבצים מגרסה שלפני הבעלים וה-heartbeat
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(broadcasts)")}
+        for column, kind in (("owner", "TEXT"), ("heartbeat_at", "REAL")):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE broadcasts ADD COLUMN {column} {kind}")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS broadcasts_created ON broadcasts (created_at)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS broadcast_recipients ("
+            " job_id TEXT NOT NULL,"
+            " seq INTEGER NOT NULL,"
+            " phone_number TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " status_code INTEGER,"
+            " error TEXT,"
+            " updated_at REAL,"
+            " PRIMARY KEY (job_id, seq)) WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS broadcast_recipients_status ON broadcast_recipients (job_id, status, seq)"
+        )
+    
+    def create(self, job_id: str, kind: str, message: str, owner: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO broadcasts (id, kind, message, status, created_at, owner, heartbeat_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, message, RUNNING, now, owner, now),
+            )
+    
+    def add_recipients(self, job_id: str, rows: List[Tuple[int, str]]):
+        """מוסיף נמענים (seq, phone_number) במצב pending - טרנזקציה אחת לכל קבוצה"""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO broadcast_recipients (job_id, seq, phone_number, status) VALUES (?, ?, ?, ?)",
+                    [(job_id, seq, phone_number, PENDING) for seq, phone_number in rows],
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+    
+    def set_totals(self, job_id: str, total: int, skipped: int):
+        with self._lock:
+            self._conn.execute("UPDATE broadcasts SET total = ?, skipped = ? WHERE id = ?", (total, skipped, job_id))
+    
+    def set_status(self, job_id: str, status: str, only_if: Optional[str] = None) -> bool:
+        """מעדכן את מצב ה-job (רק אם הוא במצב only_if, אם ניתן). Returns: האם עודכן"""
+        query = "UPDATE broadcasts SET status = ?, finished_at = ? WHERE id = ?"
+        params: list = [status, time.time() if status != RUNNING else None, job_id]
+        if only_if is not None:
+            query += " AND status = ?"
+            params.append(only_if)
+        with self._lock:
+            return self._conn.execute(query, params).rowcount > 0
+    
+    def take(self, job_id: str, owner: str):
+        """מעביר את ה-job ל-running עם owner כבעלים"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE broadcasts SET status = ?, finished_at = NULL, owner = ?, heartbeat_at = ? WHERE id = ?",
+                (RUNNING, owner, time.time(), job_id),
+            )
+    
+    def heartbeat(self, job_id: str, owner: str) -> bool:
+        """
+        מעדכן את ה-heartbeat של job שרץ אצל owner.
+        Returns: False אם ה-job בוטל או נתפס בינתיים על ידי worker אחר
+        """
+        with self._lock:
+            return self._conn.execute(
+                "UPDATE broadcasts SET heartbeat_at = ? WHERE id = ? AND status = ? AND owner = ?",
+                (time.time(), job_id, RUNNING, owner),
+            ).rowcount > 0
+    
+    def finish(self, job_id: str, owner: str, status: str) -> bool:
+        """מסיים job שרץ אצל owner (לא נוגע ב-job שנתפס בינתיים). Returns: האם עודכן"""
+        with self._lock:
+            return self._conn.execute(
+                "UPDATE broadcasts SET status = ?, finished_at = ? WHERE id = ? AND status = ? AND owner = ?",
+                (status, time.time(), job_id, RUNNING, owner),
+            ).rowcount > 0
+    
+    def cancel_orphans(self, stale_seconds: float, me: str) -> List[str]:
+        """מסמן cancelled את ה-jobs שרצים אצל בעלים שכבר לא קיים. Returns: המזהים שלהם"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                orphans = [
+                    job_id for job_id, owner, heartbeat_at in self._conn.execute(
+                        "SELECT id, owner, heartbeat_at FROM broadcasts WHERE status = ?", (RUNNING,),
+                    ).fetchall()
+                    if _owner_gone(owner, heartbeat_at, stale_seconds, me)
+                ]
+                self._conn.executemany(
+                    "UPDATE broadcasts SET status = ?, finished_at = ? WHERE id = ?",
+                    [(CANCELLED, time.time(), job_id) for job_id in orphans],
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return orphans
+    
+    def status(self, job_id: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT status FROM broadcasts WHERE id = ?", (job_id,)).fetchone()
+        return row[0] if row else None
+    
+    def claim_retry(self, job_id: str, owner: str, stale_seconds: float) -> Optional[int]:
+        """
+        מעביר job שהסתיים (או שרץ אצל בעלים שכבר לא קיים) ל-running עם owner
+        כבעלים ומחזיר את הנמענים שנכשלו ל-pending, בטרנזקציה אחת - כך שרק
+        בקשה אחת (מכל ה-workers) מתחילה שליחה חוזרת
+        Returns: כמה נמענים הוחזרו, או None אם ה-job לא קיים או עדיין רץ
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT status, owner, heartbeat_at FROM broadcasts WHERE id = ?", (job_id,),
+                ).fetchone()
+                claimed = row is not None and (row[0] != RUNNING or _owner_gone(row[1], row[2], stale_seconds, owner))
+                if claimed:
+                    self._conn.execute(
+                        "UPDATE broadcasts SET status = ?, finished_at = NULL, owner = ?, heartbeat_at = ? WHERE id = ?",
+                        (RUNNING, owner, time.time(), job_id),
+                    )
+                retried = None
+                if claimed:
+                    retried = self._conn.execute(
+                        "UPDATE broadcast_recipients SET status = ?, status_code = NULL, error = NULL"
+                        " WHERE job_id = ? AND status = ?",
+                        (PENDING, job_id, ERROR),
+                    ).rowcount
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return retried
+    
+    def pending(self, job_id: str, after_seq: int, limit: int) -> List[Tuple[int, str]]:
+        """הנמענים הבאים שעוד לא נשלחו, לפי הסדר"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT seq, phone_number FROM broadcast_recipients"
+                " WHERE job_id = ? AND status = ? AND seq > ? ORDER BY seq LIMIT ?",
+                (job_id, PENDING, after_seq, limit),
+            ).fetchall()
+    
+    def record(self, job_id: str, results: List[Tuple[int, str, Optional[int], Optional[str]]]):
+        """שומר תוצאות (seq, status, status_code, error) - טרנזקציה אחת לכל קבוצה"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "UPDATE broadcast_recipients SET status = ?, status_code = ?, error = ?, updated_at = ?"
+                    " WHERE job_id = ? AND seq = ?",
+                    [(status, status_code, error, now, job_id, seq) for seq, status, status_code, error in results],
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+    
+    def get(self, job_id: str) -> Optional[Dict]:
+        """ה-job עם ספירת הנמענים לפי מצב"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, kind, message, status, total, skipped, created_at, finished_at, owner, heartbeat_at"
+                " FROM broadcasts WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            counts = dict.fromkeys(RECIPIENT_STATUSES, 0)
+            counts.update(self._conn.execute(
+                "SELECT status, COUNT(*) FROM broadcast_recipients WHERE job_id = ? GROUP BY status", (job_id,),
+            ).fetchall())
+        job_id, kind, message, status, total, skipped, created_at, finished_at, owner, heartbeat_at = row
+        done = total - counts[PENDING]
+        elapsed = (finished_at or time.time()) - created_at
+        return {
+            "id": job_id,
+            "kind": kind,
+            "message": message,
+            "status": status,
+            "total": total,
+            "skipped": skipped,
+            "recipients": counts,
+            "progress": round(done / total, 4) if total else 1.0,
+            "created_at": created_at,
+            "finished_at": finished_at,
+            "elapsed_seconds": round(elapsed, 3),
+            "per_second": round(done / elapsed, 1) if elapsed > 0 else None,
+            "owner": owner,
+            "heartbeat_at": heartbeat_at,
+        }
+    
+    def results(self, job_id: str, status: Optional[str] = None, after_seq: int = 0,
+                limit: int = 100) -> List[Dict]:
+        """תוצאה לכל נמען לפי הסדר (after_seq - לעמוד הבא)"""
+        query = ("SELECT seq, phone_number, status, status_code, error, updated_at FROM broadcast_recipients"
+                 " WHERE job_id = ? AND seq > ?")
+        params: list = [job_id, after_seq]
+        if status:
+            query += " AND status = ?"
+            params.append(status)
+        query += " ORDER BY seq LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [
+            {"seq": row[0], "phone_number": row[1], "status": row[2], "status_code": row[3],
+             "error": row[4], "updated_at": row[5]}
+            for row in rows
+        ]
+    
+    def jobs(self, limit: int = 20) -> List[Dict]:
+        """ה-jobs האחרונים (בלי ספירת נמענים)"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, kind, status, total, created_at, finished_at FROM broadcasts"
+                " ORDER BY created_at DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [
+            {"id": row[0], "kind": row[1], "status": row[2], "total": row[3],
+             "created_at": row[4], "finished_at": row[5]}
+            for row in rows
+        ]
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+async def iter_list(values: Iterable[str]) -> AsyncIterator[str]:
+    """רשימת נמענים רגילה כ-async iterator (הממשק של Broadcaster.create)"""
+    for value in values:
+        yield value
+
+
+async def iter_csv_phones(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """
+    מספרי טלפון מ-CSV שמגיע ב-stream (UTF-8, עם או בלי BOM): העמודה הראשונה,
+    או עמודה מ-PHONE_COLUMNS אם יש שורת כותרת. שורה שאין בה ספרות מדולגת
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    column: Optional[int] = None
+    buffer = ""
+    first = True
+    
+    def rows(lines: List[str]):
+        nonlocal column, first
+        for row in csv.reader(lines):
+            if not row:
+                continue
+            if first:
+                first = False
+                header = [cell.strip().lower() for cell in row]
+                matches = [i for i, name in enumerate(header) if name in PHONE_COLUMNS]
+                if matches:
+                    column = matches[0]
+                    continue
+            cell = row[column or 0] if len(row) > (column or 0) else ""
+            yield cell
+    
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        lines = buffer.split("\n")
+        buffer = lines.pop()
+        for cell in rows(lines):
+            yield cell
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        for cell in rows([buffer]):
+            yield cell
+
+
+class Broadcaster:
+    """
+    מריץ jobs של שליחה מרוכזת ב-worker שקיבל אותם: לכל job תור חסום
+    ו-concurrency שולחים, ו-token bucket לקצב (בנוסף למגבלות של
+    WhatsAppService). תוצאות נצברות ונכתבות בקבוצות
+    """
+    
+    # כמה נמענים נשלפים מהטבלה בכל פעם / כמה תוצאות נכתבות בכל פעם
+    PAGE_SIZE = 1000
+    FLUSH_EVERY = 200
+    FLUSH_INTERVAL = 0.5
+    
+    def __init__(self, store: BroadcastStore, whatsapp_service, allowlist: Optional[Allowlist] = None,
+                 concurrency: int = 50, rate: float = 0.0, max_recipients: int = 100_000,
+                 stale_seconds: float = 30.0):
+        self.store = store
+        self.whatsapp_service = whatsapp_service
+        # נמענים שה-allowlist לא מנתב לא נשלחים (None = בלי בדיקה)
+        self.allowlist = allowlist
+        self.concurrency = concurrency
+        self.rate = rate
+        self.max_recipients = max_recipients
+        # אחרי כמה שניות בלי heartbeat job שרץ נחשב יתום
+        self.stale_seconds = stale_seconds
+        # הבעלים של ה-jobs שרצים בתהליך הזה (ה-token מבדיל מתהליך קודם עם אותו pid)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._jobs: Dict[str, asyncio.Task] = {}
+    
+    def cancel_orphans(self) -> List[str]:
+        """
+        מסמן cancelled את ה-jobs שה-worker שהריץ אותם מת בלי shutdown מסודר
+        (נקרא בעליית ה-worker) - אפשר להמשיך אותם בשליחה חוזרת
+        """
+        orphans = self.store.cancel_orphans(self.stale_seconds, self.owner)
+        for job_id in orphans:
+            logger.warning("Broadcast %s was left running by a worker that is gone - marked cancelled", job_id)
+        return orphans
+    
+    def claim_retry(self, job_id: str) -> Optional[int]:
+        """תופס job לשליחה חוזרת בתהליך הזה (ראו BroadcastStore.claim_retry)"""
+        return self.store.claim_retry(job_id, self.owner, self.stale_seconds)
+    
+    async def create(self, kind: str, message: str, recipients: AsyncIterator[str],
+                     menu: Optional[Menu] = None) -> Dict:
+        """
+        יוצר job: מנרמל את מספרי הטלפון, מדלג על כפולים, לא תקינים ומספרים
+        שלא ב-allowlist, כותב את הנמענים לטבלה ומתחיל לשלוח ברקע.
+        Returns: מצב ה-job (עם not_allowed - כמה מהדילוגים היו מספרים לא מורשים)
+        
+        Raises:
+            ValueError: אם אין נמענים תקינים או שיש יותר מ-max_recipients
+        """
+        job_id = uuid.uuid4().hex
+        self.store.create(job_id, kind, message, self.owner)
+        # heartbeat גם בזמן קריאת הנמענים (CSV גדול יכול להגיע לאט)
+        keepalive = asyncio.create_task(self._keep_alive(job_id))
+        seen = set()
+        batch: List[Tuple[int, str]] = []
+        skipped = not_allowed = 0
+        try:
+            async for raw in recipients:
+                phone_number = normalize_phone(str(raw))
+                if not phone_number or phone_number in seen:
+                    skipped += 1
+                    continue
+                if self.allowlist is not None and not self.allowlist.allows(phone_number):
+                    skipped += 1
+                    not_allowed += 1
+                    continue
+                if len(seen) >= self.max_recipients:
+                    raise ValueError(f"More than {self.max_recipients} recipients")
+                seen.add(phone_number)
+                batch.append((len(seen), phone_number))
+                if len(batch) >= self.PAGE_SIZE:
+                    self.store.add_recipients(job_id, batch)
+                    batch = []
+            if batch:
+                self.store.add_recipients(job_id, batch)
+            if not seen:
+                raise ValueError("No valid recipients" + (f" ({not_allowed} not in the allowlist)" if not_allowed else ""))
+        except BaseException:
+            self.store.set_totals(job_id, len(seen), skipped)
+            self.store.set_status(job_id, CANCELLED)
+            raise
+        finally:
+            keepalive.cancel()
+        self.store.set_totals(job_id, len(seen), skipped)
+        self.start(job_id, kind, message, menu)
+        logger.info("Broadcast %s: %d recipients (%d skipped, %d not in the allowlist), %s",
+                    job_id, len(seen), skipped, not_allowed, kind)
+        return {**self.store.get(job_id), "not_allowed": not_allowed}
+    
+    def start(self, job_id: str, kind: str, message: str, menu: Optional[Menu] = None):
+        """מתחיל (או ממשיך) לשלוח את הנמענים שעדיין pending"""
+        self.store.take(job_id, self.owner)
+        previous = self._jobs.get(job_id)
+        if previous is not None:
+            # ריצה קודמת באותו תהליך שנתקעה עד שה-job נתפס מחדש
+            previous.cancel()
+        task = asyncio.create_task(self._run(job_id, kind, message, menu), name=f"broadcast-{job_id}")
+        self._jobs[job_id] = task
+        
+        def done(_):
+            if self._jobs.get(job_id) is task:
+                del self._jobs[job_id]
+        task.add_done_callback(done)
+    
+    def cancel(self, job_id: str) -> bool:
+        """
+        מסמן job שרץ כ-cancelled. ה-worker שמריץ אותו (גם אם זה worker אחר)
+        רואה את הסימון בבדיקה התקופתית ועוצר. Returns: האם ה-job רץ
+        """
+        if not self.store.set_status(job_id, CANCELLED, only_if=RUNNING):
+            return False
+        task = self._jobs.get(job_id)
+        if task is not None:
+            task.cancel()
+        return True
+    
+    async def stop(self):
+        """עוצר את כל ה-jobs (נקרא ב-shutdown) - הם מסומנים cancelled והנמענים שלא נשלחו נשארים pending"""
+        tasks = list(self._jobs.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    async def _keep_alive(self, job_id: str):
+        while True:
+            await asyncio.sleep(self.FLUSH_INTERVAL)
+            self.store.heartbeat(job_id, self.owner)
+    
+    async def _send(self, kind: str, message: str, menu: Optional[Menu], phone_number: str) -> dict:
+        if kind == "menu":
+            return await self.whatsapp_service.send_menu(phone_number, menu)
+        return await self.whatsapp_service.send_message(phone_number, message)
+    
+    async def _run(self, job_id: str, kind: str, message: str, menu: Optional[Menu]):
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        results: List[Tuple[int, str, Optional[int], Optional[str]]] = []
+        bucket = TokenBucket(self.rate, max(1.0, self.rate / 10)) if self.rate > 0 else None
+        status = CANCELLED
+        runner = asyncio.current_task()
+        
+        def flush():
+            if results:
+                self.store.record(job_id, results[:])
+                results.clear()
+        
+        async def sender():
+            while True:
+                seq, phone_number = await queue.get()
+                try:
+                    result = await self._send(kind, message, menu, phone_number)
+                    results.append((seq, result.get("status", ERROR), result.get("status_code"), result.get("error")))
+                    if len(results) >= self.FLUSH_EVERY:
+                        flush()
+                finally:
+                    queue.task_done()
+        
+        async def flusher():
+            # כתיבת התוצאות שנצברו ו-heartbeat, שגם בודק אם ה-job בוטל או נתפס (אולי דרך worker אחר)
+            while True:
+                await asyncio.sleep(self.FLUSH_INTERVAL)
+                flush()
+                if not self.store.heartbeat(job_id, self.owner):
+                    runner.cancel()
+                    return
+        
+        workers = [asyncio.create_task(sender()) for _ in range(self.concurrency)]
+        workers.append(asyncio.create_task(flusher()))
+        try:
+            after_seq = 0
+            while True:
+                page = self.store.pending(job_id, after_seq, self.PAGE_SIZE)
+                if not page:
+                    break
+                for seq, phone_number in page:
+                    if bucket is not None:
+                        await bucket.acquire()
+                    await queue.put((seq, phone_number))
+                after_seq = page[-1][0]
+            await queue.join()
+            status = DONE
+        except Exception:
+            logger.exception("Broadcast %s failed", job_id)
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            flush()
+            if self._jobs.get(job_id) is runner:
+                # ריצה שהוחלפה בתהליך הזה לא מסיימת את הריצה שהחליפה אותה
+                self.store.finish(job_id, self.owner, status)
+            job = self.store.get(job_id)
+            logger.info("Broadcast %s %s: %s in %.1fs", job_id, status, job["recipients"], job["elapsed_seconds"])
+    
+    def stats(self) -> dict:
+        return {
+            "path": self.store.path,
+            "running_here": list(self._jobs),
+            "concurrency": self.concurrency,
+            "rate": self.rate or None,
+            "max_recipients": self.max_recipients,
+            "stale_seconds": self.stale_seconds,
+        }
+    
+    def close(self):
+        self.store.close()
+
+
+def create_broadcaster(whatsapp_service, allowlist: Optional[Allowlist] = None) -> Broadcaster:
+    """
+    יוצר את שירות השליחה המרוכזת לפי משתני הסביבה:
+        BROADCAST_DB_PATH: קובץ ה-SQLite של ה-jobs והתוצאות (ברירת מחדל: data/broadcasts.db)
+        BROADCAST_CONCURRENCY: הודעות שבדרך במקביל לכל job (ברירת מחדל: 50)
+        BROADCAST_RATE: הודעות לשנייה לכל job (ברירת מחדל: 0 = ללא הגבלה מעבר ל-OUTBOUND_RATE)
+        BROADCAST_MAX_RECIPIENTS: מקסימום נמענים ל-job (ברירת מחדל: 100000)
+        BROADCAST_STALE_SECONDS: אחרי כמה שניות בלי heartbeat job שרץ נחשב יתום (ברירת מחדל: 30)
+    """
+    return Broadcaster(
+        BroadcastStore(env_str("BROADCAST_DB_PATH", "data/broadcasts.db")),
+        whatsapp_service,
+        allowlist,
+        concurrency=env_int("BROADCAST_CONCURRENCY", 50),
+        rate=env_float("BROADCAST_RATE", 0.0),
+        max_recipients=env_int("BROADCAST_MAX_RECIPIENTS", 100_000),
+        stale_seconds=env_float("BROADCAST_STALE_SECONDS", 30.0),
+    )
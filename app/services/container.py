@@ -0,0 +1,179 @@
+"""
+השירותים של ה-worker (Service Container)
+כל שירות נוצר בעצלות בגישה הראשונה ומשותף לכל ה-endpoints של התהליך, כך
+ש-import של האפליקציה לא פותח קבצי DB, חיבורי HTTP או threads - הם נוצרים
+ב-startup של ה-worker (או בשימוש הראשון מחוץ לשרת, למשל בסקריפט)
+"""
+import logging
+import time
+from functools import cached_property
+from typing import List, Optional
+
+from app.config import env_float
+from app.services.allowlist import Allowlist, create_allowlist
+from app.services.broadcast import Broadcaster, create_broadcaster
+from app.services.dedup import DedupCache, create_dedup_cache
+from app.services.delivery_tracker import DeliveryTracker, create_delivery_tracker
+from app.services.dispatch_queue import dispatch_queue
+from app.services.flow_manager import FlowManager
+from app.services.metrics import metrics
+from app.services.sequencer import create_process_key_lock, phone_sequencer
+from app.services.whatsapp_service import WhatsAppService
+
+logger = logging.getLogger(__name__)
+
+
+class Services:
+    """
+    השירותים של התהליך - כל אחד נוצר פעם אחת, בגישה הראשונה
+    
+    start מפעיל את עבודות הרקע (ויוצר את כל השירותים לפני שה-worker מקבל
+    בקשות), ו-stop מנקז אותן לפי הסדר: קודם מה שמייצר הודעות יוצאות (תור
+    השיגור, שליחות מרוכזות, תזכורות), אחר כך ה-client של N8N, ובסוף קבצי ה-DB
+    """
+    
+    # שמות השירותים (לפי סדר היצירה ב-start)
+    NAMES = ("whatsapp", "flow_manager", "dedup", "delivery_tracker", "allowlist", "broadcaster")
+    
+    def __init__(self, drain_timeout: float = 10.0):
+        # כמה זמן לחכות לריקון תור השיגור ב-shutdown
+        self.drain_timeout = drain_timeout
+        self.started = False
+        self.startup_seconds: Optional[float] = None
+    
+    @cached_property
+    def whatsapp(self) -> WhatsAppService:
+        return WhatsAppService()
+    
+    @cached_property
+    def flow_manager(self) -> FlowManager:
+        return FlowManager()
+    
+    @cached_property
+    def dedup(self) -> DedupCache:
+        # סינון webhooks כפולים לפי מזהה ההודעה (משותף בין workers אם ה-backend תומך)
+        return create_dedup_cache(self.flow_manager.store)
+    
+    @cached_property
+    def delivery_tracker(self) -> Optional[DeliveryTracker]:
+        # מעקב זמני מסירה/קריאה של הודעות יוצאות (None אם DELIVERY_TRACKING כבוי)
+        return create_delivery_tracker()
+    
+    @cached_property
+    def allowlist(self) -> Allowlist:
+        # מספרים מורשים וניתוב לכל מספר (נטען מ-ALLOWLIST_PATH ומתעדכן כשהקובץ משתנה)
+        return create_allowlist()
+    
+    @cached_property
+    def broadcaster(self) -> Broadcaster:
+        # שליחה מרוכזת - jobs ברקע עם התקדמות ותוצאות לכל נמען (רק למספרים ב-allowlist)
+        return create_broadcaster(self.whatsapp, self.allowlist)
+    
+    def created(self) -> List[str]:
+        """השירותים שכבר נוצרו (בלי ליצור את השאר)"""
+        return [name for name in self.NAMES if name in self.__dict__]
+    
+    def register_gauges(self):
+        """מדדים רגעיים שנאספים בזמן ה-scrape של /metrics"""
+        metrics.gauge(
+            "flow_active_sessions", "Live conversation sessions per flow state", ("state",),
+            lambda: {(state,): count for state, count in self.flow_manager.store.count_by_state().items()},
+            # backend משותף - כל worker רואה את אותה ספירה, אז לא מסכמים בין workers
+            shared=self.flow_manager.store.shared,
+        )
+        metrics.gauge(
+            "n8n_endpoint_up", "1 while an n8n endpoint is in rotation, 0 while its circuit breaker is open",
+            ("endpoint",),
+            lambda: {(e["url"],): int(e["state"] != "open") for e in self.whatsapp.endpoint_stats()["endpoints"]},
+        )
+        if self.whatsapp.outbox is not None:
+            metrics.gauge(
+                "outbox_messages", "Messages in the outbound outbox, by status", ("status",),
+                lambda: {(status,): count for status, count in self.whatsapp.outbox.count_by_status().items()},
+                # טבלת SQLite אחת לכל ה-workers
+                shared=True,
+            )
+        metrics.gauge(
+            "reminders", "Scheduled reminders, by status", ("status",),
+            lambda: {(status,): count
+                     for status, count in self.flow_manager.reminders.store.count_by_status().items()},
+            shared=True,
+        )
+        metrics.gauge(
+            "dispatch_queue_depth", "Jobs waiting in the background dispatch queue", (),
+            lambda: {(): dispatch_queue.depth()},
+        )
+    
+    async def start(self):
+        """
+        יוצר את כל השירותים ומפעיל את עבודות הרקע: תור השיגור (אם
+        DISPATCH_MODE=queue), בדיקות התקינות של N8N וה-outbox, מתזמן התזכורות
+        וכתיבת המדדים
+        """
+        if self.started:
+            return
+        started = time.perf_counter()
+        logger.info("Starting WhatsApp Bot in '%s' mode", self.whatsapp.get_environment())
+        # יצירה מראש, כדי שהבקשה הראשונה לא תשלם על פתיחת DB או קריאת קבצים
+        for name in self.NAMES:
+            getattr(self, name)
+        # jobs שה-worker שלהם מת באמצע נשארו running - משחררים אותם לשליחה חוזרת
+        self.broadcaster.cancel_orphans()
+        if self.flow_manager.store.shared:
+            # הודעות של אותו מספר יכולות להגיע ל-workers שונים - נעילה בין תהליכים
+            phone_sequencer.process_lock = create_process_key_lock()
+        self.register_gauges()
+        if dispatch_queue.enabled:
+            await dispatch_queue.start()
+        await self.whatsapp.start()
+        await self.flow_manager.reminders.start(self.whatsapp.send_message)
+        await metrics.start()
+        self.started = True
+        self.startup_seconds = time.perf_counter() - started
+        logger.info("Worker ready in %.1f ms", self.startup_seconds * 1000)
+    
+    async def stop(self):
+        """
+        ניקוז לפי הסדר וסגירת החיבורים והקבצים. שלב שנכשל נרשם ללוג ולא מונע
+        את סגירת השאר; שירות שלא נוצר לא נוצר רק כדי להיסגר
+        """
+        started = time.perf_counter()
+        created = self.created()
+        steps = [("dispatch queue", lambda: dispatch_queue.stop(self.drain_timeout))]
+        if "broadcaster" in created:
+            steps.append(("broadcasts", self.broadcaster.stop))
+        if "flow_manager" in created:
+            steps.append(("reminders", self.flow_manager.reminders.stop))
+        if "whatsapp" in created:
+            steps.append(("n8n client", self.whatsapp.aclose))
+        steps.append(("metrics", metrics.stop))
+        for name, step in steps:
+            try:
+                await step()
+            except Exception:
+                logger.exception("Shutdown step '%s' failed", name)
+        
+        closers = []
+        if "flow_manager" in created:
+            closers += [self.flow_manager.store.close, self.flow_manager.proposals.close,
+                        self.flow_manager.reminders.close]
+        if "broadcaster" in created:
+            closers.append(self.broadcaster.close)
+        if phone_sequencer.process_lock is not None:
+            closers.append(phone_sequencer.process_lock.close)
+            phone_sequencer.process_lock = None
+        for close in closers:
+            try:
+                close()
+            except Exception:
+                logger.exception("Failed to close %r", close)
+        self.started = False
+        logger.info("Worker stopped in %.1f ms", (time.perf_counter() - started) * 1000)
+
+
+def create_services() -> Services:
+    """
+    יוצר את מיכל השירותים (בלי ליצור את השירותים עצמם) לפי משתני הסביבה:
+        SHUTDOWN_DRAIN_SECONDS: כמה זמן לחכות לריקון תור השיגור ב-shutdown (ברירת מחדל: 10)
+    """
+    return Services(drain_timeout=env_float("SHUTDOWN_DRAIN_SECONDS", 10.0))
@@ -0,0 +1,106 @@
+"""
+סינון כפילויות של webhooks (Idempotent Ingestion)
+Meta ו-N8N שולחים at-least-once - הודעה שכבר טופלה מזוהה לפי ה-id שלה
+ומדולגת בבדיקת hash אחת, בלי צעד flow ובלי שליחה נוספת ל-N8N
+"""
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from app.config import env_bool, env_float, env_int
+from app.services.state_store import StateStore
+
+
+class DedupCache:
+    """
+    LRU חסום בגודל וב-TTL של מזהים שכבר נראו
+    
+    כל המזהים נשמרים עם אותו TTL ולא מתרעננים בפגיעה, ולכן סדר ההכנסה
+    הוא גם סדר התפוגה - ניקוי מזהים שפג תוקפם נעשה מראש ה-OrderedDict
+    ב-O(1) לכל מזהה. אם הוגדר shared_store, מזהה חדש נבדק גם מול
+    ה-backend המשותף כדי לזהות כפילות שהגיעה ל-worker אחר
+    """
+    
+    def __init__(self, max_size: int = 100_000, ttl: float = 86_400.0,
+                 shared_store: Optional[StateStore] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.shared_store = shared_store
+        # Dictionary: message_id -> expires_at (monotonic)
+        self._entries: "OrderedDict[str, float]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def seen(self, key: Optional[str]) -> bool:
+        """
+        בודק ומסמן מזהה בפעולה אחת
+        
+        Returns:
+            True אם המזהה כבר נראה בתוך ה-TTL (כפילות), אחרת False
+        """
+        if not key:
+            return False
+        now = time.monotonic()
+        self._evict_expired(now)
+        
+        expires_at = self._entries.get(key)
+        if expires_at is not None and expires_at > now:
+            self.hits += 1
+            return True
+        
+        self._entries[key] = now + self.ttl
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        
+        if self.shared_store is not None and self.shared_store.mark_seen(key, self.ttl):
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+    
+    def _evict_expired(self, now: float):
+        """מסיר מזהים שפג תוקפם מראש הרשימה"""
+        entries = self._entries
+        while entries:
+            key, expires_at = next(iter(entries.items()))
+            if expires_at > now:
+                break
+            del entries[key]
+    
+    def forget(self, key: Optional[str]):
+        """מבטל סימון של מזהה (למשל כשההודעה לא טופלה ויש לעבד את ה-redelivery)"""
+        if not key:
+            return
+        self._entries.pop(key, None)
+        if self.shared_store is not None:
+            self.shared_store.forget_seen(key)
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def stats(self) -> dict:
+        """מחזיר את גודל ה-cache ומוני הפגיעות"""
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl,
+            "shared": self.shared_store is not None,
+            "duplicates": self.hits,
+            "unique": self.misses,
+        }
+
+
+def create_dedup_cache(store: StateStore) -> DedupCache:
+    """
+    יוצר את ה-cache לפי משתני הסביבה:
+        DEDUP_MAX_SIZE: מספר מזהים מקסימלי בזיכרון (ברירת מחדל: 100000)
+        DEDUP_TTL: כמה שניות לזכור מזהה (ברירת מחדל: 86400)
+        DEDUP_SHARED: להשתמש ב-backend המשותף אם הוא תומך (ברירת מחדל: true)
+    """
+    shared = store if store.shared and env_bool("DEDUP_SHARED", True) else None
+    return DedupCache(
+        max_size=env_int("DEDUP_MAX_SIZE", 100_000),
+        ttl=env_float("DEDUP_TTL", 86_400.0),
+        shared_store=shared,
+    )
@@ -0,0 +1,90 @@
+"""
+מעקב מסירה (Delivery Tracking)
+רושם את עדכוני ה-status של הודעות יוצאות (sent / delivered / read / failed)
+ומחשב לכל הודעה את זמן המסירה והקריאה מרגע שנשלחה, לפי ה-timestamps של WhatsApp
+"""
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Optional
+
+from app.config import env_bool, env_int
+from app.services.webhook_parser import InboundStatus
+
+
+def _percentile(sorted_values: list, fraction: float) -> float:
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def _summary(samples: Deque[int]) -> Optional[dict]:
+    """ממוצע ואחוזונים (בשניות) על המדגם האחרון"""
+    if not samples:
+        return None
+    values = sorted(samples)
+    return {
+        "samples": len(values),
+        "avg": round(sum(values) / len(values), 3),
+        "p50": _percentile(values, 0.50),
+        "p90": _percentile(values, 0.90),
+        "p99": _percentile(values, 0.99),
+        "max": values[-1],
+    }
+
+
+class DeliveryTracker:
+    """
+    זמן "sent" של כל הודעה נשמר ב-LRU חסום עד שמגיע "read" או "failed";
+    "delivered" ו-"read" מוסיפים את הפרש הזמנים למדגם מתגלגל בגודל קבוע
+    """
+    
+    def __init__(self, max_pending: int = 100_000, sample_size: int = 1024):
+        self.max_pending = max_pending
+        # Dictionary: message_id -> sent timestamp (שניות, לפי WhatsApp)
+        self._sent_at: "OrderedDict[str, int]" = OrderedDict()
+        self._delivery: Deque[int] = deque(maxlen=sample_size)
+        self._read: Deque[int] = deque(maxlen=sample_size)
+        self.counts: Dict[str, int] = {}
+    
+    def record(self, status: InboundStatus):
+        """רושם עדכון status אחד"""
+        self.counts[status.status] = self.counts.get(status.status, 0) + 1
+        if not status.status_id or not status.timestamp:
+            return
+        try:
+            timestamp = int(status.timestamp)
+        except ValueError:
+            return
+        
+        if status.status == "sent":
+            self._sent_at[status.status_id] = timestamp
+            while len(self._sent_at) > self.max_pending:
+                self._sent_at.popitem(last=False)
+        elif status.status == "delivered":
+            sent_at = self._sent_at.get(status.status_id)
+            if sent_at is not None:
+                self._delivery.append(max(0, timestamp - sent_at))
+        elif status.status == "read":
+            sent_at = self._sent_at.pop(status.status_id, None)
+            if sent_at is not None:
+                self._read.append(max(0, timestamp - sent_at))
+        elif status.status == "failed":
+            self._sent_at.pop(status.status_id, None)
+    
+    def stats(self) -> dict:
+        """מונים לפי status וזמני מסירה/קריאה בשניות"""
+        return {
+            "counts": dict(self.counts),
+            "pending": len(self._sent_at),
+            "delivery_latency_seconds": _summary(self._delivery),
+            "read_latency_seconds": _summary(self._read),
+        }
+
+
+def create_delivery_tracker() -> Optional[DeliveryTracker]:
+    """
+    יוצר את ה-tracker לפי משתני הסביבה (או None אם כבוי):
+        DELIVERY_TRACKING: הפעלת מעקב המסירה (ברירת מחדל: false)
+        DELIVERY_TRACKING_MAX_PENDING: כמה הודעות שנשלחו לזכור עד שנקראו (ברירת מחדל: 100000)
+    """
+    if not env_bool("DELIVERY_TRACKING", False):
+        return None
+    return DeliveryTracker(max_pending=env_int("DELIVERY_TRACKING_MAX_PENDING", 100_000))
@@ -0,0 +1,138 @@
+"""
+תור שיגור (Dispatch Queue) לעיבוד הודעות נכנסות ברקע
+ה-webhook רק מאמת ומכניס עבודה לתור, ו-workers מעבדים אותה במקביל
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, List, Optional
+
+from app.config import env_float, env_int, env_str
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """התור מלא - יש להחזיר תשובת עומס כדי שהשולח ינסה שוב מאוחר יותר"""
+
+
+class DispatchQueue:
+    """
+    תור חסום (bounded) עם מאגר workers
+    
+    כשהתור מלא, submit ממתין לכל היותר put_timeout שניות ואז זורק
+    QueueFullError במקום לגדול ללא הגבלה (backpressure)
+    """
+    
+    def __init__(self):
+        """אתחול התור לפי משתני הסביבה"""
+        # inline - עיבוד בתוך הבקשה (ברירת מחדל), queue - עיבוד ברקע
+        self.mode = env_str("DISPATCH_MODE", "inline").lower()
+        self.maxsize = env_int("DISPATCH_QUEUE_SIZE", 1000)
+        self.num_workers = env_int("DISPATCH_WORKERS", 8)
+        self.put_timeout = env_float("DISPATCH_PUT_TIMEOUT", 0.05)
+        
+        # התור וה-workers נוצרים ב-start כדי להיקשר ל-event loop של ה-worker
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        
+        # מונים וסטטיסטיקות
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.last_lag = 0.0
+        self.avg_lag = 0.0
+        self.max_lag = 0.0
+    
+    @property
+    def enabled(self) -> bool:
+        """האם מצב עיבוד ברקע פעיל"""
+        return self.mode == "queue"
+    
+    @property
+    def running(self) -> bool:
+        """האם ה-workers רצים"""
+        return bool(self._workers)
+    
+    async def start(self):
+        """יוצר את התור ומפעיל את ה-workers"""
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._workers = [
+            asyncio.create_task(self._worker(), name=f"dispatch-worker-{i}")
+            for i in range(self.num_workers)
+        ]
+        logger.info("DispatchQueue started: %d workers, maxsize %d", self.num_workers, self.maxsize)
+    
+    async def stop(self, drain_timeout: float = 10.0):
+        """ממתין לריקון התור (עד drain_timeout) ועוצר את ה-workers"""
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("DispatchQueue stopped with %d pending items", self._queue.qsize())
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+    
+    async def submit(self, func: Callable[..., Awaitable], *args):
+        """
+        מכניס עבודה לתור
+        
+        Raises:
+            QueueFullError: אם התור נשאר מלא גם אחרי put_timeout
+        """
+        if not self.running:
+            raise RuntimeError("DispatchQueue is not running")
+        item = (time.monotonic(), func, args)
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(self._queue.put(item), timeout=self.put_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise QueueFullError(f"dispatch queue is full ({self.maxsize} items)")
+    
+    async def _worker(self):
+        """לולאת worker - שולף עבודות מהתור ומריץ אותן"""
+        while True:
+            enqueued_at, func, args = await self._queue.get()
+            lag = time.monotonic() - enqueued_at
+            self.last_lag = lag
+            self.avg_lag = lag if self.processed == 0 else 0.9 * self.avg_lag + 0.1 * lag
+            self.max_lag = max(self.max_lag, lag)
+            try:
+                await func(*args)
+            except Exception as e:
+                self.failed += 1
+                logger.exception("Dispatch job failed: %s", e)
+            finally:
+                self.processed += 1
+                self._queue.task_done()
+    
+    def depth(self) -> int:
+        """מספר העבודות שממתינות בתור"""
+        return self._queue.qsize() if self._queue is not None else 0
+    
+    def stats(self) -> dict:
+        """מחזיר את מצב התור - עומק, lag ומונים"""
+        return {
+            "mode": self.mode,
+            "depth": self.depth(),
+            "maxsize": self.maxsize,
+            "workers": len(self._workers),
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "last_lag_ms": round(self.last_lag * 1000, 3),
+            "avg_lag_ms": round(self.avg_lag * 1000, 3),
+            "max_lag_ms": round(self.max_lag * 1000, 3),
+        }
+
+
+# יצירת instance גלובלי
+dispatch_queue = DispatchQueue()
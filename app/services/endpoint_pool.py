@@ -0,0 +1,278 @@
+"""
+מאגר endpoints של N8N (Endpoint Pool)
+כמה כתובות webhook יוצאות במקום אחת: כל שליחה בוחרת endpoint לפי latency
+(או לפי משקל), circuit breaker מוציא endpoint שנכשל שוב ושוב מהסבב,
+ובדיקות תקינות ברקע מחזירות אותו כשהוא מתאושש
+"""
+import asyncio
+import logging
+import time
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import httpx
+
+from app.config import env_float, env_int, env_str
+
+logger = logging.getLogger(__name__)
+
+# מצבי ה-circuit breaker
+CLOSED = "closed"  # תקין - מקבל תעבורה
+OPEN = "open"  # הוצא מהסבב עד שיעבור open_seconds או שבדיקת תקינות תצליח
+HALF_OPEN = "half_open"  # בקשת ניסיון אחת - הצלחה סוגרת, כישלון פותח מחדש
+
+STRATEGIES = ("least_latency", "weighted")
+
+
+class Endpoint:
+    """endpoint אחד והמצב שלו - latency ממוצע (EWMA), בקשות פתוחות ו-circuit breaker"""
+    
+    __slots__ = ("url", "weight", "state", "latency", "in_flight", "failures",
+                 "opened_at", "trial", "current_weight", "requests", "errors", "ejections")
+    
+    def __init__(self, url: str, weight: int = 1):
+        self.url = url
+        self.weight = weight
+        self.state = CLOSED
+        # EWMA של זמן התגובה בשניות (0 = עוד לא נמדד)
+        self.latency = 0.0
+        self.in_flight = 0
+        # כישלונות רצופים
+        self.failures = 0
+        self.opened_at = 0.0
+        # האם בקשת הניסיון של HALF_OPEN כבר יצאה
+        self.trial = False
+        # משקל נוכחי ל-smooth weighted round robin
+        self.current_weight = 0
+        self.requests = 0
+        self.errors = 0
+        self.ejections = 0
+    
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "weight": self.weight,
+            "state": self.state,
+            "latency_ms": round(self.latency * 1000, 3),
+            "in_flight": self.in_flight,
+            "consecutive_failures": self.failures,
+            "requests": self.requests,
+            "errors": self.errors,
+            "ejections": self.ejections,
+        }
+
+
+def parse_endpoints(value: str) -> List[Tuple[str, int]]:
+    """
+    מפענח רשימה מופרדת בפסיקים של "<url> [weight]"
+    למשל: "https://a.example/webhook/whatsappout 3, https://b.example/webhook/whatsappout"
+    """
+    endpoints = []
+    for item in value.split(","):
+        parts = item.split()
+        if not parts:
+            continue
+        weight = int(parts[1]) if len(parts) > 1 else 1
+        if weight < 1:
+            raise ValueError(f"Endpoint weight must be >= 1: {item.strip()!r}")
+        endpoints.append((parts[0], weight))
+    return endpoints
+
+
+class EndpointPool:
+    """
+    בחירת endpoint לכל בקשה + circuit breaker + בדיקות תקינות
+    
+    least_latency: ה-endpoint עם ה-latency הממוצע הנמוך ביותר, מוכפל במספר
+    הבקשות הפתוחות אליו (כך ש-endpoint מהיר לא מוצף). weighted: smooth
+    weighted round robin לפי המשקלים. אחרי failure_threshold כישלונות רצופים
+    (שגיאת רשת, 429 או 5xx) ה-endpoint מוצא מהסבב ל-open_seconds, ואז מקבל
+    בקשת ניסיון אחת. אם כל ה-endpoints פתוחים, נבחר זה שנפתח ראשון - עדיף
+    לנסות מאשר לוותר על ההודעה
+    """
+    
+    # משקל המדידה החדשה ב-EWMA
+    LATENCY_ALPHA = 0.2
+    # כישלון נספר ב-EWMA כתגובה איטית לפחות כזו - endpoint שנכשל מהר לא "נראה" מהיר
+    FAILURE_PENALTY = 1.0
+    # הערכת latency ל-endpoint שעוד לא נמדד (כדי שמספר הבקשות הפתוחות ישפיע גם עליו)
+    UNMEASURED_LATENCY = 0.001
+    
+    def __init__(self, endpoints: Iterable[Tuple[str, int]], strategy: str = "least_latency",
+                 failure_threshold: int = 5, open_seconds: float = 30.0,
+                 probe_interval: float = 10.0, probe_timeout: float = 2.0):
+        self.endpoints = [Endpoint(url, weight) for url, weight in endpoints]
+        if not self.endpoints:
+            raise ValueError("EndpointPool needs at least one endpoint")
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown N8N_POOL_STRATEGY: {strategy!r} (expected one of {STRATEGIES})")
+        self.strategy = strategy
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self._prober: Optional[asyncio.Task] = None
+        self.failovers = 0
+    
+    @property
+    def primary(self) -> Endpoint:
+        return self.endpoints[0]
+    
+    # --- בחירה ---
+    
+    def _available(self, endpoint: Endpoint, now: float) -> bool:
+        if endpoint.state == CLOSED:
+            return True
+        if endpoint.state == OPEN and now - endpoint.opened_at >= self.open_seconds:
+            endpoint.state = HALF_OPEN
+            endpoint.trial = False
+        return endpoint.state == HALF_OPEN and not endpoint.trial
+    
+    def choose(self, exclude: Iterable[Endpoint] = ()) -> Endpoint:
+        """
+        בוחר endpoint לבקשה הבאה (ומסמן אותה כפתוחה - יש לקרוא ל-record בסיומה)
+        exclude: endpoints שכבר נכשלו בבקשה הזו (ניסיון חוזר עובר ל-endpoint אחר)
+        """
+        now = time.monotonic()
+        candidates = [e for e in self.endpoints if e not in exclude and self._available(e, now)]
+        if not candidates:
+            candidates = [e for e in self.endpoints if self._available(e, now)]
+        if not candidates:
+            endpoint = min(self.endpoints, key=lambda e: e.opened_at)
+        elif len(candidates) == 1:
+            endpoint = candidates[0]
+        elif self.strategy == "weighted":
+            total = 0
+            for candidate in candidates:
+                candidate.current_weight += candidate.weight
+                total += candidate.weight
+            endpoint = max(candidates, key=lambda e: e.current_weight)
+            endpoint.current_weight -= total
+        else:
+            unmeasured = self.UNMEASURED_LATENCY
+            endpoint = min(candidates, key=lambda e: (e.latency or unmeasured) * (e.in_flight + 1))
+        
+        if exclude and endpoint not in exclude:
+            self.failovers += 1
+        if endpoint.state == HALF_OPEN:
+            endpoint.trial = True
+        endpoint.in_flight += 1
+        endpoint.requests += 1
+        return endpoint
+    
+    def has_alternative(self, exclude: Iterable[Endpoint]) -> bool:
+        """האם יש endpoint זמין שלא ב-exclude (ניסיון חוזר יכול לעבור אליו בלי להמתין)"""
+        now = time.monotonic()
+        return any(e not in exclude and self._available(e, now) for e in self.endpoints)
+    
+    def record(self, endpoint: Endpoint, latency: float, ok: bool):
+        """מעדכן latency ו-circuit breaker אחרי בקשה שיצאה דרך choose"""
+        endpoint.in_flight -= 1
+        self._observe(endpoint, latency, ok)
+    
+    def release(self, endpoint: Endpoint):
+        """משחרר בקשה שיצאה דרך choose ולא הסתיימה (ביטול) - בלי לעדכן את המדדים"""
+        endpoint.in_flight -= 1
+        if endpoint.state == HALF_OPEN:
+            endpoint.trial = False
+    
+    def _observe(self, endpoint: Endpoint, latency: float, ok: bool):
+        if not ok:
+            latency = max(latency, self.FAILURE_PENALTY)
+        if endpoint.latency:
+            endpoint.latency += self.LATENCY_ALPHA * (latency - endpoint.latency)
+        else:
+            endpoint.latency = latency
+        if ok:
+            if endpoint.state != CLOSED:
+                logger.info("N8N endpoint %s recovered", endpoint.url)
+            endpoint.state = CLOSED
+            endpoint.failures = 0
+            return
+        endpoint.errors += 1
+        endpoint.failures += 1
+        if endpoint.state == HALF_OPEN or (endpoint.state == CLOSED and endpoint.failures >= self.failure_threshold):
+            self._open(endpoint)
+    
+    def _open(self, endpoint: Endpoint):
+        endpoint.state = OPEN
+        endpoint.opened_at = time.monotonic()
+        endpoint.trial = False
+        endpoint.ejections += 1
+        logger.warning("N8N endpoint %s ejected after %d consecutive failures", endpoint.url, endpoint.failures)
+    
+    # --- בדיקות תקינות ---
+    
+    async def start(self, get_client: Callable[[], httpx.AsyncClient]):
+        """
+        מפעיל בדיקות תקינות ברקע (רק כשיש יותר מ-endpoint אחד ו-probe_interval > 0)
+        get_client: מחזיר את ה-client המשותף של השירות (נוצר מחדש אם נסגר)
+        """
+        if self._prober is not None or self.probe_interval <= 0 or len(self.endpoints) < 2:
+            return
+        self._prober = asyncio.create_task(self._run_prober(get_client), name="n8n-endpoint-prober")
+    
+    async def stop(self):
+        if self._prober is not None:
+            self._prober.cancel()
+            await asyncio.gather(self._prober, return_exceptions=True)
+            self._prober = None
+    
+    async def _run_prober(self, get_client: Callable[[], httpx.AsyncClient]):
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            client = get_client()
+            await asyncio.gather(*(self.probe(client, endpoint) for endpoint in self.endpoints))
+    
+    async def probe(self, client: httpx.AsyncClient, endpoint: Endpoint):
+        """
+        בדיקת תקינות: HEAD ל-URL של ה-webhook. כל תשובה מתחת ל-500 (גם 404/405
+        של webhook שמקבל רק POST) מראה שהשרת חי ועונה. endpoint פתוח שעונה
+        עובר ל-HALF_OPEN ומקבל בקשת ניסיון בלי לחכות ל-open_seconds
+        """
+        started = time.perf_counter()
+        try:
+            response = await client.head(endpoint.url, timeout=self.probe_timeout)
+            ok = response.status_code < 500
+        except httpx.HTTPError:
+            ok = False
+        latency = time.perf_counter() - started
+        if endpoint.state == OPEN:
+            if ok:
+                endpoint.state = HALF_OPEN
+                endpoint.trial = False
+        elif not ok:
+            self._observe(endpoint, latency, ok)
+        elif not endpoint.latency:
+            # הערכה ראשונית ל-endpoint שעוד לא קיבל תעבורה
+            endpoint.latency = latency
+    
+    def stats(self) -> dict:
+        return {
+            "strategy": self.strategy,
+            "failure_threshold": self.failure_threshold,
+            "open_seconds": self.open_seconds,
+            "probe_interval_seconds": self.probe_interval or None,
+            "failovers": self.failovers,
+            "endpoints": [endpoint.stats() for endpoint in self.endpoints],
+        }
+
+
+def create_endpoint_pool(default_url: str) -> EndpointPool:
+    """
+    יוצר את מאגר ה-endpoints לפי משתני הסביבה:
+        N8N_WEBHOOK_URLS: "<url> [weight], ..." (ברירת מחדל: default_url בלבד)
+        N8N_POOL_STRATEGY: least_latency (ברירת מחדל) או weighted
+        N8N_CIRCUIT_FAILURES: כישלונות רצופים עד הוצאה מהסבב (ברירת מחדל: 5)
+        N8N_CIRCUIT_OPEN_SECONDS: כמה זמן endpoint נשאר מחוץ לסבב (ברירת מחדל: 30)
+        N8N_HEALTH_INTERVAL: כל כמה שניות לבדוק את ה-endpoints, 0 = כבוי (ברירת מחדל: 10)
+        N8N_HEALTH_TIMEOUT: timeout לבדיקת תקינות בשניות (ברירת מחדל: 2)
+    """
+    endpoints = parse_endpoints(env_str("N8N_WEBHOOK_URLS", "")) or [(default_url, 1)]
+    return EndpointPool(
+        endpoints,
+        strategy=env_str("N8N_POOL_STRATEGY", "least_latency").lower(),
+        failure_threshold=env_int("N8N_CIRCUIT_FAILURES", 5),
+        open_seconds=env_float("N8N_CIRCUIT_OPEN_SECONDS", 30.0),
+        probe_interval=env_float("N8N_HEALTH_INTERVAL", 10.0),
+        probe_timeout=env_float("N8N_HEALTH_TIMEOUT", 2.0),
+    )
@@ -0,0 +1,181 @@
+"""
+הגדרות הזרימות (Flow Definitions)
+כל זרימה מתוארת כנתונים בלבד - FlowEngine מקמפל אותן פעם אחת בעלייה
+לטבלת מעברים, ולכן הוספת זרימה חדשה לא דורשת קוד חדש ב-FlowManager
+
+מבנה זרימה (המפתח הוא ה-choice_id מהתפריט הראשי):
+    reply: תשובת טקסט קבועה לזרימה בלי שלבים (למשל פיצ'ר שעדיין בפיתוח)
+    data: נתונים התחלתיים שנשמרים בכניסה לזרימה
+    start: המצב (ערך של FlowState) של השלב הראשון
+    steps: מצב -> שלב. שלב הוא אחד משלושה:
+        - שלב קלט: prompt (השאלה שנשלחת בכניסה לשלב), field (איפה לשמור
+          את התשובה), next (המצב הבא, או None לסיום הזרימה)
+        - שלב בחירה: menu (תפריט שנשלח בכניסה לשלב - נבדק מול מגבלות
+          WhatsApp ונשמר מקומפל ב-MenuRegistry), choices (choice_id ->
+          {"next": מצב}, {"reply": טקסט} שמסיים את הזרימה, או {"action": שם}
+          שמטופל בקוד ב-FlowManager), invalid (תשובה לבחירה לא מוכרת)
+        - שלב action: action (שם) - כל הודעה בשלב מטופלת בקוד, למשל בחירה
+          מתפריט שנבנה לפי נתוני המשתמש או מועד שצריך לפענח (prompt ו-field
+          אופציונליים, כמו בשלב קלט)
+    summary: שורות הסיכום בסיום הזרימה, עם {field} לכל נתון שנאסף
+    on_complete: hook ב-FlowManager שמקבל את הנתונים בסיום (למשל שמירת המצע)
+"""
+
+# מילים שמבטלות את הזרימה הנוכחית בכל שלב
+CANCEL_WORDS = ("סיים", "סיום", "ביטול", "exit", "cancel")
+
+CANCELLED_REPLY = "התהליך בוטל. תודה!"
+UNKNOWN_CHOICE_REPLY = "אני לא מבין את הבחירה שלך"
+IDLE_REPLY = "אנא בחר אחת מהאפשרויות"
+
+# ערך ברירת מחדל בסיכום לנתון שלא נאסף
+MISSING_VALUE = "לא צוין"
+
+# התפריט הראשי - נשלח למשתמש במצב IDLE, וכל id בו הוא מפתח ב-FLOWS
+MAIN_MENU = {
+    "body_text": "בחר אחת מהאפשרויות הבאות:",
+    "options": [
+        {"id": "proposal_for_discussion", "title": "מצע לדיון"},
+        {"id": "new_reminder", "title": "תזכורת חדשה"},
+        {"id": "control_and_monitoring", "title": "בקרה ומעקב"},
+        {"id": "new_task", "title": "משימה חדשה"}
+    ],
+    "button_text": "בחר אפשרות"
+}
+
+# "מצע קיים" - רשימת המצעים השמורים של המשתמש (תפריט שנבנה בכל פעם מחדש)
+PROPOSAL_LIST_MENU = {
+    "body_text": "המצעים שלך (החדשים קודם). בחר מצע, או הקלד מילים מהשם, המשתתפים או התוכן כדי לחפש:",
+    "button_text": "בחר מצע",
+    "more_title": "מצעים קודמים ←",
+}
+PROPOSAL_SEARCH_MENU_BODY = "מצעים שנמצאו עבור \"{query}\":"
+NO_PROPOSALS_REPLY = "עדיין לא שמרת מצעים. אפשר ליצור אחד דרך \"מצע חדש\""
+PROPOSAL_SEARCH_EMPTY_REPLY = "לא נמצאו מצעים עבור \"{query}\". נסה מילים אחרות או הקלד 'סיום' כדי לסיים"
+PROPOSAL_NOT_FOUND_REPLY = "המצע לא נמצא. בחר מצע מהרשימה או הקלד 'סיום' כדי לסיים"
+PROPOSAL_SAVE_FAILED_REPLY = "שמירת המצע נכשלה, אנא נסה שוב מאוחר יותר"
+PROPOSAL_DETAILS = [
+    "📋 {name}",
+    "🗓️ נשמר: {created}",
+    "",
+    "👥 משתתפים: {participants}",
+    "📄 תוכן הדיון:",
+    "{content}",
+]
+
+# "תזכורת חדשה" - מועד שלא פוענח או שכבר עבר (המשתמש נשאר בשלב המועד)
+REMINDER_TIME_INVALID_REPLY = ("לא הבנתי את המועד. אפשר לכתוב למשל 25/12 09:00, 09:00, מחר 08:30 או בעוד 2 שעות "
+                               "(או 'סיום' כדי לבטל)")
+REMINDER_TIME_PAST_REPLY = "המועד הזה כבר עבר. מתי להזכיר?"
+REMINDER_SAVE_FAILED_REPLY = "שמירת התזכורת נכשלה, אנא נסה שוב מאוחר יותר"
+
+
+FLOWS = {
+    "proposal_for_discussion": {
+        "data": {"type": "proposal"},
+        "start": "proposal_choice",
+        "steps": {
+            "proposal_choice": {
+                "menu": {
+                    "body_text": "מה תרצה לעשות?",
+                    "options": [
+                        {"id": "proposal_new", "title": "מצע חדש"},
+                        {"id": "proposal_existing", "title": "מצע קיים"}
+                    ],
+                    "button_text": "בחר אפשרות"
+                },
+                "choices": {
+                    "proposal_new": {"next": "proposal_new_name"},
+                    "proposal_existing": {"action": "list_proposals"},
+                },
+                "invalid": "אנא בחר אחת מהאפשרויות או הקלד 'סיום' כדי לסיים",
+            },
+            "proposal_new_name": {
+                "prompt": "מה שם הדיון?",
+                "field": "name",
+                "next": "proposal_new_participants",
+            },
+            "proposal_new_participants": {
+                "prompt": "מי המשתתפים בדיון? (הקלד את שמות המשתתפים מופרדים בפסיקים)",
+                "field": "participants",
+                "next": "proposal_new_content",
+            },
+            "proposal_new_content": {
+                "prompt": "מה תוכן הדיון?",
+                "field": "content",
+                "next": None,
+            },
+            "proposal_existing_select": {
+                "action": "open_proposal",
+            },
+        },
+        "on_complete": "save_proposal",
+        "summary": [
+            "📋 סיכום מצע הדיון:",
+            "",
+            "📝 שם הדיון: {name}",
+            "👥 משתתפים: {participants}",
+            "📄 תוכן הדיון:",
+            "{content}",
+            "",
+            "✅ הפרטים נשמרו בהצלחה!",
+        ],
+    },
+    "new_reminder": {
+        "data": {"type": "reminder"},
+        "start": "reminder_text",
+        "steps": {
+            "reminder_text": {
+                "prompt": "על מה להזכיר לך?",
+                "field": "text",
+                "next": "reminder_time",
+            },
+            "reminder_time": {
+                "prompt": "מתי להזכיר? (למשל 25/12 09:00, מחר 08:30 או בעוד שעה)",
+                "field": "time",
+                "action": "schedule_reminder",
+            },
+        },
+        "summary": [
+            "⏰ סיכום התזכורת:",
+            "",
+            "📝 תזכורת: {text}",
+            "🕒 מועד: {time}",
+            "",
+            "✅ התזכורת נקלטה!",
+        ],
+    },
+    "control_and_monitoring": {
+        "reply": "בקרה ומעקב - עדיין בפיתוח",
+    },
+    "new_task": {
+        "data": {"type": "task"},
+        "start": "task_name",
+        "steps": {
+            "task_name": {
+                "prompt": "מה המשימה?",
+                "field": "name",
+                "next": "task_assignee",
+            },
+            "task_assignee": {
+                "prompt": "מי אחראי על המשימה?",
+                "field": "assignee",
+                "next": "task_due",
+            },
+            "task_due": {
+                "prompt": "מה תאריך היעד?",
+                "field": "due",
+                "next": None,
+            },
+        },
+        "summary": [
+            "📌 סיכום המשימה:",
+            "",
+            "📝 משימה: {name}",
+            "👤 אחראי: {assignee}",
+            "📅 תאריך יעד: {due}",
+            "",
+            "✅ המשימה נקלטה!",
+        ],
+    },
+}
@@ -0,0 +1,190 @@
+"""
+מנוע זרימות מבוסס טבלה (Table-Driven Flow Engine)
+מקמפל את הגדרות הזרימות (flow_definitions) פעם אחת לטבלת מעברים:
+dict של choice_id -> זרימה ו-dict של מצב -> שלב, כך שכל צעד בשיחה
+הוא חיפוש אחד ב-dict בלי תלות במספר הזרימות
+"""
+from typing import Dict, Iterable, Optional, Tuple
+
+from app.services.menus import MenuRegistry
+
+# תשובה לשלב: (response_text, next_message_payload)
+# next_message_payload הוא {"menu": Menu} - תפריט מקומפל לשליחה אחרי הטקסט
+Reply = Tuple[str, Optional[Dict]]
+
+
+class _SummaryValues(dict):
+    """ערכים לתבנית הסיכום - נתון שלא נאסף מוצג כ-missing"""
+    
+    def __init__(self, data: Dict, missing: str):
+        super().__init__(data)
+        self.missing = missing
+    
+    def __missing__(self, key):
+        return self.missing
+
+
+class Flow:
+    """זרימה מקומפלת"""
+    
+    __slots__ = ("name", "data", "start", "reply", "summary", "missing", "on_complete")
+    
+    def __init__(self, name: str, data: Dict, reply: Optional[Reply],
+                 summary: Optional[str], missing: str, on_complete: Optional[str] = None):
+        self.name = name
+        self.data = data
+        self.start: Optional["Step"] = None
+        self.reply = reply
+        self.summary = summary
+        self.missing = missing
+        # שם ה-hook שמקבל את הנתונים שנאספו בסיום הזרימה (למשל שמירת המצע)
+        self.on_complete = on_complete
+    
+    def render_summary(self, data: Dict) -> str:
+        """בונה את הודעת הסיכום מהנתונים שנאספו"""
+        if self.summary is None:
+            return ""
+        return self.summary.format_map(_SummaryValues(data, self.missing))
+
+
+class Transition:
+    """מעבר מבחירה בשלב בחירה: לשלב הבא, סיום הזרימה עם תשובה קבועה, או action"""
+    
+    __slots__ = ("next", "reply", "action")
+    
+    def __init__(self, next: Optional["Step"] = None, reply: Optional[Reply] = None,
+                 action: Optional[str] = None):
+        self.next = next
+        self.reply = reply
+        self.action = action
+
+
+class Step:
+    """שלב מקומפל - שלב קלט (field), שלב בחירה (choices) או שלב action"""
+    
+    __slots__ = ("state", "flow", "enter", "field", "next", "choices", "invalid", "action")
+    
+    def __init__(self, state: str, flow: Flow, enter: Reply):
+        self.state = state
+        self.flow = flow
+        # ההודעה שנשלחת בכניסה לשלב (מחושבת מראש)
+        self.enter = enter
+        self.field: Optional[str] = None
+        self.next: Optional["Step"] = None
+        self.choices: Optional[Dict[str, Transition]] = None
+        self.invalid: Optional[Reply] = None
+        # שלב שכל הודעה בו מטופלת בקוד (action) ולא נשמרת לשדה
+        self.action: Optional[str] = None
+
+
+class FlowTable:
+    """טבלת המעברים המקומפלת"""
+    
+    __slots__ = ("entries", "steps", "cancel_words", "cancelled", "unknown_choice", "idle")
+    
+    def __init__(self, entries: Dict[str, Flow], steps: Dict[str, Step],
+                 cancel_words: frozenset, cancelled: Reply, unknown_choice: Reply, idle: Reply):
+        self.entries = entries
+        self.steps = steps
+        self.cancel_words = cancel_words
+        self.cancelled = cancelled
+        self.unknown_choice = unknown_choice
+        self.idle = idle
+    
+    def is_cancel(self, message_text: str) -> bool:
+        """האם הטקסט הוא מילת ביטול"""
+        return message_text.strip().lower() in self.cancel_words
+
+
+def compile_flows(flows: Dict[str, Dict], states: Iterable[str], cancel_words: Iterable[str],
+                  cancelled: str, unknown_choice: str, idle: str,
+                  missing: str, menus: MenuRegistry, actions: Iterable[str] = (),
+                  hooks: Iterable[str] = ()) -> FlowTable:
+    """
+    מקמפל את הגדרות הזרימות לטבלת מעברים
+    
+    Args:
+        flows: choice_id -> הגדרת זרימה (ראה flow_definitions)
+        states: ערכי המצב המותרים (ערכי FlowState)
+        cancel_words: מילים שמבטלות את הזרימה
+        cancelled / unknown_choice / idle: תשובות קבועות
+        missing: ערך ברירת מחדל בסיכום לנתון שלא נאסף
+        menus: המאגר שבו נרשמים תפריטי השלבים (לפי שם המצב)
+        actions / hooks: שמות ה-actions וה-hooks של on_complete שמוגדרים בקוד
+    
+    Raises:
+        ValueError: אם ההגדרה מפנה למצב, action או hook לא קיים, למצב כפול, או שתפריט חורג ממגבלות WhatsApp
+    """
+    known_states = set(states)
+    known_actions = set(actions)
+    known_hooks = set(hooks)
+    entries: Dict[str, Flow] = {}
+    steps: Dict[str, Step] = {}
+    pending = []
+    
+    def check_action(flow_name: str, action: Optional[str]) -> Optional[str]:
+        if action is not None and action not in known_actions:
+            raise ValueError(f"Flow '{flow_name}': unknown action '{action}'")
+        return action
+    
+    for name, spec in flows.items():
+        reply = (spec["reply"], None) if "reply" in spec else None
+        summary = "\n".join(spec["summary"]) if "summary" in spec else None
+        on_complete = spec.get("on_complete")
+        if on_complete is not None and on_complete not in known_hooks:
+            raise ValueError(f"Flow '{name}': unknown on_complete hook '{on_complete}'")
+        flow = Flow(name, dict(spec.get("data", {})), reply, summary, missing, on_complete)
+        entries[name] = flow
+        
+        for state, step_spec in spec.get("steps", {}).items():
+            if state not in known_states:
+                raise ValueError(f"Flow '{name}': unknown state '{state}'")
+            if state in steps:
+                raise ValueError(f"Flow '{name}': state '{state}' is used by more than one step")
+            if "menu" in step_spec:
+                enter: Reply = ("", {"menu": menus.register(state, **step_spec["menu"])})
+            else:
+                enter = (step_spec.get("prompt", ""), None)
+            steps[state] = Step(state, flow, enter)
+            pending.append((name, steps[state], step_spec))
+        
+        if "start" in spec:
+            flow.start = steps.get(spec["start"])
+            if flow.start is None:
+                raise ValueError(f"Flow '{name}': start state '{spec['start']}' has no step")
+    
+    def resolve(flow_name: str, state: Optional[str]) -> Optional[Step]:
+        if state is None:
+            return None
+        step = steps.get(state)
+        if step is None or step.flow.name != flow_name:
+            raise ValueError(f"Flow '{flow_name}': next state '{state}' is not a step of this flow")
+        return step
+    
+    # שלב שני - חיבור המעברים אחרי שכל השלבים קיימים
+    for name, step, step_spec in pending:
+        if "choices" in step_spec:
+            step.choices = {
+                choice_id: Transition(
+                    next=resolve(name, choice.get("next")),
+                    reply=(choice["reply"], None) if "reply" in choice else None,
+                    action=check_action(name, choice.get("action")),
+                )
+                for choice_id, choice in step_spec["choices"].items()
+            }
+            step.invalid = (step_spec.get("invalid", unknown_choice), None)
+        elif "action" in step_spec:
+            step.action = check_action(name, step_spec["action"])
+            step.field = step_spec.get("field")
+        else:
+            step.field = step_spec["field"]
+            step.next = resolve(name, step_spec.get("next"))
+    
+    return FlowTable(
+        entries=entries,
+        steps=steps,
+        cancel_words=frozenset(word.lower() for word in cancel_words),
+        cancelled=(cancelled, None),
+        unknown_choice=(unknown_choice, None),
+        idle=(idle, None),
+    )
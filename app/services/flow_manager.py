@@ -2,9 +2,38 @@
 מנהל זרימת השיחה (Conversation Flow Manager)
 מנהל את התהליכים והמדינות של המשתמש לפי בחירותיו
 """
-from typing import Dict, Optional, Callable
+import logging
+import sqlite3
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
 from enum import Enum
 
+from app.services import flow_definitions
+from app.services.flow_engine import Flow, Reply, Step, compile_flows
+from app.services.menus import (
+    MAX_BODY_LENGTH, MAX_ROW_DESCRIPTION_LENGTH, MAX_ROW_TITLE_LENGTH, MenuRegistry, compile_menu,
+)
+from app.services.metrics import FLOW_TRANSITION_SECONDS
+from app.services.proposal_store import ProposalStore, create_proposal_store
+from app.services.reminders import ReminderScheduler, create_reminder_scheduler
+from app.services.state_backends import create_state_store
+from app.services.state_store import StateStore
+
+logger = logging.getLogger(__name__)
+
+# מספר המצעים בעמוד של "מצע קיים" (שורה אחת בתפריט שמורה ל"מצעים קודמים")
+PROPOSAL_PAGE_SIZE = 9
+# מזהי השורות בתפריט המצעים: מצע לפתיחה, או העמוד שלפני מזהה מסוים
+_PROPOSAL_ROW = "proposal:"
+_PROPOSAL_PAGE_ROW = "proposals_before:"
+
+
+def _clip(text: str, limit: int) -> str:
+    """מקצר טקסט למגבלת אורך של שדה בתפריט"""
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
 
 class FlowState(Enum):
     """מצבים שונים בזרימת השיחה"""
@@ -14,192 +43,266 @@ class FlowState(Enum):
     PROPOSAL_NEW_PARTICIPANTS = "proposal_new_participants"  # שאלת משתתפים
     PROPOSAL_NEW_CONTENT = "proposal_new_content"  # שאלת תוכן הדיון
     PROPOSAL_COMPLETE = "proposal_complete"  # סיום - הצגת סיכום
+    PROPOSAL_EXISTING_SELECT = "proposal_existing_select"  # בחירה/חיפוש במצעים השמורים
+    REMINDER_TEXT = "reminder_text"  # שאלת תוכן התזכורת
+    REMINDER_TIME = "reminder_time"  # שאלת מועד התזכורת
+    TASK_NAME = "task_name"  # שאלת תיאור המשימה
+    TASK_ASSIGNEE = "task_assignee"  # שאלת האחראי
+    TASK_DUE = "task_due"  # שאלת תאריך היעד
 
 
 class FlowManager:
     """מנהל את זרימת השיחה של המשתמש"""
     
-    def __init__(self):
-        # Dictionary: phone_number -> current_state
-        self.user_states: Dict[str, FlowState] = {}
-        # Dictionary: phone_number -> collected_data
-        self.user_data: Dict[str, Dict] = {}
+    def __init__(self, store: Optional[StateStore] = None, proposals: Optional[ProposalStore] = None,
+                 reminders: Optional[ReminderScheduler] = None):
+        # אחסון המצב והנתונים: phone_number -> (state, collected_data)
+        self.store: StateStore = store if store is not None else create_state_store()
+        # מצעים שהושלמו - נשמרים לצמיתות ומוצגים ב"מצע קיים"
+        self.proposals: ProposalStore = proposals if proposals is not None else create_proposal_store()
+        # תזכורות מתוזמנות - נשמרות בסיום "תזכורת חדשה" ונשלחות במועדן (ה-scheduler מופעל ב-startup)
+        self.reminders: ReminderScheduler = reminders if reminders is not None else create_reminder_scheduler()
+        # קוד שמטפל בבחירות/שלבים מסוג action ו-hooks של סיום זרימה (לפי שם ב-flow_definitions)
+        self.actions = {
+            "list_proposals": self._list_proposals,
+            "open_proposal": self._open_proposal,
+            "schedule_reminder": self._schedule_reminder,
+        }
+        self.hooks = {
+            "save_proposal": self._save_proposal,
+        }
+        # תפריטים מקומפלים (התפריט הראשי ותפריטי השלבים)
+        self.menus = MenuRegistry()
+        self.main_menu = self.menus.register("main", **flow_definitions.MAIN_MENU)
+        # טבלת המעברים - מקומפלת פעם אחת מהגדרות הזרימות
+        self.table = compile_flows(
+            flow_definitions.FLOWS,
+            states=(state.value for state in FlowState),
+            cancel_words=flow_definitions.CANCEL_WORDS,
+            cancelled=flow_definitions.CANCELLED_REPLY,
+            unknown_choice=flow_definitions.UNKNOWN_CHOICE_REPLY,
+            idle=flow_definitions.IDLE_REPLY,
+            missing=flow_definitions.MISSING_VALUE,
+            menus=self.menus,
+            actions=self.actions,
+            hooks=self.hooks,
+        )
+        self._proposal_details = "\n".join(flow_definitions.PROPOSAL_DETAILS)
     
     def reset_user_flow(self, phone_number: str):
-        """מאפס את הזרימה של משתמש"""
-        self.user_states[phone_number] = FlowState.IDLE
-        self.user_data[phone_number] = {}
+        """מאפס את הזרימה של משתמש - מחיקת הרשומה (היעדר רשומה = IDLE)"""
+        self.store.delete(phone_number)
+    
+    def get_session(self, phone_number: str) -> tuple[FlowState, Dict]:
+        """מחזיר את המצב והנתונים של המשתמש בקריאה אחת"""
+        record = self.store.get(phone_number)
+        if record is None:
+            return FlowState.IDLE, {}
+        return FlowState(record[0]), record[1]
     
     def get_user_state(self, phone_number: str) -> FlowState:
         """מחזיר את המצב הנוכחי של המשתמש"""
-        return self.user_states.get(phone_number, FlowState.IDLE)
+        return self.get_session(phone_number)[0]
     
-    def set_user_state(self, phone_number: str, state: FlowState):
-        """מגדיר מצב חדש למשתמש"""
-        self.user_states[phone_number] = state
-        print(f"DEBUG flow_manager: Set state for {phone_number} to {state}")
+    def set_user_state(self, phone_number: str, state: FlowState, data: Optional[Dict] = None):
+        """מגדיר מצב חדש למשתמש (ואופציונלית מחליף את הנתונים שנאספו)"""
+        if data is None:
+            data = self.get_user_data(phone_number)
+        self.store.set(phone_number, state.value, data)
+        logger.debug("Set state for %s to %s", phone_number, state)
     
     def get_user_data(self, phone_number: str) -> Dict:
         """מחזיר את הנתונים שנאספו מהמשתמש"""
-        return self.user_data.get(phone_number, {})
+        return self.get_session(phone_number)[1]
     
     def set_user_data(self, phone_number: str, key: str, value: str):
         """שומר נתון של המשתמש"""
-        if phone_number not in self.user_data:
-            self.user_data[phone_number] = {}
-        self.user_data[phone_number][key] = value
+        state, data = self.get_session(phone_number)
+        data[key] = value
+        self.store.set(phone_number, state.value, data)
     
-    def handle_initial_choice(self, phone_number: str, choice_id: str) -> tuple[str, Optional[Dict]]:
-        """
-        מטפל בבחירה הראשונית (מצע לדיון, תזכורת חדשה, וכו')
-        Returns: (response_text, next_message_payload)
-        """
-        if choice_id == "proposal_for_discussion":
-            # התחלת flow של מצע לדיון
-            self.set_user_state(phone_number, FlowState.PROPOSAL_CHOICE)
-            self.user_data[phone_number] = {"type": "proposal"}
-            
-            # שליחת הודעת בחירה בין חדש/קיים
-            from app.services.whatsapp_service import whatsapp_service
-            
-            whatsapp_service.send_interactive_message(
-                phone_number=phone_number,
-                body_text="מה תרצה לעשות?",
-                options=[
-                    {"id": "proposal_new", "title": "מצע חדש"},
-                    {"id": "proposal_existing", "title": "מצע קיים"}
-                ],
-                button_text="בחר אפשרות"
+    def _enter(self, phone_number: str, step: Step, data: Dict) -> Reply:
+        """מעביר את המשתמש לשלב ומחזיר את ההודעה המחושבת מראש של השלב"""
+        self.store.set(phone_number, step.state, data)
+        logger.debug("Set state for %s to %s", phone_number, step.state)
+        return step.enter
+    
+    def _complete(self, phone_number: str, flow: Flow, data: Dict) -> Reply:
+        """מסיים זרימה: מעביר את הנתונים ל-hook (אם הוגדר), בונה את הסיכום ומאפס את המשתמש"""
+        self.reset_user_flow(phone_number)
+        if flow.on_complete is not None:
+            failed = self.hooks[flow.on_complete](phone_number, data)
+            if failed is not None:
+                return failed
+        return flow.render_summary(data), None
+    
+    # --- מצעים ---
+    
+    def _save_proposal(self, phone_number: str, data: Dict) -> Optional[Reply]:
+        """hook בסיום "מצע חדש" - שומר את המצע. Returns: תשובת שגיאה אם השמירה נכשלה"""
+        try:
+            proposal_id = self.proposals.save(
+                phone_number,
+                data.get("name", ""),
+                data.get("participants", ""),
+                data.get("content", ""),
             )
-            
-            return "", None  # ההודעה נשלחה כבר, אין צורך בתגובה נוספת
-            
-        elif choice_id == "new_reminder":
-            return "תזכורת חדשה - עדיין בפיתוח", None
-        elif choice_id == "control_and_monitoring":
-            return "בקרה ומעקב - עדיין בפיתוח", None
-        elif choice_id == "new_task":
-            return "משימה חדשה - עדיין בפיתוח", None
-        else:
-            return "אני לא מבין את הבחירה שלך", None
+        except sqlite3.Error:
+            logger.exception("Failed to save proposal for %s", phone_number)
+            return flow_definitions.PROPOSAL_SAVE_FAILED_REPLY, None
+        logger.debug("Saved proposal %s for %s", proposal_id, phone_number)
+        return None
     
-    def handle_proposal_choice(self, phone_number: str, choice_id: str, message_text: str) -> tuple[str, Optional[Dict]]:
-        """
-        מטפל בבחירה בין מצע חדש/קיים
-        """
-        if choice_id == "proposal_new":
-            # התחלת תהליך מצע חדש
-            self.set_user_state(phone_number, FlowState.PROPOSAL_NEW_NAME)
-            return "מה שם הדיון?", None
-        elif choice_id == "proposal_existing":
-            # מצע קיים - עדיין לא מיושם
-            self.reset_user_flow(phone_number)
-            return "מצע קיים - עדיין בפיתוח", None
-        elif message_text.lower() in ["סיים", "סיום", "ביטול", "exit", "cancel"]:
-            # המשתמש רוצה לסיים
+    def _local_time(self, timestamp: float) -> datetime:
+        """זמן שמוצג למשתמש - באזור הזמן של התזכורות (REMINDER_TIMEZONE) ולא של השרת"""
+        return datetime.fromtimestamp(timestamp, self.reminders.timezone)
+    
+    def _proposal_menu(self, proposals: List[Dict], body_text: str, has_more: bool) -> Reply:
+        """תפריט עם מצע בכל שורה (ושורת "מצעים קודמים" כשיש עוד)"""
+        spec = flow_definitions.PROPOSAL_LIST_MENU
+        options = []
+        for proposal in proposals:
+            created = self._local_time(proposal["created_at"]).strftime("%d/%m/%Y")
+            options.append({
+                "id": f"{_PROPOSAL_ROW}{proposal['id']}",
+                "title": _clip(proposal["name"], MAX_ROW_TITLE_LENGTH) or str(proposal["id"]),
+                "description": _clip(f"{created} · {proposal['participants']}", MAX_ROW_DESCRIPTION_LENGTH),
+            })
+        if has_more:
+            options.append({"id": f"{_PROPOSAL_PAGE_ROW}{proposals[-1]['id']}", "title": spec["more_title"]})
+        menu = compile_menu(FlowState.PROPOSAL_EXISTING_SELECT.value, _clip(body_text, MAX_BODY_LENGTH), options,
+                            spec["button_text"])
+        return "", {"menu": menu}
+    
+    def _proposal_page(self, phone_number: str, data: Dict, before_id: Optional[int] = None) -> Reply:
+        """עמוד של המצעים השמורים של המשתמש, החדשים קודם"""
+        proposals = self.proposals.list_for(phone_number, PROPOSAL_PAGE_SIZE + 1, before_id)
+        if not proposals:
             self.reset_user_flow(phone_number)
-            return "התהליך בוטל. תודה!", None
-        else:
-            return "אנא בחר אחת מהאפשרויות או הקלד 'סיום' כדי לסיים", None
+            return flow_definitions.NO_PROPOSALS_REPLY, None
+        self.store.set(phone_number, FlowState.PROPOSAL_EXISTING_SELECT.value, data)
+        return self._proposal_menu(proposals[:PROPOSAL_PAGE_SIZE], flow_definitions.PROPOSAL_LIST_MENU["body_text"],
+                                   has_more=len(proposals) > PROPOSAL_PAGE_SIZE)
     
-    def handle_proposal_name(self, phone_number: str, message_text: str) -> tuple[str, Optional[Dict]]:
+    def _list_proposals(self, phone_number: str, step: Step, data: Dict,
+                        choice_id: Optional[str], message_text: str) -> Reply:
+        """action של "מצע קיים" - מציג את המצעים השמורים של המשתמש"""
+        return self._proposal_page(phone_number, data)
+    
+    def _open_proposal(self, phone_number: str, step: Step, data: Dict,
+                       choice_id: Optional[str], message_text: str) -> Reply:
         """
-        מטפל בשם הדיון
+        action של שלב בחירת המצע: בחירה מהתפריט פותחת את המצע (ומסיימת את
+        הזרימה), "מצעים קודמים" מציג את העמוד הבא, וטקסט חופשי מחפש במצעים
+        של המשתמש
         """
-        if message_text.lower() in ["סיים", "סיום", "ביטול", "exit", "cancel"]:
+        if choice_id and choice_id.startswith(_PROPOSAL_PAGE_ROW):
+            before_id = choice_id[len(_PROPOSAL_PAGE_ROW):]
+            return self._proposal_page(phone_number, data, int(before_id) if before_id.isdigit() else None)
+        if choice_id:
+            proposal_id = choice_id[len(_PROPOSAL_ROW):] if choice_id.startswith(_PROPOSAL_ROW) else ""
+            proposal = self.proposals.get(int(proposal_id), phone_number) if proposal_id.isdigit() else None
+            if proposal is None:
+                return flow_definitions.PROPOSAL_NOT_FOUND_REPLY, None
             self.reset_user_flow(phone_number)
-            return "התהליך בוטל. תודה!", None
+            created = self._local_time(proposal["created_at"]).strftime("%d/%m/%Y %H:%M")
+            return self._proposal_details.format(created=created, **{
+                key: proposal[key] or flow_definitions.MISSING_VALUE for key in ("name", "participants", "content")
+            }), None
         
-        # שמירת שם הדיון
-        self.set_user_data(phone_number, "name", message_text)
-        self.set_user_state(phone_number, FlowState.PROPOSAL_NEW_PARTICIPANTS)
-        return "מי המשתתפים בדיון? (הקלד את שמות המשתתפים מופרדים בפסיקים)", None
+        query = " ".join(message_text.split())
+        if not query:
+            return flow_definitions.PROPOSAL_NOT_FOUND_REPLY, None
+        proposals = self.proposals.find(phone_number, text=query, limit=PROPOSAL_PAGE_SIZE)
+        if not proposals:
+            return flow_definitions.PROPOSAL_SEARCH_EMPTY_REPLY.format(query=query), None
+        return self._proposal_menu(proposals, flow_definitions.PROPOSAL_SEARCH_MENU_BODY.format(query=query),
+                                   has_more=False)
+    
+    # --- תזכורות ---
     
-    def handle_proposal_participants(self, phone_number: str, message_text: str) -> tuple[str, Optional[Dict]]:
+    def _schedule_reminder(self, phone_number: str, step: Step, data: Dict,
+                           choice_id: Optional[str], message_text: str) -> Reply:
         """
-        מטפל ברשימת המשתתפים
+        action של שלב מועד התזכורת: מועד לא מובן או שעבר - נשארים בשלב;
+        אחרת התזכורת נשמרת ומתוזמנת והזרימה מסתיימת בסיכום
         """
-        if message_text.lower() in ["סיים", "סיום", "ביטול", "exit", "cancel"]:
+        due = self.reminders.parse_time(message_text)
+        if due is None:
+            return flow_definitions.REMINDER_TIME_INVALID_REPLY, None
+        if due <= self.reminders.now():
+            return flow_definitions.REMINDER_TIME_PAST_REPLY, None
+        data[step.field] = due.strftime("%d/%m/%Y %H:%M")
+        try:
+            reminder_id = self.reminders.schedule(phone_number, data.get("text", ""), due)
+        except sqlite3.Error:
+            logger.exception("Failed to save reminder for %s", phone_number)
             self.reset_user_flow(phone_number)
-            return "התהליך בוטל. תודה!", None
-        
-        # שמירת המשתתפים
-        self.set_user_data(phone_number, "participants", message_text)
-        self.set_user_state(phone_number, FlowState.PROPOSAL_NEW_CONTENT)
-        return "מה תוכן הדיון?", None
+            return flow_definitions.REMINDER_SAVE_FAILED_REPLY, None
+        logger.debug("Scheduled reminder %s for %s at %s", reminder_id, phone_number, due.isoformat())
+        return self._complete(phone_number, step.flow, data)
     
-    def handle_proposal_content(self, phone_number: str, message_text: str) -> tuple[str, Optional[Dict]]:
+    def handle_initial_choice(self, phone_number: str, choice_id: str) -> Reply:
         """
-        מטפל בתוכן הדיון - השלב האחרון לפני סיכום
+        מטפל בבחירה הראשונית (מצע לדיון, תזכורת חדשה, וכו')
+        Returns: (response_text, next_message_payload)
         """
-        if message_text.lower() in ["סיים", "סיום", "ביטול", "exit", "cancel"]:
-            self.reset_user_flow(phone_number)
-            return "התהליך בוטל. תודה!", None
+        flow = self.table.entries.get(choice_id)
+        if flow is None:
+            return self.table.unknown_choice
+        if flow.start is None:
+            return flow.reply or self.table.unknown_choice
+        return self._enter(phone_number, flow.start, dict(flow.data))
+    
+    def handle_step(self, phone_number: str, step: Step, data: Dict,
+                    choice_id: Optional[str], message_text: str) -> Reply:
+        """מטפל בהודעה בשלב הנוכחי של הזרימה"""
+        if step.choices is not None:
+            transition = step.choices.get(choice_id) if choice_id else None
+            if transition is None:
+                if self.table.is_cancel(message_text):
+                    self.reset_user_flow(phone_number)
+                    return self.table.cancelled
+                return step.invalid
+            if transition.next is not None:
+                return self._enter(phone_number, transition.next, data)
+            if transition.action is not None:
+                return self.actions[transition.action](phone_number, step, data, choice_id, message_text)
+            if transition.reply is not None:
+                self.reset_user_flow(phone_number)
+                return transition.reply
+            return self._complete(phone_number, step.flow, data)
         
-        # שמירת התוכן
-        self.set_user_data(phone_number, "content", message_text)
-        self.set_user_state(phone_number, FlowState.PROPOSAL_COMPLETE)
+        if self.table.is_cancel(message_text):
+            self.reset_user_flow(phone_number)
+            return self.table.cancelled
         
-        # בניית סיכום
-        data = self.get_user_data(phone_number)
-        summary = self._build_proposal_summary(data)
+        if step.action is not None:
+            return self.actions[step.action](phone_number, step, data, choice_id, message_text)
         
-        # איפוס הזרימה
-        self.reset_user_flow(phone_number)
-        
-        return summary, None
-    
-    def _build_proposal_summary(self, data: Dict) -> str:
-        """בונה סיכום של מצע הדיון"""
-        summary_lines = [
-            "📋 סיכום מצע הדיון:",
-            "",
-            f"📝 שם הדיון: {data.get('name', 'לא צוין')}",
-            f"👥 משתתפים: {data.get('participants', 'לא צוין')}",
-            f"📄 תוכן הדיון:",
-            data.get('content', 'לא צוין'),
-            "",
-            "✅ הפרטים נשמרו בהצלחה!"
-        ]
-        return "\n".join(summary_lines)
-    
-    def process_message(self, phone_number: str, choice_id: Optional[str], message_text: str) -> tuple[str, Optional[Dict]]:
+        data[step.field] = message_text
+        if step.next is not None:
+            return self._enter(phone_number, step.next, data)
+        return self._complete(phone_number, step.flow, data)
+    
+    def process_message(self, phone_number: str, choice_id: Optional[str], message_text: str) -> Reply:
         """
         עיבוד הודעה מהמשתמש - נקודת הכניסה הראשית
         Returns: (response_text, next_message_payload)
         """
-        current_state = self.get_user_state(phone_number)
-        print(f"DEBUG flow_manager: Processing message - phone: {phone_number}, state: {current_state}, choice_id: {choice_id}, text: '{message_text}'")
+        started = time.perf_counter()
+        record = self.store.get(phone_number)
+        step = self.table.steps.get(record[0]) if record is not None else None
+        state = step.state if step else FlowState.IDLE.value
+        logger.debug("Processing message - phone: %s, state: %s, choice_id: %s, text: '%s'",
+                     phone_number, state, choice_id, message_text)
         
-        # אם זו בחירה ראשונית (choice_id קיים והמשתמש במצב IDLE)
-        if choice_id and current_state == FlowState.IDLE:
-            print(f"DEBUG flow_manager: Handling initial choice: {choice_id}")
-            return self.handle_initial_choice(phone_number, choice_id)
-        
-        # טיפול לפי המצב הנוכחי
-        if current_state == FlowState.PROPOSAL_CHOICE:
-            print(f"DEBUG flow_manager: Handling PROPOSAL_CHOICE state")
-            return self.handle_proposal_choice(phone_number, choice_id or "", message_text)
-        elif current_state == FlowState.PROPOSAL_NEW_NAME:
-            print(f"DEBUG flow_manager: Handling PROPOSAL_NEW_NAME state")
-            return self.handle_proposal_name(phone_number, message_text)
-        elif current_state == FlowState.PROPOSAL_NEW_PARTICIPANTS:
-            print(f"DEBUG flow_manager: Handling PROPOSAL_NEW_PARTICIPANTS state")
-            return self.handle_proposal_participants(phone_number, message_text)
-        elif current_state == FlowState.PROPOSAL_NEW_CONTENT:
-            print(f"DEBUG flow_manager: Handling PROPOSAL_NEW_CONTENT state")
-            return self.handle_proposal_content(phone_number, message_text)
+        if step is not None:
+            reply = self.handle_step(phone_number, step, record[1], choice_id, message_text)
+        elif choice_id:
+            # מצב IDLE (או לא מזוהה) - choice_id הוא בחירה מהתפריט הראשי
+            reply = self.handle_initial_choice(phone_number, choice_id)
         else:
-            # מצב IDLE או לא מזוהה - אם יש choice_id, נטפל בו
-            if choice_id:
-                print(f"DEBUG flow_manager: State is {current_state}, but choice_id provided, handling as initial choice")
-                return self.handle_initial_choice(phone_number, choice_id)
-            else:
-                print(f"DEBUG flow_manager: State is {current_state}, no choice_id, sending initial message")
-                # אם המשתמש במצב לא מזוהה, נשלח לו את הרשימה הראשונית
-                return "אנא בחר אחת מהאפשרויות", None
-
-
-# יצירת instance גלובלי
-flow_manager = FlowManager()
-
+            reply = self.table.idle
+        FLOW_TRANSITION_SECONDS.observe(time.perf_counter() - started, state)
+        return reply
@@ -0,0 +1,148 @@
+"""
+מאגר תפריטים (Menu Registry)
+תפריטי Interactive List נבדקים פעם אחת מול המגבלות של WhatsApp ונשמרים
+כ-JSON bytes מוכן - בזמן שליחה רק מספר הנמען מוכנס לתוך ה-bytes
+"""
+from typing import Dict, List, Optional
+
+from app.serialization import dumps
+
+# מגבלות WhatsApp Business API ל-Interactive List Message
+MAX_ROWS = 10
+MAX_BODY_LENGTH = 1024
+MAX_BUTTON_LENGTH = 20
+MAX_SECTION_TITLE_LENGTH = 24
+MAX_ROW_ID_LENGTH = 200
+MAX_ROW_TITLE_LENGTH = 24
+MAX_ROW_DESCRIPTION_LENGTH = 72
+
+# שדה "to" הוא השדה היחיד שמשתנה בין נמענים - נשמר כמקום ריק בתבנית
+_RECIPIENT_MARKER = "\x00recipient\x00"
+
+
+def _check_length(menu_name: str, field: str, value: str, limit: int):
+    """מוודא ששדה טקסט לא ריק ולא חורג מהמגבלה"""
+    if not value:
+        raise ValueError(f"Menu '{menu_name}': {field} is empty")
+    if len(value) > limit:
+        raise ValueError(f"Menu '{menu_name}': {field} '{value}' is longer than {limit} characters")
+
+
+class Menu:
+    """תפריט מקומפל - JSON bytes לפני ואחרי מספר הנמען"""
+    
+    __slots__ = ("name", "option_ids", "_prefix", "_suffix")
+    
+    def __init__(self, name: str, payload: dict):
+        self.name = name
+        rows = payload["interactive"]["action"]["sections"][0]["rows"]
+        self.option_ids = frozenset(row["id"] for row in rows)
+        encoded = dumps(payload)
+        marker = dumps(_RECIPIENT_MARKER)
+        self._prefix, self._suffix = encoded.split(marker)
+    
+    def render(self, phone_number: str) -> bytes:
+        """מחזיר את גוף הבקשה המוכן לנמען"""
+        return self._prefix + dumps(phone_number) + self._suffix
+
+
+def build_list_payload(phone_number: str, body_text: str, options: List[Dict],
+                       button_text: str, section_title: str = "אפשרויות") -> dict:
+    """
+    בונה payload של Interactive List Message (פורמט WhatsApp Business API)
+    
+    Args:
+        options: רשימת dict עם "id", "title" ו-"description" אופציונלי
+    """
+    rows = []
+    for option in options:
+        row = {
+            "id": option["id"],
+            "title": option["title"]
+        }
+        # הוספת description אם קיים
+        if "description" in option:
+            row["description"] = option["description"]
+        rows.append(row)
+    
+    return {
+        "messaging_product": "whatsapp",
+        "to": phone_number,
+        "type": "interactive",
+        "interactive": {
+            "type": "list",
+            "body": {
+                "text": body_text
+            },
+            "action": {
+                "button": button_text,
+                "sections": [
+                    {
+                        "title": section_title,
+                        "rows": rows
+                    }
+                ]
+            }
+        }
+    }
+
+
+def compile_menu(name: str, body_text: str, options: List[Dict],
+                 button_text: str = "בחר אפשרות", section_title: str = "אפשרויות") -> Menu:
+    """
+    בודק תפריט מול מגבלות WhatsApp ומקמפל אותו (בלי לרשום אותו - לתפריטים
+    שנבנים לפי נתוני המשתמש, כמו רשימת המצעים שלו)
+    
+    Raises:
+        ValueError: אם התפריט חורג מהמגבלות
+    """
+    _check_length(name, "body", body_text, MAX_BODY_LENGTH)
+    _check_length(name, "button", button_text, MAX_BUTTON_LENGTH)
+    _check_length(name, "section title", section_title, MAX_SECTION_TITLE_LENGTH)
+    if not options or len(options) > MAX_ROWS:
+        raise ValueError(f"Menu '{name}': must have 1-{MAX_ROWS} options, got {len(options)}")
+    
+    seen_ids = set()
+    for option in options:
+        _check_length(name, "option id", option.get("id", ""), MAX_ROW_ID_LENGTH)
+        _check_length(name, "option title", option.get("title", ""), MAX_ROW_TITLE_LENGTH)
+        if "description" in option:
+            _check_length(name, "option description", option["description"], MAX_ROW_DESCRIPTION_LENGTH)
+        if option["id"] in seen_ids:
+            raise ValueError(f"Menu '{name}': duplicate option id '{option['id']}'")
+        seen_ids.add(option["id"])
+    
+    payload = build_list_payload(_RECIPIENT_MARKER, body_text, options, button_text, section_title)
+    return Menu(name, payload)
+
+
+class MenuRegistry:
+    """מאגר התפריטים לפי שם"""
+    
+    def __init__(self):
+        self._menus: Dict[str, Menu] = {}
+    
+    def register(self, name: str, body_text: str, options: List[Dict],
+                 button_text: str = "בחר אפשרות", section_title: str = "אפשרויות") -> Menu:
+        """
+        בודק את התפריט מול מגבלות WhatsApp ושומר אותו מקומפל
+        
+        Raises:
+            ValueError: אם התפריט חורג מהמגבלות או שהשם כבר קיים
+        """
+        if name in self._menus:
+            raise ValueError(f"Menu '{name}' is already registered")
+        menu = compile_menu(name, body_text, options, button_text, section_title)
+        self._menus[name] = menu
+        return menu
+    
+    def get(self, name: str) -> Optional[Menu]:
+        """מחזיר תפריט לפי שם (או None)"""
+        return self._menus.get(name)
+    
+    def __contains__(self, name: str) -> bool:
+        return name in self._menus
+    
+    def names(self) -> List[str]:
+        """שמות כל התפריטים הרשומים"""
+        return list(self._menus)
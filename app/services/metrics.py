@@ -0,0 +1,371 @@
+"""
+מדדים בפורמט Prometheus (Metrics)
+מונים והיסטוגרמות בזיכרון של כל worker - עדכון הוא פעולת dict/רשימה אחת,
+בלי נעילות ובלי תלות חיצונית. כשהשרת רץ עם כמה workers, כל worker כותב
+snapshot של המדדים שלו לקובץ בתיקייה משותפת, ו-/metrics (שיכול להגיע לכל
+worker) מאחד את כל הקבצים לתשובה אחת
+"""
+import asyncio
+import bisect
+import glob
+import logging
+import math
+import os
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from app.config import env_float, env_str
+from app.serialization import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+LabelValues = Tuple[str, ...]
+
+
+def log_linear_buckets(low: float, high: float, per_octave: int = 2) -> Tuple[float, ...]:
+    """
+    גבולות דליים בסגנון HDR: per_octave דליים לכל הכפלה של הערך,
+    כך שהשגיאה היחסית קבועה לאורך כל הטווח (מיקרו-שניות עד עשרות שניות)
+    """
+    count = int(math.ceil(math.log2(high / low) * per_octave))
+    return tuple(float(f"{low * 2 ** (i / per_octave):.3g}") for i in range(count + 1))
+
+
+# 100µs עד ~60s, שני דליים לכל הכפלה (~40 דליים, שגיאה יחסית של עד ~41%)
+LATENCY_BUCKETS = log_linear_buckets(0.0001, 60.0)
+
+
+class Counter:
+    """מונה מצטבר לכל צירוף ערכי labels"""
+    
+    kind = "counter"
+    
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        # Dictionary: label values -> value (מונה בלי labels מתחיל מ-0 כדי שיופיע מיד)
+        self.values: Dict[LabelValues, float] = {} if self.labels else {(): 0}
+    
+    def inc(self, *label_values: str, amount: float = 1):
+        values = self.values
+        values[label_values] = values.get(label_values, 0) + amount
+    
+    def snapshot(self) -> list:
+        return [[list(labels), value] for labels, value in self.values.items()]
+
+
+class Histogram:
+    """
+    היסטוגרמה עם דליים קבועים לכל צירוף labels
+    כל סדרה היא רשימה אחת: מונה לכל דלי, דלי עודף (+Inf) ובסוף סכום הערכים
+    """
+    
+    kind = "histogram"
+    
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = buckets
+        self.series: Dict[LabelValues, list] = {}
+    
+    def observe(self, value: float, *label_values: str):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+    
+    def snapshot(self) -> list:
+        return [[list(labels), list(series)] for labels, series in self.series.items()]
+
+
+class Gauge:
+    """
+    ערך רגעי שנאסף בזמן ה-scrape דרך collect() -> {label values: value}
+    shared: הערך זהה בכל ה-workers (למשל ספירה מ-backend משותף) - נאסף רק
+    ב-worker שעונה ל-scrape ולא מסוכם בין ה-workers
+    """
+    
+    kind = "gauge"
+    
+    def __init__(self, name: str, help_text: str, labels: Iterable[str],
+                 collect: Callable[[], Dict[LabelValues, float]], shared: bool = False):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.collect = collect
+        self.shared = shared
+    
+    def snapshot(self) -> list:
+        try:
+            values = self.collect()
+        except Exception as e:
+            logger.warning("Failed to collect gauge %s: %s", self.name, e)
+            return []
+        return [[list(labels), value] for labels, value in values.items()]
+
+
+def pid_alive(pid: int) -> bool:
+    """האם יש תהליך חי עם ה-pid הזה (באותו host)"""
+    if os.name == "nt":  # ב-Windows os.kill(pid, 0) שולח CTRL_C - מניחים שהתהליך חי
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Iterable[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class MetricsRegistry:
+    """
+    רישום המדדים של התהליך
+    
+    directory: תיקייה משותפת ל-workers (None = מדדי התהליך בלבד). כל worker
+    כותב אליה metrics-<pid>.json כל flush_interval שניות; ב-scrape ה-worker
+    כותב את שלו ומסכם את כל הקבצים. מונים של worker שמת נשארים בסיכום (כדי
+    שהמונים לא ירדו), אבל ה-gauges שלו לא - לכן את התיקייה מנקים בכל deploy
+    """
+    
+    def __init__(self, directory: Optional[str] = None, flush_interval: float = 5.0):
+        self.directory = directory or None
+        self.flush_interval = flush_interval
+        self._metrics: Dict[str, object] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        self.pid = os.getpid()
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+    
+    def _register(self, metric):
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+    
+    def counter(self, name: str, help_text: str, labels: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(name, help_text, labels))
+    
+    def histogram(self, name: str, help_text: str, labels: Iterable[str] = (),
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, labels, buckets))
+    
+    def gauge(self, name: str, help_text: str, labels: Iterable[str],
+              collect: Callable[[], Dict[LabelValues, float]], shared: bool = False) -> Gauge:
+        """מחליף gauge קיים באותו שם (ה-collect נקשר לשירותים של התהליך)"""
+        gauge = Gauge(name, help_text, labels, collect, shared)
+        self._metrics[name] = gauge
+        return gauge
+    
+    # --- snapshots ---
+    
+    def snapshot(self, include_shared: bool = False, base: Optional[dict] = None) -> dict:
+        """
+        מצב כל המדדים של התהליך: {name: [[label values, value], ...]}
+        base: מונים והיסטוגרמות שכבר צולמו על ה-event loop (snapshot_counters) -
+        נאספים רק ה-gauges, כך שאפשר לקרוא לזה מ-thread אחר
+        """
+        metrics = dict(base["metrics"]) if base is not None else {}
+        for name, metric in self._metrics.items():
+            if isinstance(metric, Gauge):
+                if metric.shared and not include_shared:
+                    continue
+            elif base is not None:
+                continue
+            metrics[name] = metric.snapshot()
+        return {"pid": self.pid, "written_at": time.time(), "metrics": metrics}
+    
+    def snapshot_counters(self) -> dict:
+        """
+        העתק של המונים וההיסטוגרמות בלבד. הם מתעדכנים בלי נעילה מה-event loop,
+        לכן מצלמים אותם שם - ואת השאר (gauges, קבצים, עיצוב) אפשר לעשות ב-thread
+        """
+        metrics = {name: metric.snapshot() for name, metric in list(self._metrics.items())
+                   if not isinstance(metric, Gauge)}
+        return {"pid": self.pid, "written_at": time.time(), "metrics": metrics}
+    
+    def _path(self, pid: int) -> str:
+        return os.path.join(self.directory, f"metrics-{pid}.json")
+    
+    def flush(self, base: Optional[dict] = None):
+        """כותב את ה-snapshot של התהליך לקובץ שלו (החלפה אטומית)"""
+        if not self.directory:
+            return
+        path = self._path(self.pid)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(dumps(self.snapshot(base=base)))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Failed to write metrics snapshot %s: %s", path, e)
+    
+    def _read_peers(self) -> List[dict]:
+        """snapshots של שאר ה-workers (קובץ פגום או שנמחק באמצע מדולג)"""
+        peers = []
+        own_path = self._path(self.pid)
+        for path in glob.glob(os.path.join(self.directory, "metrics-*.json")):
+            if path == own_path:
+                continue
+            try:
+                with open(path, "rb") as f:
+                    peers.append(loads(f.read()))
+            except (OSError, ValueError):
+                continue
+        return peers
+    
+    async def start(self):
+        """מפעיל כתיבה תקופתית של ה-snapshot (רק כשיש תיקייה משותפת)"""
+        if not self.directory or self._flusher is not None:
+            return
+        self.pid = os.getpid()
+        self.flush()
+        self._flusher = asyncio.create_task(self._run_flusher(), name="metrics-flusher")
+    
+    async def stop(self):
+        """עוצר את הכתיבה התקופתית וכותב snapshot אחרון"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        self.flush()
+    
+    async def _run_flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+    
+    # --- איחוד ותצוגה ---
+    
+    def _merge(self, base: Optional[dict] = None) -> Dict[str, Dict[LabelValues, object]]:
+        """מסכם את ה-snapshot של התהליך עם של שאר ה-workers"""
+        own = self.snapshot(include_shared=True, base=base)
+        snapshots = [own]
+        if self.directory:
+            self.flush(base)
+            snapshots += self._read_peers()
+        
+        merged: Dict[str, Dict[LabelValues, object]] = {name: {} for name in self._metrics}
+        for snapshot in snapshots:
+            is_own = snapshot is own
+            alive = is_own or pid_alive(snapshot.get("pid", 0))
+            for name, series_list in snapshot.get("metrics", {}).items():
+                metric = self._metrics.get(name)
+                if metric is None:
+                    continue
+                if isinstance(metric, Gauge) and not alive:
+                    continue
+                series = merged[name]
+                for labels, value in series_list:
+                    key = tuple(labels)
+                    if isinstance(metric, Histogram):
+                        current = series.get(key)
+                        if current is None or len(current) != len(value):
+                            series[key] = list(value)
+                        else:
+                            series[key] = [a + b for a, b in zip(current, value)]
+                    else:
+                        series[key] = series.get(key, 0) + value
+        return merged
+    
+    def render(self, base: Optional[dict] = None) -> str:
+        """
+        כל המדדים (מאוחדים מכל ה-workers) בפורמט הטקסט של Prometheus
+        בלי base - רק מה-event loop (המונים נקראים ישירות); עם base - מכל thread
+        """
+        merged = self._merge(base)
+        lines = []
+        for name, metric in self._metrics.items():
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for labels, value in sorted(merged[name].items()):
+                if isinstance(metric, Histogram):
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets + (math.inf,), value):
+                        cumulative += count
+                        le = 'le="' + _format_value(bound) + '"'
+                        lines.append(f"{name}_bucket{_format_labels(metric.labels, labels, le)} {cumulative}")
+                    label_text = _format_labels(metric.labels, labels)
+                    lines.append(f"{name}_sum{label_text} {_format_value(value[-1])}")
+                    lines.append(f"{name}_count{label_text} {cumulative}")
+                else:
+                    lines.append(f"{name}{_format_labels(metric.labels, labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+    
+    async def render_async(self) -> str:
+        """
+        render מה-event loop בלי לחסום אותו: המונים מצולמים על ה-loop, וה-gauges
+        (שאילתות SQLite), הקבצים של שאר ה-workers והעיצוב רצים ב-thread
+        """
+        return await asyncio.to_thread(self.render, self.snapshot_counters())
+    
+    def stats(self) -> dict:
+        return {
+            "directory": self.directory,
+            "flush_interval_seconds": self.flush_interval if self.directory else None,
+            "metrics": len(self._metrics),
+        }
+
+
+def create_metrics_registry() -> MetricsRegistry:
+    """
+    יוצר את רישום המדדים לפי משתני הסביבה:
+        METRICS_DIR: תיקייה משותפת לאיחוד מדדים בין workers (ברירת מחדל: ריק - התהליך בלבד)
+        METRICS_FLUSH_SECONDS: כל כמה שניות כל worker כותב את המדדים שלו (ברירת מחדל: 5)
+    """
+    return MetricsRegistry(
+        env_str("METRICS_DIR", ""),
+        flush_interval=env_float("METRICS_FLUSH_SECONDS", 5.0),
+    )
+
+
+# יצירת instance גלובלי - המדדים עצמם מוגדרים כאן כדי שכל המודולים יעדכנו אותם ישירות
+metrics = create_metrics_registry()
+
+WEBHOOK_SECONDS = metrics.histogram(
+    "whatsapp_webhook_seconds",
+    "Time to handle an inbound WhatsApp webhook, by outcome",
+    ("outcome",),
+)
+WEBHOOK_EVENTS = metrics.counter(
+    "whatsapp_webhook_events_total",
+    "Inbound webhook events, by kind (messages, statuses, duplicates, rejected)",
+    ("kind",),
+)
+FLOW_TRANSITION_SECONDS = metrics.histogram(
+    "flow_transition_seconds",
+    "Time to process one user message in a flow state (state read + transition + write)",
+    ("state",),
+)
+N8N_POST_SECONDS = metrics.histogram(
+    "n8n_post_seconds",
+    "Latency of a single POST attempt to the n8n webhook, by HTTP status code ('error' for transport errors)",
+    ("status",),
+)
+N8N_RETRIES = metrics.counter(
+    "n8n_retries_total",
+    "POST attempts to n8n that were retried",
+)
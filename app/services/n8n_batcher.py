@@ -0,0 +1,121 @@
+"""
+קיבוץ (batching) של הודעות יוצאות ל-N8N
+הודעות שנאספות בחלון זמן קצר או עד גודל מקסימלי נשלחות כ-POST אחד
+של מערך JSON, והתוצאה של כל פריט מוחזרת לקורא שלו
+הפריטים מגיעים כבר מקודדים (JSON bytes) ומשורשרים למערך בלי קידוד נוסף
+"""
+import asyncio
+import logging
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+import httpx
+
+from app.serialization import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+# תוצאה של פריט בודד: (status_code, response_text)
+ItemResult = Tuple[int, str]
+
+
+class N8NBatcher:
+    """
+    אוסף גופי JSON מקודדים ושולח אותם יחד
+    
+    הקבוצה נשלחת כשהיא מגיעה ל-max_size, או window שניות אחרי שהפריט
+    הראשון בה נכנס - המוקדם מביניהם. אם N8N מחזיר מערך JSON באותו אורך
+    כמו הקבוצה, כל פריט מקבל את התוצאה שבמקום המתאים; אחרת כל הפריטים
+    מקבלים את הסטטוס והתשובה של ה-POST כולו
+    """
+    
+    def __init__(self, post_batch: Callable[[List[bytes]], Awaitable[httpx.Response]],
+                 window: float = 0.02, max_size: int = 50):
+        self.post_batch = post_batch
+        self.window = window
+        self.max_size = max_size
+        
+        self._pending: List[Tuple[bytes, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._inflight: set = set()
+        
+        # מונים
+        self.batches = 0
+        self.items = 0
+    
+    async def submit(self, payload: bytes) -> ItemResult:
+        """מוסיף גוף JSON לקבוצה הנוכחית וממתין לתוצאה שלו"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((payload, future))
+        
+        if len(self._pending) >= self.max_size:
+            self._flush_now()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush_now)
+        return await future
+    
+    def _flush_now(self):
+        """מוציא את הקבוצה הנוכחית לשליחה ברקע"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        task = asyncio.ensure_future(self._send(batch))
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+    
+    async def _send(self, batch: List[Tuple[bytes, asyncio.Future]]):
+        """שולח קבוצה אחת וממפה את התוצאות חזרה לכל קורא"""
+        payloads = [payload for payload, _ in batch]
+        self.batches += 1
+        self.items += len(batch)
+        try:
+            response = await self.post_batch(payloads)
+        except Exception as e:
+            logger.warning("N8N batch of %d failed: %s", len(batch), e)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        results = self._split_results(response, len(batch))
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+    
+    @staticmethod
+    def _split_results(response: httpx.Response, size: int) -> List[ItemResult]:
+        """ממפה את תשובת N8N לתוצאה לכל פריט"""
+        try:
+            body = loads(response.content)
+        except ValueError:
+            body = None
+        
+        if isinstance(body, list) and len(body) == size:
+            results = []
+            for item in body:
+                status_code = response.status_code
+                if isinstance(item, dict) and isinstance(item.get("status_code"), int):
+                    status_code = item["status_code"]
+                results.append((status_code, dumps(item).decode("utf-8")))
+            return results
+        return [(response.status_code, response.text)] * size
+    
+    async def flush(self):
+        """שולח מיד את מה שממתין ומחכה לכל השליחות שבדרך (נקרא ב-shutdown)"""
+        self._flush_now()
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+    
+    def stats(self) -> dict:
+        """מחזיר את מוני הקיבוץ"""
+        return {
+            "window_ms": round(self.window * 1000, 3),
+            "max_size": self.max_size,
+            "pending": len(self._pending),
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+        }
@@ -0,0 +1,452 @@
+"""
+תיבת דואר יוצא עמידה (Outbox)
+כל הודעה יוצאת נכתבת קודם לטבלת SQLite מקומית, ו-workers ברקע שולחים אותה
+ל-N8N. כישלון (שגיאת רשת, 429, 5xx) לא מאבד את ההודעה - היא נשארת בטבלה
+ונשלחת שוב עם exponential backoff, כך שנפילה זמנית של N8N הופכת לעיכוב
+ולא לשיחה שנקטעה. ההודעות של כל נמען נשלחות לפי הסדר
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from app.config import env_bool, env_float, env_int, env_str
+from app.services.rate_limiter import retry_delay
+
+logger = logging.getLogger(__name__)
+
+# מצבי הודעה
+PENDING = "pending"  # ממתינה לשליחה (או לניסיון הבא)
+SENDING = "sending"  # נתפסה ע"י worker - עד claimed_until
+SENT = "sent"  # נשלחה (נשמרת retention_seconds לבדיקה)
+DEAD = "dead"  # נכשלה סופית (4xx או max_attempts) - ממתינה ל-replay ידני
+STATUSES = (PENDING, SENDING, SENT, DEAD)
+
+# שולח גוף JSON לנמען: (status_code, response_text)
+SendFunc = Callable[[bytes, Optional[str]], Awaitable[Tuple[int, str]]]
+
+
+class Outbox:
+    """
+    טבלת outbox ב-SQLite (WAL) + מאגר workers שמרוקן אותה
+    
+    הטבלה משותפת לכל ה-workers של uvicorn על אותו שרת: הודעה נתפסת ע"י
+    UPDATE בתוך טרנזקציה, עם lease - אם התהליך שתפס אותה מת, היא חוזרת
+    לתור כשה-lease פג. ה-worker מאריך את ה-lease כל עוד השליחה נמשכת, ועדכון
+    התוצאה מותנה ב-lease שלו - worker שאיבד את ההודעה לא דורס את מי שתפס
+    אותה אחריו. רק ההודעה הראשונה שלא נשלחה של כל נמען ניתנת לתפיסה,
+    כך שהודעות של אותו נמען לא נשלחות במקביל ולא מחליפות סדר (הודעה DEAD
+    לא חוסמת את הבאות אחריה)
+    """
+    
+    # מחיקת הודעות שנשלחו ופג זמן השמירה שלהן אחת ל-N שליחות
+    PURGE_EVERY = 1000
+    
+    def __init__(self, path: str, send: SendFunc, workers: int = 4,
+                 max_attempts: int = 20, base_delay: float = 1.0, max_delay: float = 300.0,
+                 lease_seconds: float = 60.0, poll_interval: float = 0.5,
+                 retention_seconds: float = 86400.0):
+        self.path = path
+        self.send = send
+        self.num_workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.retention_seconds = retention_seconds
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " recipient TEXT NOT NULL,"
+            " body BLOB NOT NULL,"
+            " status TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " next_attempt_at REAL NOT NULL,"
+            " claimed_until REAL NOT NULL DEFAULT 0,"
+            " created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " last_error TEXT)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS outbox_status_due ON outbox (status, next_attempt_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS outbox_recipient ON outbox (recipient, id)")
+        # בדיקת "האם יש הודעה קודמת של אותו נמען שעוד לא נשלחה" ב-claim - בלי
+        # האינדקס הזה היא סורקת את כל ההודעות של הנמען (גם אלפי dead/sent)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS outbox_recipient_status ON outbox (recipient, status, id)"
+        )
+        
+        self._wakeup: Optional[asyncio.Event] = None
+        self._workers: List[asyncio.Task] = []
+        self._sends = 0
+        
+        # מונים (של התהליך הזה)
+        self.enqueued = 0
+        self.sent = 0
+        self.retried = 0
+        self.dead = 0
+    
+    # --- כתיבה ותפיסה ---
+    
+    def enqueue(self, recipient: Optional[str], body: bytes) -> int:
+        """כותב הודעה לטבלה (לפני כל ניסיון שליחה). Returns: מזהה ההודעה"""
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO outbox (recipient, body, status, next_attempt_at, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (recipient or "", body, PENDING, now, now, now),
+            )
+        self.enqueued += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return cursor.lastrowid
+    
+    # ההודעה הבאה שמוכנה לשליחה ושאין לפניה הודעה של אותו נמען שעוד לא נשלחה
+    _NEXT_DUE = (
+        "SELECT id, recipient, body, attempts FROM outbox AS o"
+        " WHERE status = ? AND next_attempt_at <= ?"
+        " AND NOT EXISTS (SELECT 1 FROM outbox AS p WHERE p.recipient = o.recipient"
+        "                 AND p.status IN (?, ?) AND p.id < o.id)"
+        " ORDER BY next_attempt_at, id LIMIT 1"
+    )
+    
+    def _has_work(self, now: float) -> bool:
+        """
+        בדיקה לקריאה בלבד (לא תופסת את נעילת הכתיבה של SQLite): האם יש הודעה
+        לתפוס, או lease שפג. workers פנויים בכל התהליכים בודקים כך בכל poll_interval
+        """
+        with self._lock:
+            if self._conn.execute(
+                "SELECT 1 FROM outbox WHERE status = ? AND claimed_until <= ? LIMIT 1", (SENDING, now),
+            ).fetchone() is not None:
+                return True
+            return self._conn.execute(self._NEXT_DUE, (PENDING, now, PENDING, SENDING)).fetchone() is not None
+    
+    def claim(self) -> Optional[Tuple[int, str, bytes, int, float]]:
+        """
+        תופס את ההודעה הבאה שמוכנה לשליחה. סינכרוני (SQLite) - ה-workers
+        קוראים לו דרך asyncio.to_thread כדי לא לחסום את ה-event loop
+        Returns: (id, recipient, body, attempts, lease) או None אם אין.
+        lease הוא ה-claimed_until שנכתב - מזהה את התפיסה הזו
+        """
+        now = time.time()
+        if not self._has_work(now):
+            return None
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # lease שפג - התהליך שתפס את ההודעה מת באמצע שליחה
+                self._conn.execute(
+                    "UPDATE outbox SET status = ? WHERE status = ? AND claimed_until <= ?",
+                    (PENDING, SENDING, now),
+                )
+                row = self._conn.execute(self._NEXT_DUE, (PENDING, now, PENDING, SENDING)).fetchone()
+                if row is not None:
+                    lease = now + self.lease_seconds
+                    self._conn.execute(
+                        "UPDATE outbox SET status = ?, claimed_until = ?, updated_at = ? WHERE id = ?",
+                        (SENDING, lease, now, row[0]),
+                    )
+                    row = (*row, lease)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return row
+    
+    def extend_lease(self, message_id: int, lease: float) -> Optional[float]:
+        """
+        מאריך lease של הודעה שבאמצע שליחה
+        Returns: ה-lease החדש, או None אם ההודעה כבר לא בתפיסה הזו
+        """
+        renewed = time.time() + self.lease_seconds
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE outbox SET claimed_until = ? WHERE id = ? AND status = ? AND claimed_until = ?",
+                (renewed, message_id, SENDING, lease),
+            )
+        return renewed if cursor.rowcount else None
+    
+    def _finish(self, message_id: int, lease: float, status: str, attempts: int,
+                next_attempt_at: float = 0.0, error: Optional[str] = None) -> bool:
+        """
+        מעדכן את תוצאת השליחה - רק אם ההודעה עדיין בתפיסה הזו (lease)
+        Returns: False אם ה-lease פג וההודעה נתפסה מחדש
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, claimed_until = 0,"
+                " updated_at = ?, last_error = ? WHERE id = ? AND status = ? AND claimed_until = ?",
+                (status, attempts, next_attempt_at or now, now, error, message_id, SENDING, lease),
+            )
+            self._sends += 1
+            if self._sends % self.PURGE_EVERY == 0:
+                self._conn.execute(
+                    "DELETE FROM outbox WHERE status = ? AND updated_at <= ?",
+                    (SENT, now - self.retention_seconds),
+                )
+        if cursor.rowcount == 0:
+            logger.warning("Outbox message %d lost its lease while sending; result (%s) not recorded",
+                           message_id, status)
+            return False
+        return True
+    
+    async def _send_leased(self, message_id: int, recipient: str, body: bytes, attempts: int, lease: float):
+        """
+        שולח ומאריך את ה-lease כל חצי lease כל עוד השליחה נמשכת (המתנה במגביל
+        הקצב ו-N8N איטי יכולים להימשך יותר מ-lease אחד, ו-worker אחר היה
+        תופס את ההודעה ושולח אותה שוב)
+        Returns: (ה-future של השליחה שהסתיימה, ה-lease הנוכחי)
+        """
+        sending = asyncio.ensure_future(self.send(body, recipient or None))
+        try:
+            while True:
+                done, _ = await asyncio.wait({sending}, timeout=self.lease_seconds / 2)
+                if done:
+                    return sending, lease
+                renewed = self.extend_lease(message_id, lease)
+                if renewed is None:
+                    logger.warning("Outbox message %d lease was lost while sending", message_id)
+                else:
+                    lease = renewed
+        except asyncio.CancelledError:
+            # עצירה באמצע שליחה - ההודעה חוזרת לתור מיד (ולא אחרי שה-lease יפוג)
+            self._finish(message_id, lease, PENDING, attempts)
+            raise
+        finally:
+            sending.cancel()
+    
+    async def deliver(self, message_id: int, recipient: str, body: bytes, attempts: int, lease: float):
+        """שולח הודעה שנתפסה (ניסיון אחד - self.send לא מנסה שוב) ומעדכן את מצבה לפי התוצאה"""
+        sending, lease = await self._send_leased(message_id, recipient, body, attempts, lease)
+        try:
+            status_code, response_text = sending.result()
+        except Exception as e:
+            status_code, error = 0, f"{type(e).__name__}: {e}"
+        else:
+            error = None if 200 <= status_code < 300 else f"HTTP {status_code}: {response_text[:200]}"
+        attempts += 1
+        
+        if error is None:
+            if await asyncio.to_thread(self._finish, message_id, lease, SENT, attempts):
+                self.sent += 1
+            return
+        retryable = status_code in (0, 429) or status_code >= 500
+        if not retryable or attempts >= self.max_attempts:
+            if await asyncio.to_thread(self._finish, message_id, lease, DEAD, attempts, error=error):
+                self.dead += 1
+                logger.error("Outbox message %d to %s failed permanently after %d attempts: %s",
+                             message_id, recipient, attempts, error)
+            return
+        delay = retry_delay(attempts - 1, self.base_delay, self.max_delay)
+        if not await asyncio.to_thread(self._finish, message_id, lease, PENDING, attempts,
+                                       time.time() + delay, error):
+            return
+        self.retried += 1
+        logger.warning("Outbox message %d to %s failed (%s), retry %d in %.1fs",
+                       message_id, recipient, error, attempts, delay)
+    
+    # --- workers ---
+    
+    @property
+    def running(self) -> bool:
+        return bool(self._workers)
+    
+    async def start(self):
+        """מפעיל את ה-workers (גם הודעות שנשארו מהריצה הקודמת יישלחו)"""
+        if self.running:
+            return
+        self._wakeup = asyncio.Event()
+        self._workers = [
+            asyncio.create_task(self._worker(), name=f"outbox-worker-{i}")
+            for i in range(self.num_workers)
+        ]
+        logger.info("Outbox started: %d workers, %s", self.num_workers, self.path)
+    
+    async def stop(self, drain_timeout: float = 5.0):
+        """
+        ממתין (עד drain_timeout) שהטבלה תתרוקן מהודעות מוכנות ועוצר את ה-workers.
+        מה שלא נשלח נשאר בטבלה לריצה הבאה
+        """
+        if not self.running:
+            return
+        deadline = time.monotonic() + drain_timeout
+        while time.monotonic() < deadline and self._due_count() > 0:
+            await asyncio.sleep(0.05)
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+    
+    async def _claim(self) -> Optional[Tuple[int, str, bytes, int, float]]:
+        """
+        claim ב-thread. אם ה-worker נעצר בזמן שה-thread רץ, ההודעה שנתפסה
+        מוחזרת לתור מיד (ולא נשארת sending עד שה-lease יפוג)
+        """
+        claiming = asyncio.ensure_future(asyncio.to_thread(self.claim))
+        try:
+            return await asyncio.shield(claiming)
+        except asyncio.CancelledError:
+            claimed = await claiming
+            if claimed is not None:
+                self._finish(claimed[0], claimed[4], PENDING, claimed[3])
+            raise
+    
+    async def _worker(self):
+        """לולאת worker - תופס הודעה ושולח, וממתין להודעה חדשה כשאין מה לשלוח"""
+        while True:
+            try:
+                claimed = await self._claim()
+            except sqlite3.Error as e:
+                logger.warning("Outbox claim failed: %s", e)
+                claimed = None
+            if claimed is None:
+                self._wakeup.clear()
+                # asyncio.wait ולא wait_for - wait_for בולע את הביטול אם ה-event
+                # נקבע באותו רגע, וה-worker ממשיך לרוץ אחרי stop
+                waiting = asyncio.ensure_future(self._wakeup.wait())
+                try:
+                    await asyncio.wait({waiting}, timeout=self.poll_interval)
+                finally:
+                    waiting.cancel()
+                continue
+            await self.deliver(*claimed)
+            # הנמען עשוי להחזיק הודעה הבאה בתור - worker אחר יכול לתפוס אותה עכשיו
+            self._wakeup.set()
+    
+    # --- בדיקה ו-replay ---
+    
+    def _due_count(self) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM outbox WHERE status IN (?, ?) AND next_attempt_at <= ?",
+                (PENDING, SENDING, time.time()),
+            ).fetchone()[0]
+    
+    def messages(self, status: Optional[str] = None, recipient: Optional[str] = None,
+                 limit: int = 100) -> List[dict]:
+        """הודעות בטבלה (החדשות קודם), לפי מצב ו/או נמען"""
+        query = ("SELECT id, recipient, status, attempts, created_at, updated_at, next_attempt_at,"
+                 " last_error, body FROM outbox")
+        conditions, params = [], []
+        if status:
+            conditions.append("status = ?")
+            params.append(status)
+        if recipient:
+            conditions.append("recipient = ?")
+            params.append(recipient)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [
+            {
+                "id": row[0],
+                "recipient": row[1],
+                "status": row[2],
+                "attempts": row[3],
+                "created_at": row[4],
+                "updated_at": row[5],
+                "next_attempt_at": row[6] if row[2] == PENDING else None,
+                "last_error": row[7],
+                "body": bytes(row[8]).decode("utf-8", errors="replace"),
+            }
+            for row in rows
+        ]
+    
+    def replay(self, ids: Optional[Iterable[int]] = None, status: str = DEAD) -> int:
+        """
+        מחזיר הודעות לשליחה מיידית עם מונה ניסיונות מאופס
+        ids: הודעות מסוימות (בכל מצב חוץ מ-sending); אחרת כל ההודעות במצב status
+        Returns: כמה הודעות הוחזרו לתור
+        """
+        now = time.time()
+        with self._lock:
+            if ids is not None:
+                ids = list(ids)
+                if not ids:
+                    return 0
+                placeholders = ",".join("?" * len(ids))
+                cursor = self._conn.execute(
+                    f"UPDATE outbox SET status = ?, attempts = 0, next_attempt_at = ?, updated_at = ?"
+                    f" WHERE id IN ({placeholders}) AND status != ?",
+                    (PENDING, now, now, *ids, SENDING),
+                )
+            else:
+                cursor = self._conn.execute(
+                    "UPDATE outbox SET status = ?, attempts = 0, next_attempt_at = ?, updated_at = ?"
+                    " WHERE status = ?",
+                    (PENDING, now, now, status),
+                )
+        if cursor.rowcount and self._wakeup is not None:
+            self._wakeup.set()
+        return cursor.rowcount
+    
+    def count_by_status(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()
+        counts = dict.fromkeys(STATUSES, 0)
+        counts.update(rows)
+        return counts
+    
+    def stats(self) -> dict:
+        with self._lock:
+            oldest = self._conn.execute(
+                "SELECT MIN(created_at) FROM outbox WHERE status IN (?, ?)", (PENDING, SENDING),
+            ).fetchone()[0]
+        return {
+            "path": self.path,
+            "workers": len(self._workers),
+            "messages": self.count_by_status(),
+            "oldest_unsent_age_seconds": round(time.time() - oldest, 3) if oldest else None,
+            "max_attempts": self.max_attempts,
+            "enqueued": self.enqueued,
+            "sent": self.sent,
+            "retried": self.retried,
+            "dead": self.dead,
+        }
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def create_outbox(send: SendFunc) -> Optional[Outbox]:
+    """
+    יוצר את ה-outbox לפי משתני הסביבה (או None אם כבוי):
+        OUTBOX_ENABLED: כתיבת הודעות יוצאות ל-outbox לפני השליחה (ברירת מחדל: false)
+        OUTBOX_DB_PATH: קובץ ה-SQLite (ברירת מחדל: data/outbox.db)
+        OUTBOX_WORKERS: workers ששולחים במקביל בכל תהליך (ברירת מחדל: 4)
+        OUTBOX_MAX_ATTEMPTS: ניסיונות עד שהודעה מסומנת dead (ברירת מחדל: 20)
+        OUTBOX_RETRY_BASE_DELAY / OUTBOX_RETRY_MAX_DELAY: backoff בשניות (ברירת מחדל: 1 / 300)
+        OUTBOX_LEASE_SECONDS: אחרי כמה זמן הודעה שנתפסה חוזרת לתור - מוארך כל עוד השליחה נמשכת (ברירת מחדל: 60)
+        OUTBOX_RETENTION_SECONDS: כמה זמן לשמור הודעות שנשלחו (ברירת מחדל: 86400)
+    """
+    if not env_bool("OUTBOX_ENABLED", False):
+        return None
+    return Outbox(
+        env_str("OUTBOX_DB_PATH", "data/outbox.db"),
+        send,
+        workers=env_int("OUTBOX_WORKERS", 4),
+        max_attempts=env_int("OUTBOX_MAX_ATTEMPTS", 20),
+        base_delay=env_float("OUTBOX_RETRY_BASE_DELAY", 1.0),
+        max_delay=env_float("OUTBOX_RETRY_MAX_DELAY", 300.0),
+        lease_seconds=env_float("OUTBOX_LEASE_SECONDS", 60.0),
+        retention_seconds=env_float("OUTBOX_RETENTION_SECONDS", 86400.0),
+    )
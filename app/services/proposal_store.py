@@ -0,0 +1,256 @@
+"""
+אחסון מצעים לדיון (Proposal Store)
+כל מצע שהושלם בזרימת "מצע חדש" נשמר בטבלת SQLite עם אינדקסים לפי מספר
+טלפון, שם הדיון ומשתתפים, ואינדקס FTS5 לחיפוש חופשי בתוכן - כך ש"מצע
+קיים" מציג ושולף את המצעים של המשתמש במילישניות גם עם מאות אלפי מצעים
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+from app.config import env_str
+
+logger = logging.getLogger(__name__)
+
+_COLUMNS = "p.id, p.phone_number, p.name, p.participants, p.content, p.created_at"
+
+
+def split_participants(participants: str) -> List[str]:
+    """שמות המשתתפים מתוך הטקסט שהמשתמש הקליד (מופרדים בפסיקים), מנורמלים ובלי כפילויות"""
+    names = []
+    for part in participants.split(","):
+        name = " ".join(part.split())
+        if name and name.casefold() not in (n.casefold() for n in names):
+            names.append(name)
+    return names
+
+
+# אינדקס trigram מוצא מילה רק מ-3 תווים ומעלה - מילים קצרות יותר נבדקות ב-LIKE
+MIN_FTS_WORD = 3
+
+
+def fts_query(words: List[str]) -> str:
+    """שאילתת FTS5 שבה כל המילים חייבות להופיע - כל מילה בין מרכאות (בלי תחביר FTS מהמשתמש)"""
+    return " ".join('"' + word.replace('"', '""') + '"' for word in words)
+
+
+def _like_pattern(word: str) -> str:
+    return "%" + word.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+class ProposalStore:
+    """
+    טבלת מצעים ב-SQLite (WAL) - משותפת לכל ה-workers על אותו שרת
+    
+    proposals: שורה לכל מצע, עם אינדקס (phone_number, id) לרשימת המצעים של
+    משתמש (החדשים קודם) ואינדקס על השם. proposal_participants: שורה לכל
+    משתתף לחיפוש לפי משתתף. proposals_fts: אינדקס FTS5 (tokenizer trigram)
+    על שם, משתתפים ותוכן שמתעדכן ב-triggers - מוצא כל חלק של מילה, כך
+    ש"תקציב" מוצא גם "התקציב" ו"לתקציבים". אם ה-SQLite לא תומך ב-FTS5
+    trigram (לפני 3.34), החיפוש נופל ל-LIKE
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS proposals ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " phone_number TEXT NOT NULL,"
+            " name TEXT NOT NULL,"
+            " participants TEXT NOT NULL,"
+            " content TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS proposals_phone ON proposals (phone_number, id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS proposals_name ON proposals (name COLLATE NOCASE)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS proposal_participants ("
+            " participant TEXT NOT NULL COLLATE NOCASE,"
+            " proposal_id INTEGER NOT NULL REFERENCES proposals (id) ON DELETE CASCADE,"
+            " PRIMARY KEY (participant, proposal_id)) WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS proposal_participants_proposal ON proposal_participants (proposal_id)"
+        )
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self.fts = self._create_fts()
+    
+    def _create_fts(self) -> bool:
+        """יוצר את אינדקס החיפוש (external content) ואת ה-triggers. Returns: האם FTS5 זמין"""
+        existed = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'proposals_fts'"
+        ).fetchone() is not None
+        try:
+            self._conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS proposals_fts USING fts5("
+                " name, participants, content, content='proposals', content_rowid='id', tokenize='trigram')"
+            )
+        except sqlite3.OperationalError:
+            logger.warning("SQLite has no FTS5 trigram tokenizer - proposal search falls back to LIKE")
+            return False
+        if not existed:
+            # מצעים שנשמרו לפני שהאינדקס נוצר (למשל קובץ מ-SQLite בלי FTS5)
+            self._conn.execute("INSERT INTO proposals_fts (proposals_fts) VALUES ('rebuild')")
+        self._conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS proposals_fts_insert AFTER INSERT ON proposals BEGIN"
+            " INSERT INTO proposals_fts (rowid, name, participants, content)"
+            " VALUES (new.id, new.name, new.participants, new.content); END"
+        )
+        self._conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS proposals_fts_delete AFTER DELETE ON proposals BEGIN"
+            " INSERT INTO proposals_fts (proposals_fts, rowid, name, participants, content)"
+            " VALUES ('delete', old.id, old.name, old.participants, old.content); END"
+        )
+        return True
+    
+    @staticmethod
+    def _row(row: tuple) -> Dict:
+        return {
+            "id": row[0],
+            "phone_number": row[1],
+            "name": row[2],
+            "participants": row[3],
+            "content": row[4],
+            "created_at": row[5],
+        }
+    
+    def save(self, phone_number: str, name: str, participants: str, content: str) -> int:
+        """שומר מצע חדש (השורה, המשתתפים ואינדקס החיפוש בטרנזקציה אחת). Returns: מזהה המצע"""
+        names = split_participants(participants)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = self._conn.execute(
+                    "INSERT INTO proposals (phone_number, name, participants, content, created_at)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    (phone_number, name, participants, content, time.time()),
+                )
+                proposal_id = cursor.lastrowid
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO proposal_participants (participant, proposal_id) VALUES (?, ?)",
+                    [(participant, proposal_id) for participant in names],
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return proposal_id
+    
+    def get(self, proposal_id: int, phone_number: Optional[str] = None) -> Optional[Dict]:
+        """מצע לפי מזהה (ואם phone_number ניתן - רק אם הוא של המשתמש הזה)"""
+        query = f"SELECT {_COLUMNS} FROM proposals p WHERE p.id = ?"
+        params: list = [proposal_id]
+        if phone_number is not None:
+            query += " AND p.phone_number = ?"
+            params.append(phone_number)
+        with self._lock:
+            row = self._conn.execute(query, params).fetchone()
+        return self._row(row) if row else None
+    
+    def list_for(self, phone_number: str, limit: int = 10, before_id: Optional[int] = None) -> List[Dict]:
+        """המצעים של המשתמש, החדשים קודם (before_id - לעמוד הבא)"""
+        query = f"SELECT {_COLUMNS} FROM proposals p WHERE p.phone_number = ?"
+        params: list = [phone_number]
+        if before_id is not None:
+            query += " AND p.id < ?"
+            params.append(before_id)
+        query += " ORDER BY p.id DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [self._row(row) for row in rows]
+    
+    def find(self, phone_number: Optional[str] = None, name: Optional[str] = None,
+             participant: Optional[str] = None, text: Optional[str] = None,
+             limit: int = 10) -> List[Dict]:
+        """
+        חיפוש מצעים, החדשים קודם. כל התנאים שניתנו חייבים להתקיים:
+            phone_number: של המשתמש הזה
+            name: שם הדיון (התאמה מלאה, בלי תלות באותיות גדולות/קטנות)
+            participant: אחד המשתתפים (התאמה מלאה)
+            text: כל המילים מופיעות בשם, במשתתפים או בתוכן (גם כחלק ממילה)
+        """
+        joins, conditions, params = [], [], []
+        words = text.split() if text else []
+        fts_words = [word for word in words if len(word) >= MIN_FTS_WORD] if self.fts else []
+        if fts_words:
+            if phone_number is not None:
+                # המצעים של המשתמש נשלפים מהאינדקס לפי טלפון וכל אחד נבדק מול ה-FTS לפי rowid -
+                # מילה נפוצה לא גורמת לסריקת כל ההתאמות של כל המשתמשים
+                conditions.append("EXISTS (SELECT 1 FROM proposals_fts"
+                                  " WHERE proposals_fts.rowid = p.id AND proposals_fts MATCH ?)")
+            else:
+                joins.append("JOIN proposals_fts f ON f.rowid = p.id")
+                conditions.append("proposals_fts MATCH ?")
+            params.append(fts_query(fts_words))
+        for word in words:
+            if word in fts_words:
+                continue
+            pattern = _like_pattern(word)
+            conditions.append("(p.name LIKE ? ESCAPE '\\' OR p.participants LIKE ? ESCAPE '\\'"
+                              " OR p.content LIKE ? ESCAPE '\\')")
+            params.extend((pattern, pattern, pattern))
+        if participant:
+            joins.append("JOIN proposal_participants pp ON pp.proposal_id = p.id")
+            conditions.append("pp.participant = ?")
+            params.append(" ".join(participant.split()))
+        if name:
+            conditions.append("p.name = ? COLLATE NOCASE")
+            params.append(name.strip())
+        if phone_number is not None:
+            conditions.append("p.phone_number = ?")
+            params.append(phone_number)
+        
+        query = f"SELECT {_COLUMNS} FROM proposals p " + " ".join(joins)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY p.id DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [self._row(row) for row in rows]
+    
+    def delete(self, proposal_id: int, phone_number: Optional[str] = None) -> bool:
+        """מוחק מצע (המשתתפים ואינדקס החיפוש מתעדכנים אוטומטית). Returns: האם נמחק"""
+        query = "DELETE FROM proposals WHERE id = ?"
+        params: list = [proposal_id]
+        if phone_number is not None:
+            query += " AND phone_number = ?"
+            params.append(phone_number)
+        with self._lock:
+            return self._conn.execute(query, params).rowcount > 0
+    
+    def count(self, phone_number: Optional[str] = None) -> int:
+        with self._lock:
+            if phone_number is None:
+                return self._conn.execute("SELECT COUNT(*) FROM proposals").fetchone()[0]
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM proposals WHERE phone_number = ?", (phone_number,),
+            ).fetchone()[0]
+    
+    def stats(self) -> dict:
+        return {"path": self.path, "proposals": self.count(), "full_text_search": self.fts}
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def create_proposal_store() -> ProposalStore:
+    """
+    יוצר את אחסון המצעים לפי משתני הסביבה:
+        PROPOSAL_DB_PATH: קובץ ה-SQLite (ברירת מחדל: data/proposals.db)
+    """
+    return ProposalStore(env_str("PROPOSAL_DB_PATH", "data/proposals.db"))
@@ -0,0 +1,188 @@
+"""
+הגבלת קצב לתעבורה יוצאת (Outbound Rate Limiting)
+token bucket גלובלי + token bucket לכל נמען + הגבלת מספר הבקשות שבדרך,
+וחישוב המתנה עם jitter לניסיון חוזר אחרי 429/5xx
+"""
+import asyncio
+import random
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+from app.config import env_float, env_int
+
+
+class TokenBucket:
+    """
+    token bucket עם pacing חלק
+    
+    כל acquire שומר לעצמו את ה-token הבא ומחכה בדיוק עד שהוא מתמלא,
+    כך שבקשות שמגיעות יחד מתפזרות במרווחים קבועים במקום לצאת בפרץ
+    """
+    
+    __slots__ = ("rate", "capacity", "_tokens", "_updated_at")
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+    
+    def reserve(self) -> float:
+        """לוקח token (גם "בהקפה") ומחזיר כמה שניות צריך לחכות עד שהוא זמין"""
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+        self._tokens -= 1
+        if self._tokens >= 0:
+            return 0.0
+        return -self._tokens / self.rate
+    
+    async def acquire(self):
+        """ממתין עד שיש token פנוי"""
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    
+    @property
+    def idle(self) -> bool:
+        """האם ה-bucket מלא (אפשר למחוק אותו בלי לאבד מידע)"""
+        elapsed = time.monotonic() - self._updated_at
+        return self._tokens + elapsed * self.rate >= self.capacity
+
+
+class OutboundRateLimiter:
+    """
+    מגביל את קצב השליחה ל-N8N / WhatsApp Cloud API
+    
+    - bucket גלובלי: סך ההודעות לשנייה מה-worker
+    - bucket לכל נמען: כמה הודעות לשנייה לאותו מספר (מוחזק ב-LRU חסום)
+    - semaphore: מקסימום בקשות שבדרך במקביל
+    ערך 0 ב-rate מבטל את ההגבלה המתאימה
+    
+    כל ניסיון שליחה (גם ניסיון חוזר) עובר ב-pace, וה-semaphore מוחזק רק
+    לאורך ה-POST עצמו. אחרי 429 כל השליחה מה-worker נעצרת (hold_off) ולא
+    רק הבקשה שנדחתה
+    """
+    
+    def __init__(self, global_rate: float = 0.0, global_burst: float = 0.0,
+                 per_recipient_rate: float = 0.0, per_recipient_burst: float = 1.0,
+                 max_in_flight: int = 0, max_recipients: int = 10_000):
+        self.global_bucket = (
+            TokenBucket(global_rate, global_burst or global_rate) if global_rate > 0 else None
+        )
+        self.per_recipient_rate = per_recipient_rate
+        self.per_recipient_burst = per_recipient_burst
+        self.max_recipients = max_recipients
+        self._recipient_buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._semaphore = asyncio.Semaphore(max_in_flight) if max_in_flight > 0 else None
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.waited = 0.0
+        self._resume_at = 0.0
+        self.hold_offs = 0
+    
+    def _recipient_bucket(self, recipient: str) -> Optional[TokenBucket]:
+        """מחזיר את ה-bucket של הנמען (ויוצר אותו אם צריך)"""
+        if self.per_recipient_rate <= 0:
+            return None
+        bucket = self._recipient_buckets.get(recipient)
+        if bucket is None:
+            bucket = TokenBucket(self.per_recipient_rate, self.per_recipient_burst)
+            self._recipient_buckets[recipient] = bucket
+            # פינוי נמענים ישנים - רק אם ה-bucket שלהם כבר התמלא מחדש
+            while len(self._recipient_buckets) > self.max_recipients:
+                oldest_key, oldest = next(iter(self._recipient_buckets.items()))
+                if not oldest.idle:
+                    break
+                del self._recipient_buckets[oldest_key]
+        else:
+            self._recipient_buckets.move_to_end(recipient)
+        return bucket
+    
+    def hold_off(self, seconds: float):
+        """אחרי 429 - אף שליחה מה-worker לא יוצאת לפני שיעברו seconds"""
+        resume_at = time.monotonic() + seconds
+        if resume_at > self._resume_at:
+            self._resume_at = resume_at
+            self.hold_offs += 1
+    
+    async def pace(self, recipient: Optional[str] = None):
+        """ממתין לסוף ה-hold_off ולתור לפי ה-buckets (token מכל bucket)"""
+        started = time.monotonic()
+        # hold_off יכול להתארך בזמן ההמתנה (429 נוסף)
+        while (delay := self._resume_at - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+        bucket = self._recipient_bucket(recipient) if recipient else None
+        if bucket is not None:
+            await bucket.acquire()
+        if self.global_bucket is not None:
+            await self.global_bucket.acquire()
+        self.waited += time.monotonic() - started
+    
+    @asynccontextmanager
+    async def in_flight_slot(self) -> AsyncIterator[None]:
+        """מחזיק מקום ב-semaphore לאורך בקשה אחת"""
+        if self._semaphore is not None:
+            started = time.monotonic()
+            await self._semaphore.acquire()
+            self.waited += time.monotonic() - started
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            if self._semaphore is not None:
+                self._semaphore.release()
+    
+    @asynccontextmanager
+    async def slot(self, recipient: Optional[str] = None) -> AsyncIterator[None]:
+        """pace ואז מקום ב-semaphore לאורך ניסיון שליחה אחד"""
+        await self.pace(recipient)
+        async with self.in_flight_slot():
+            yield
+    
+    def stats(self) -> dict:
+        """מחזיר את מצב המגביל"""
+        return {
+            "global_rate": self.global_bucket.rate if self.global_bucket else None,
+            "per_recipient_rate": self.per_recipient_rate or None,
+            "max_in_flight": self.max_in_flight or None,
+            "in_flight": self.in_flight,
+            "tracked_recipients": len(self._recipient_buckets),
+            "total_wait_seconds": round(self.waited, 3),
+            "hold_offs": self.hold_offs,
+            "holding_off_seconds": round(max(0.0, self._resume_at - time.monotonic()), 3),
+        }
+
+
+def retry_delay(attempt: int, base: float, cap: float, retry_after: Optional[str] = None) -> float:
+    """
+    זמן המתנה לפני ניסיון חוזר: Retry-After אם השרת שלח,
+    אחרת exponential backoff עם full jitter
+    """
+    if retry_after:
+        try:
+            return min(cap, max(0.0, float(retry_after)))
+        except ValueError:
+            pass
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def create_rate_limiter() -> OutboundRateLimiter:
+    """
+    יוצר את המגביל לפי משתני הסביבה (0 = ללא הגבלה):
+        OUTBOUND_RATE: הודעות לשנייה מה-worker (גלובלי)
+        OUTBOUND_BURST: גודל הפרץ הגלובלי (ברירת מחדל: כמו ה-rate)
+        OUTBOUND_PER_RECIPIENT_RATE: הודעות לשנייה לאותו נמען
+        OUTBOUND_PER_RECIPIENT_BURST: גודל הפרץ לאותו נמען (ברירת מחדל: 1)
+        OUTBOUND_MAX_IN_FLIGHT: מקסימום בקשות שבדרך במקביל
+    """
+    return OutboundRateLimiter(
+        global_rate=env_float("OUTBOUND_RATE", 0.0),
+        global_burst=env_float("OUTBOUND_BURST", 0.0),
+        per_recipient_rate=env_float("OUTBOUND_PER_RECIPIENT_RATE", 0.0),
+        per_recipient_burst=env_float("OUTBOUND_PER_RECIPIENT_BURST", 1.0),
+        max_in_flight=env_int("OUTBOUND_MAX_IN_FLIGHT", 0),
+    )
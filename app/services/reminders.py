@@ -0,0 +1,501 @@
+"""
+תזכורות מתוזמנות (Reminders)
+תזכורת שנקלטה בזרימת "תזכורת חדשה" נשמרת בטבלת SQLite, ו-scheduler בכל
+worker שולח אותה דרך WhatsAppService כשמגיע זמנה:
+    - ה-heap בזיכרון מחזיק רק תזכורות שזמנן בחלון הקרוב (window_seconds) -
+      מיליוני תזכורות עתידיות נשארות באינדקס (status, due_at) ונטענות לפי הצורך
+    - הוספה ושליפת התזכורת הבאה ב-O(log n) (heapq), והמתנה עד הזמן שלה בלי polling
+    - אחרי restart החלון נטען מחדש, כולל תזכורות שזמנן עבר בזמן שהשרת היה למטה
+    - כל ה-workers טוענים את אותו חלון, אבל תזכורת נשלחת רק ע"י ה-worker שתפס
+      אותה ב-UPDATE אטומי (pending -> sending), עם lease למקרה שהוא נפל באמצע
+"""
+import asyncio
+import heapq
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, tzinfo
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from app.config import env_float, env_int, env_str
+from app.services.rate_limiter import retry_delay
+
+logger = logging.getLogger(__name__)
+
+# מצבי תזכורת
+PENDING = "pending"  # ממתינה למועד (או לניסיון הבא)
+SENDING = "sending"  # נתפסה ע"י worker - עד claimed_until
+SENT = "sent"
+FAILED = "failed"  # השליחה נכשלה max_attempts פעמים
+STATUSES = (PENDING, SENDING, SENT, FAILED)
+
+# שולח טקסט למספר: dict התוצאה של WhatsAppService.send_message
+SendFunc = Callable[[str, str], Awaitable[dict]]
+
+# שעה שנקבעת כשהמשתמש כתב רק תאריך
+DEFAULT_HOUR = 9
+
+_DATE_TIME = re.compile(
+    r"^(?:(?P<day>\d{1,2})[/.](?P<month>\d{1,2})(?:[/.](?P<year>\d{2}|\d{4}))?)?"
+    r"\s*(?:(?P<hour>\d{1,2}):(?P<minute>\d{2}))?$"
+)
+_RELATIVE_DAY = {"היום": 0, "מחר": 1, "מחרתיים": 2}
+_IN_UNITS = {
+    "דקה": 60, "דקות": 60,
+    "שעה": 3600, "שעות": 3600,
+    "יום": 86400, "ימים": 86400,
+    "שבוע": 604800, "שבועות": 604800,
+}
+_IN = re.compile(r"^בעוד\s+(?:(?P<amount>\d+)\s+)?(?P<unit>\S+)$")
+
+
+def load_timezone(name: str) -> tzinfo:
+    """אזור הזמן של המועדים שהמשתמשים מקלידים (אזור הזמן המקומי אם הוא לא מוכר)"""
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        # ב-Windows אין מסד אזורי זמן בלי החבילה tzdata
+        logger.warning("Unknown timezone %r (install tzdata on Windows) - using the local timezone", name)
+        return datetime.now().astimezone().tzinfo
+
+
+def parse_reminder_time(text: str, now: datetime) -> Optional[datetime]:
+    """
+    מפענח את מועד התזכורת שהמשתמש הקליד, יחסית ל-now (datetime עם אזור זמן):
+        25/12 09:00, 25.12.2026 9:00, 25/12 (בשעה DEFAULT_HOUR)
+        09:00 (היום, או מחר אם השעה עברה), מחר 08:30, היום 18:00
+        בעוד 10 דקות, בעוד שעה, בעוד 3 ימים
+    תאריך בלי שנה שכבר עבר השנה - בשנה הבאה
+    Returns: המועד (באותו אזור זמן), או None אם הטקסט לא מובן
+    """
+    text = " ".join(text.split())
+    match = _IN.match(text)
+    if match:
+        seconds = _IN_UNITS.get(match["unit"])
+        if seconds is None:
+            return None
+        return now + timedelta(seconds=seconds * int(match["amount"] or 1))
+    
+    word, _, rest = text.partition(" ")
+    day_offset = _RELATIVE_DAY.get(word)
+    if day_offset is not None:
+        text = rest
+    match = _DATE_TIME.match(text)
+    if match is None or not (match["day"] or match["hour"] or day_offset is not None):
+        return None
+    if match["day"] and day_offset is not None:
+        return None
+    hour = int(match["hour"]) if match["hour"] else DEFAULT_HOUR
+    minute = int(match["minute"]) if match["minute"] else 0
+    try:
+        if match["day"]:
+            year = int(match["year"]) if match["year"] else now.year
+            if year < 100:
+                year += 2000
+            due = now.replace(year=year, month=int(match["month"]), day=int(match["day"]),
+                              hour=hour, minute=minute, second=0, microsecond=0)
+            if due <= now and not match["year"]:
+                due = due.replace(year=year + 1)
+            return due
+        due = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    except ValueError:
+        # תאריך או שעה לא קיימים (31/02, 25:00)
+        return None
+    if day_offset is not None:
+        return due + timedelta(days=day_offset)
+    return due if due > now else due + timedelta(days=1)
+
+
+class ReminderStore:
+    """
+    טבלת תזכורות ב-SQLite (WAL) - משותפת לכל ה-workers על אותו שרת.
+    האינדקס (status, due_at) נותן את התזכורות הבאות ב-O(log n) גם עם מיליוני שורות
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS reminders ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " phone_number TEXT NOT NULL,"
+            " text TEXT NOT NULL,"
+            " due_at REAL NOT NULL,"
+            " status TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " claimed_until REAL NOT NULL DEFAULT 0,"
+            " created_at REAL NOT NULL,"
+            " sent_at REAL,"
+            " last_error TEXT)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS reminders_due ON reminders (status, due_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS reminders_phone ON reminders (phone_number, due_at)")
+    
+    def add(self, phone_number: str, text: str, due_at: float) -> int:
+        """שומר תזכורת חדשה. Returns: מזהה התזכורת"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO reminders (phone_number, text, due_at, status, created_at) VALUES (?, ?, ?, ?, ?)",
+                (phone_number, text, due_at, PENDING, time.time()),
+            )
+        return cursor.lastrowid
+    
+    def due_before(self, horizon: float, limit: int) -> List[Tuple[float, int]]:
+        """
+        (due_at, id) של תזכורות שממתינות עד horizon, לפי הסדר. קודם מחזיר
+        לתור תזכורות שנתפסו וה-lease שלהן פג (ה-worker שתפס אותן נפל)
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE reminders SET status = ? WHERE status = ? AND claimed_until < ?",
+                (PENDING, SENDING, now),
+            )
+            return self._conn.execute(
+                "SELECT due_at, id FROM reminders WHERE status = ? AND due_at <= ? ORDER BY due_at LIMIT ?",
+                (PENDING, horizon, limit),
+            ).fetchall()
+    
+    def claim(self, reminder_id: int, lease_seconds: float) -> Optional[Tuple[str, str, float, int]]:
+        """
+        תופס תזכורת שהגיע זמנה - UPDATE אטומי, כך שרק worker אחד מצליח
+        Returns: (phone_number, text, due_at, attempts), או None אם היא כבר נתפסה/נשלחה
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE reminders SET status = ?, claimed_until = ? WHERE id = ? AND status = ? AND due_at <= ?",
+                (SENDING, now + lease_seconds, reminder_id, PENDING, now),
+            )
+            if cursor.rowcount == 0:
+                return None
+            return self._conn.execute(
+                "SELECT phone_number, text, due_at, attempts FROM reminders WHERE id = ?", (reminder_id,),
+            ).fetchone()
+    
+    def extend_lease(self, reminder_id: int, lease_seconds: float) -> bool:
+        """מאריך את ה-lease של תזכורת שבאמצע שליחה. Returns: False אם היא כבר לא נתפסת"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE reminders SET claimed_until = ? WHERE id = ? AND status = ?",
+                (time.time() + lease_seconds, reminder_id, SENDING),
+            )
+        return cursor.rowcount > 0
+    
+    def finish(self, reminder_id: int, status: str, attempts: int,
+               due_at: Optional[float] = None, error: Optional[str] = None):
+        """מעדכן תזכורת שנתפסה: sent, failed, או pending עם מועד ניסיון חדש"""
+        with self._lock:
+            if status == SENT:
+                self._conn.execute(
+                    "UPDATE reminders SET status = ?, attempts = ?, sent_at = ?, last_error = NULL WHERE id = ?",
+                    (SENT, attempts, time.time(), reminder_id),
+                )
+            elif due_at is not None:
+                self._conn.execute(
+                    "UPDATE reminders SET status = ?, attempts = ?, due_at = ?, claimed_until = 0,"
+                    " last_error = ? WHERE id = ?",
+                    (status, attempts, due_at, error, reminder_id),
+                )
+            else:
+                self._conn.execute(
+                    "UPDATE reminders SET status = ?, attempts = ?, claimed_until = 0, last_error = ? WHERE id = ?",
+                    (status, attempts, error, reminder_id),
+                )
+    
+    def list_for(self, phone_number: str, status: Optional[str] = PENDING, limit: int = 20) -> List[Dict]:
+        """התזכורות של המשתמש לפי מועד"""
+        query = "SELECT id, text, due_at, status, attempts, sent_at FROM reminders WHERE phone_number = ?"
+        params: list = [phone_number]
+        if status:
+            query += " AND status = ?"
+            params.append(status)
+        query += " ORDER BY due_at LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [
+            {"id": row[0], "text": row[1], "due_at": row[2], "status": row[3], "attempts": row[4], "sent_at": row[5]}
+            for row in rows
+        ]
+    
+    def count_by_status(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM reminders GROUP BY status").fetchall()
+        counts = dict.fromkeys(STATUSES, 0)
+        counts.update(rows)
+        return counts
+    
+    def next_due(self) -> Optional[float]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT MIN(due_at) FROM reminders WHERE status = ?", (PENDING,),
+            ).fetchone()[0]
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ReminderScheduler:
+    """
+    מתזמן התזכורות של ה-worker: heap של (due_at, id) לכל התזכורות שממתינות
+    עד horizon, ו-task אחד שישן עד התזכורת הבאה (או עד שתזכורת מוקדמת יותר
+    נוספת) ושולח אותה
+    
+    horizon הוא now + window_seconds בטעינה האחרונה - או המועד של השורה
+    האחרונה שנטענה אם החלון הכיל יותר מ-load_batch תזכורות. כל תזכורת ממתינה
+    שמועדה עד horizon נמצאת ב-heap, ותזכורת חדשה נכנסת ל-heap רק אם מועדה
+    עד horizon (את השאר תטען הטעינה הבאה מהאינדקס)
+    """
+    
+    def __init__(self, store: ReminderStore, timezone: tzinfo, window_seconds: float = 3600.0,
+                 refresh_seconds: float = 30.0, load_batch: int = 10_000, lease_seconds: float = 60.0,
+                 max_attempts: int = 5, base_delay: float = 5.0, max_delay: float = 600.0,
+                 concurrency: int = 16):
+        self.store = store
+        self.timezone = timezone
+        self.window_seconds = window_seconds
+        self.refresh_seconds = refresh_seconds
+        self.load_batch = load_batch
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.send: Optional[SendFunc] = None
+        
+        self._heap: List[Tuple[float, int]] = []
+        self._scheduled: Set[int] = set()
+        self._horizon = 0.0
+        self._loaded_at = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._sending: Set[asyncio.Task] = set()
+        self._slots = asyncio.Semaphore(concurrency)
+        
+        # מונים (של התהליך הזה)
+        self.scheduled = 0
+        self.sent = 0
+        self.late = 0
+        self.retried = 0
+        self.failed = 0
+        self.lost_claims = 0
+    
+    def now(self) -> datetime:
+        """הזמן הנוכחי באזור הזמן של התזכורות"""
+        return datetime.now(self.timezone)
+    
+    def parse_time(self, text: str) -> Optional[datetime]:
+        """מפענח מועד שהמשתמש הקליד (ראה parse_reminder_time)"""
+        return parse_reminder_time(text, self.now())
+    
+    def schedule(self, phone_number: str, text: str, due: datetime) -> int:
+        """שומר תזכורת ומכניס אותה ל-heap אם מועדה בחלון הטעון. Returns: מזהה התזכורת"""
+        due_at = due.timestamp()
+        reminder_id = self.store.add(phone_number, text, due_at)
+        self.scheduled += 1
+        self._push(due_at, reminder_id)
+        return reminder_id
+    
+    def _push(self, due_at: float, reminder_id: int):
+        if due_at > self._horizon or reminder_id in self._scheduled:
+            return
+        heapq.heappush(self._heap, (due_at, reminder_id))
+        self._scheduled.add(reminder_id)
+        # התזכורת החדשה היא הבאה בתור - ה-task צריך להתעורר מוקדם יותר
+        if self._wakeup is not None and self._heap[0][1] == reminder_id:
+            self._wakeup.set()
+    
+    def _load(self):
+        """טוען מהאינדקס את כל התזכורות שממתינות עד now + window (כולל כאלה שזמנן עבר)"""
+        now = time.time()
+        horizon = now + self.window_seconds
+        rows = self.store.due_before(horizon, self.load_batch)
+        if len(rows) >= self.load_batch:
+            # יותר תזכורות בחלון ממה שנטען - ה-heap מכסה רק עד האחרונה שנטענה
+            horizon = rows[-1][0]
+        self._horizon = horizon
+        self._loaded_at = now
+        for due_at, reminder_id in rows:
+            if reminder_id not in self._scheduled:
+                heapq.heappush(self._heap, (due_at, reminder_id))
+                self._scheduled.add(reminder_id)
+    
+    # --- task ---
+    
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+    
+    async def start(self, send: SendFunc):
+        """מפעיל את ה-scheduler (נקרא ב-startup) - תזכורות שזמנן עבר בזמן שהשרת היה למטה נשלחות מיד"""
+        if self.running:
+            return
+        self.send = send
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run(), name="reminder-scheduler")
+        logger.info("Reminder scheduler started: %s", self.store.path)
+    
+    async def stop(self):
+        """עוצר את ה-scheduler. תזכורת שבאמצע שליחה חוזרת ל-pending"""
+        if not self.running:
+            return
+        self._task.cancel()
+        tasks = [self._task, *self._sending]
+        for task in self._sending:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        self._sending.clear()
+    
+    async def _run(self):
+        while True:
+            now = time.time()
+            if now - self._loaded_at >= self.refresh_seconds or now >= self._horizon:
+                try:
+                    self._load()
+                except sqlite3.Error as e:
+                    logger.warning("Loading reminders failed: %s", e)
+                    self._loaded_at = now
+            
+            while self._heap and self._heap[0][0] <= now:
+                _, reminder_id = heapq.heappop(self._heap)
+                self._scheduled.discard(reminder_id)
+                await self._slots.acquire()
+                task = asyncio.create_task(self._fire(reminder_id))
+                self._sending.add(task)
+                task.add_done_callback(self._sending.discard)
+            
+            # שינה עד התזכורת הבאה, הטעינה הבאה, או תזכורת מוקדמת יותר שנוספה
+            wake_at = min(self._loaded_at + self.refresh_seconds, self._horizon)
+            if self._heap:
+                wake_at = min(wake_at, self._heap[0][0])
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, wake_at - time.time()))
+            except asyncio.TimeoutError:
+                pass
+    
+    async def _fire(self, reminder_id: int):
+        """תופס את התזכורת ושולח אותה (worker אחר שתפס אותה קודם - מדלגים)"""
+        try:
+            try:
+                claimed = self.store.claim(reminder_id, self.lease_seconds)
+            except sqlite3.Error as e:
+                logger.warning("Claiming reminder %d failed: %s", reminder_id, e)
+                return
+            if claimed is None:
+                self.lost_claims += 1
+                return
+            phone_number, text, due_at, attempts = claimed
+            await self._deliver(reminder_id, phone_number, text, due_at, attempts + 1)
+        finally:
+            self._slots.release()
+    
+    async def _deliver(self, reminder_id: int, phone_number: str, text: str, due_at: float, attempts: int):
+        late = time.time() - due_at
+        message = f"⏰ תזכורת: {text}"
+        if late > 60 and attempts == 1:
+            # נשלחת באיחור (למשל השרת היה למטה במועד) - מציינים את המועד המקורי
+            scheduled = datetime.fromtimestamp(due_at, self.timezone).strftime("%d/%m %H:%M")
+            message += f"\n(נקבעה ל-{scheduled})"
+            self.late += 1
+        try:
+            result = await self._send_leased(reminder_id, phone_number, message)
+        except asyncio.CancelledError:
+            self.store.finish(reminder_id, PENDING, attempts - 1, due_at=due_at)
+            raise
+        except Exception as e:
+            result = {"status": "error", "error": f"{type(e).__name__}: {e}"}
+        
+        if result.get("status") != "error":
+            self.store.finish(reminder_id, SENT, attempts)
+            self.sent += 1
+            logger.info("Sent reminder %d to %s (%.1fs after due)", reminder_id, phone_number, max(0.0, late))
+            return
+        error = result.get("error") or f"HTTP {result.get('status_code')}: {result.get('response_text', '')[:200]}"
+        if attempts >= self.max_attempts:
+            self.store.finish(reminder_id, FAILED, attempts, error=error)
+            self.failed += 1
+            logger.error("Reminder %d to %s failed after %d attempts: %s", reminder_id, phone_number, attempts, error)
+            return
+        retry_at = time.time() + retry_delay(attempts - 1, self.base_delay, self.max_delay)
+        self.store.finish(reminder_id, PENDING, attempts, due_at=retry_at, error=error)
+        self.retried += 1
+        self._push(retry_at, reminder_id)
+        logger.warning("Reminder %d to %s failed (%s), retry %d in %.1fs",
+                       reminder_id, phone_number, error, attempts, retry_at - time.time())
+    
+    async def _send_leased(self, reminder_id: int, phone_number: str, message: str) -> dict:
+        """
+        שולח ומאריך את ה-lease כל חצי lease כל עוד השליחה נמשכת - ניסיונות
+        חוזרים של WhatsAppService (backoff x endpoints x N8N_TIMEOUT) והמתנה
+        במגביל הקצב יכולים להימשך יותר מ-lease אחד, ו-worker אחר היה שולח שוב
+        """
+        send = asyncio.ensure_future(self.send(phone_number, message))
+        try:
+            while True:
+                done, _ = await asyncio.wait({send}, timeout=self.lease_seconds / 2)
+                if done:
+                    return send.result()
+                if not self.store.extend_lease(reminder_id, self.lease_seconds):
+                    logger.warning("Reminder %d lease was lost while sending", reminder_id)
+        finally:
+            send.cancel()
+    
+    def stats(self) -> dict:
+        next_due = self.store.next_due()
+        return {
+            "path": self.store.path,
+            "running": self.running,
+            "timezone": str(self.timezone),
+            "reminders": self.store.count_by_status(),
+            "next_due_in_seconds": round(next_due - time.time(), 3) if next_due else None,
+            "loaded": len(self._heap),
+            "sending": len(self._sending),
+            "scheduled": self.scheduled,
+            "sent": self.sent,
+            "late": self.late,
+            "retried": self.retried,
+            "failed": self.failed,
+            "lost_claims": self.lost_claims,
+        }
+    
+    def close(self):
+        self.store.close()
+
+
+def create_reminder_scheduler() -> ReminderScheduler:
+    """
+    יוצר את מתזמן התזכורות לפי משתני הסביבה:
+        REMINDER_DB_PATH: קובץ ה-SQLite (ברירת מחדל: data/reminders.db)
+        REMINDER_TIMEZONE: אזור הזמן של המועדים שהמשתמשים מקלידים (ברירת מחדל: Asia/Jerusalem)
+        REMINDER_WINDOW_SECONDS: כמה זמן קדימה נטען ל-heap בזיכרון (ברירת מחדל: 3600)
+        REMINDER_REFRESH_SECONDS: כל כמה שניות החלון נטען מחדש מה-DB (ברירת מחדל: 30)
+        REMINDER_LOAD_BATCH: מקסימום תזכורות שנטענות בפעם אחת (ברירת מחדל: 10000)
+        REMINDER_LEASE_SECONDS: אחרי כמה זמן תזכורת שנתפסה ולא נשלחה חוזרת לתור - מוארך כל עוד השליחה נמשכת (ברירת מחדל: 60)
+        REMINDER_MAX_ATTEMPTS: ניסיונות שליחה לפני שתזכורת מסומנת failed (ברירת מחדל: 5)
+        REMINDER_CONCURRENCY: תזכורות שנשלחות במקביל בכל תהליך (ברירת מחדל: 16)
+    """
+    return ReminderScheduler(
+        ReminderStore(env_str("REMINDER_DB_PATH", "data/reminders.db")),
+        load_timezone(env_str("REMINDER_TIMEZONE", "Asia/Jerusalem")),
+        window_seconds=env_float("REMINDER_WINDOW_SECONDS", 3600.0),
+        refresh_seconds=env_float("REMINDER_REFRESH_SECONDS", 30.0),
+        load_batch=env_int("REMINDER_LOAD_BATCH", 10_000),
+        lease_seconds=env_float("REMINDER_LEASE_SECONDS", 60.0),
+        max_attempts=env_int("REMINDER_MAX_ATTEMPTS", 5),
+        concurrency=env_int("REMINDER_CONCURRENCY", 16),
+    )
@@ -0,0 +1,188 @@
+"""
+סידור הודעות לפי מספר טלפון (Per-key Sequencer)
+הודעות של אותו משתמש מעובדות אחת אחרי השנייה לפי סדר ההגעה,
+והודעות של משתמשים שונים מעובדות במקביל
+
+הסידור בתוך התהליך נעשה ב-asyncio.Lock לכל מספר. עם כמה workers ו-backend
+מצב משותף (sqlite / shm) שתי הודעות של אותו מספר יכולות להגיע ל-workers
+שונים - אז נלקחת גם נעילה בין תהליכים (ProcessKeyLock), כך שמעבר מצב אחד
+לא דורס את השני
+"""
+import asyncio
+import errno
+import hashlib
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+from app.config import env_int, env_str
+
+try:
+    import fcntl
+except ImportError:  # Windows - סידור בתוך התהליך בלבד
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class _KeyLock:
+    """נעילה של מפתח יחיד + מונה ממתינים (לפינוי כשהמפתח לא פעיל)"""
+    
+    __slots__ = ("lock", "refs")
+    
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.refs = 0
+
+
+class _SlotHold:
+    """slot שהתהליך נועל בקובץ + כמה coroutines מחזיקות בו"""
+    
+    __slots__ = ("acquired", "refs")
+    
+    def __init__(self, acquired: asyncio.Future):
+        self.acquired = acquired
+        self.refs = 0
+
+
+class ProcessKeyLock:
+    """
+    נעילה בין תהליכים לפי מפתח: lockf על בית אחד בקובץ משותף, לפי hash יציב
+    של המפתח (slots בתים, כך ששני מפתחות חולקים slot רק לעתים רחוקות)
+    
+    נעילות lockf שייכות לתהליך ולא ל-thread, ולכן slot ננעל בקובץ פעם אחת
+    לתהליך ומשותף בין ה-coroutines שמחזיקות בו; הוא משתחרר כשהאחרונה יוצאת.
+    ההמתנה לנעילה נעשית ב-thread כדי לא לחסום את ה-event loop, והנעילה
+    משתחררת אוטומטית כשתהליך מת, כך ש-worker שנהרג לא תוקע אחרים
+    """
+    
+    def __init__(self, path: str, slots: int = 4096):
+        self.path = path
+        self.slots = slots
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._held: Dict[int, _SlotHold] = {}
+        
+        # מונים
+        self.waits = 0
+    
+    def _slot(self, key: str) -> int:
+        """slot יציב בין תהליכים (hash() של Python משתנה בכל תהליך)"""
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "little") % self.slots
+    
+    def _lock(self, slot: int):
+        """נעילה חוסמת של slot (רץ ב-thread)"""
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, slot)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EACCES, errno.EAGAIN):
+                raise
+        self.waits += 1
+        while True:
+            try:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, slot)
+                return
+            except OSError as e:
+                # הקרנל מזהה "deadlock" ברמת תהליך (תהליך אחד מחזיק slot וממתין לאחר
+                # בזמן שתהליך שני עושה הפוך) - אבל coroutine לא מחזיקה שני slots,
+                # כך שהנעילה תשתחרר; מנסים שוב
+                if e.errno != errno.EDEADLK:
+                    raise
+                time.sleep(0.005)
+    
+    def _release(self, slot: int, entry: _SlotHold):
+        """משחרר slot כשאין מי שמחזיק בו והנעילה בקובץ כבר התקבלה (או נכשלה)"""
+        if entry.refs or self._held.get(slot) is not entry or not entry.acquired.done():
+            return
+        del self._held[slot]
+        if not entry.acquired.cancelled() and entry.acquired.exception() is None:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, slot)
+    
+    @asynccontextmanager
+    async def hold(self, key: str) -> AsyncIterator[None]:
+        """מחזיק את הנעילה של המפתח (בין כל התהליכים) לאורך הבלוק"""
+        slot = self._slot(key)
+        entry = self._held.get(slot)
+        if entry is None:
+            entry = _SlotHold(asyncio.ensure_future(asyncio.to_thread(self._lock, slot)))
+            self._held[slot] = entry
+            # אם כל המחזיקים בוטלו לפני שהנעילה התקבלה - שחרור כשהיא תתקבל
+            entry.acquired.add_done_callback(lambda _: self._release(slot, entry))
+        entry.refs += 1
+        try:
+            await asyncio.shield(entry.acquired)
+            yield
+        finally:
+            entry.refs -= 1
+            self._release(slot, entry)
+    
+    def stats(self) -> dict:
+        return {"path": self.path, "slots": self.slots, "held": len(self._held), "waits": self.waits}
+    
+    def close(self):
+        os.close(self._fd)
+
+
+class KeyedSequencer:
+    """
+    נעילות async לפי מפתח
+    
+    asyncio.Lock משחרר ממתינים בסדר FIFO, ולכן הודעות של אותו מפתח
+    רצות בסדר שבו קראו ל-hold. הנעילה נמחקת ברגע שאין מי שמחזיק או
+    ממתין לה, כך שהזיכרון תלוי רק במספר המשתמשים הפעילים כרגע
+    
+    process_lock: נעילה בין תהליכים שנלקחת אחרי הנעילה המקומית (כש-backend
+    המצב משותף בין workers)
+    """
+    
+    def __init__(self):
+        # Dictionary: key -> _KeyLock (רק מפתחות פעילים)
+        self._locks: Dict[str, _KeyLock] = {}
+        self.process_lock: Optional[ProcessKeyLock] = None
+    
+    @asynccontextmanager
+    async def hold(self, key: str) -> AsyncIterator[None]:
+        """מחזיק את הנעילה של המפתח לאורך הבלוק"""
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = _KeyLock()
+            self._locks[key] = entry
+        entry.refs += 1
+        try:
+            async with entry.lock:
+                if self.process_lock is None:
+                    yield
+                else:
+                    async with self.process_lock.hold(key):
+                        yield
+        finally:
+            entry.refs -= 1
+            if entry.refs == 0:
+                del self._locks[key]
+    
+    def active_keys(self) -> int:
+        """מספר המפתחות שיש להם הודעה בעיבוד או בהמתנה"""
+        return len(self._locks)
+
+
+def create_process_key_lock() -> Optional[ProcessKeyLock]:
+    """
+    יוצר את הנעילה בין תהליכים לפי משתני הסביבה (None בלי fcntl):
+        SEQUENCER_LOCK_PATH: קובץ הנעילות המשותף לכל ה-workers (ברירת מחדל: data/phones.lock)
+        SEQUENCER_LOCK_SLOTS: מספר ה-slots (בתים) בקובץ (ברירת מחדל: 4096)
+    """
+    if fcntl is None:
+        logger.warning("fcntl is not available - messages of one phone are ordered only within a worker")
+        return None
+    return ProcessKeyLock(env_str("SEQUENCER_LOCK_PATH", "data/phones.lock"),
+                          slots=env_int("SEQUENCER_LOCK_SLOTS", 4096))
+
+
+# יצירת instance גלובלי - מפתח לפי מספר טלפון
+phone_sequencer = KeyedSequencer()
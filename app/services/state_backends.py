@@ -0,0 +1,49 @@
+"""
+בחירת backend למצב השיחה לפי משתני הסביבה
+"""
+from app.config import env_float, env_int, env_str
+from app.services.state_journal import JournaledStateStore
+from app.services.state_shm import SharedMemoryStateStore
+from app.services.state_store import InMemoryStateStore, SQLiteStateStore, StateStore
+
+
+def create_state_store() -> StateStore:
+    """
+    יוצר את ה-backend לפי משתני הסביבה:
+        STATE_BACKEND: memory (ברירת מחדל), sqlite, journal או shm
+        STATE_DB_PATH: נתיב קובץ ה-SQLite (ברירת מחדל: data/state.db)
+        STATE_JOURNAL_DIR: תיקיית היומן וה-snapshots של journal (ברירת מחדל: data/journal)
+        STATE_JOURNAL_FLUSH_MS: כל כמה מילישניות מתבצע fsync ליומן (ברירת מחדל: 20)
+        STATE_SNAPSHOT_EVERY: אחרי כמה רשומות ביומן נכתב snapshot (ברירת מחדל: 10000)
+        STATE_JOURNAL_MAX_PENDING: כמה רשומות שלא נכתבו (דיסק תקול) לפני ש-set נכשל (ברירת מחדל: 100000)
+        STATE_SHM_PATH: הקובץ הממופה של shm (ברירת מחדל: data/state.shm; ב-/dev/shm בלי כתיבה לדיסק)
+        STATE_SHM_SESSIONS: מספר ה-slots לסשנים ב-shm (ברירת מחדל: 65536)
+        STATE_SHM_DATA_MB: מקום לנתוני הסשנים ב-shm במגה-בייט (ברירת מחדל: 64)
+        STATE_SHM_STRIPES: מספר ה-stripes (נעילות נפרדות) ב-shm (ברירת מחדל: 64)
+        STATE_SHM_DEDUP_SIZE: כמה מזהי הודעות טבעת הכפילויות של shm זוכרת (ברירת מחדל: 262144)
+        SESSION_IDLE_TTL: אחרי כמה שניות בלי הודעה סשן נמחק (ברירת מחדל: 86400, 0 = לעולם לא)
+    """
+    backend = env_str("STATE_BACKEND", "memory").lower()
+    idle_ttl = env_float("SESSION_IDLE_TTL", 86_400.0)
+    if backend == "memory":
+        return InMemoryStateStore(idle_ttl)
+    if backend == "sqlite":
+        return SQLiteStateStore(env_str("STATE_DB_PATH", "data/state.db"), idle_ttl)
+    if backend == "journal":
+        return JournaledStateStore(
+            env_str("STATE_JOURNAL_DIR", "data/journal"),
+            idle_ttl,
+            flush_interval=env_float("STATE_JOURNAL_FLUSH_MS", 20.0) / 1000,
+            snapshot_every=env_int("STATE_SNAPSHOT_EVERY", 10_000),
+            max_pending=env_int("STATE_JOURNAL_MAX_PENDING", 100_000),
+        )
+    if backend == "shm":
+        return SharedMemoryStateStore(
+            env_str("STATE_SHM_PATH", "data/state.shm"),
+            idle_ttl,
+            sessions=env_int("STATE_SHM_SESSIONS", 65_536),
+            data_bytes=env_int("STATE_SHM_DATA_MB", 64) * 1024 * 1024,
+            stripes=env_int("STATE_SHM_STRIPES", 64),
+            dedup_size=env_int("STATE_SHM_DEDUP_SIZE", 262_144),
+        )
+    raise ValueError(f"Unknown STATE_BACKEND: {backend!r} (expected 'memory', 'sqlite', 'journal' or 'shm')")
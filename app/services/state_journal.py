@@ -0,0 +1,368 @@
+"""
+יומן כתיבה מראש (Write-Ahead Journal) למצב השיחה
+כל מעבר מצב נכתב ליומן append-only, thread ברקע מבצע fsync אחד לכל קבוצת
+כתיבות (group commit), ומדי פעם נכתב snapshot דחוס והיומן הישן נמחק.
+בעלייה ה-worker טוען את ה-snapshot האחרון ומריץ מחדש את זנב היומן,
+כך שמשתמש שהיה באמצע זרימה ממשיך מאותו שלב גם אחרי restart / deploy
+"""
+import glob
+import heapq
+import logging
+import os
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from app.serialization import dumps, loads
+from app.services.state_store import InMemoryStateStore, SessionRecord
+
+try:
+    import fcntl
+except ImportError:  # Windows - בלי נעילת תיקייה
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+_SEGMENT_RE = re.compile(r"(\d+)\.(?:log|json)$")
+
+
+def _encode(entry: list) -> bytes:
+    """
+    שורת יומן/snapshot: [phone, state, data, expires_at (wall clock, 0 = ללא)]
+    או [phone] למחיקה
+    """
+    return dumps(entry) + b"\n"
+
+
+def _fsync_dir(path: str):
+    """fsync לתיקייה - כדי ש-rename / יצירת קובץ ישרדו נפילת חשמל"""
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class JournaledStateStore(InMemoryStateStore):
+    """
+    אחסון בזיכרון עם יומן מקומי לשחזור אחרי restart
+    
+    כתיבה ל-set/delete רק מוסיפה שורה לבאפר; thread ה-writer כותב ומבצע
+    fsync אחת ל-flush_interval שניות, כך שהבקשה לא מחכה לדיסק. חלון
+    האובדן בקריסה הוא לכל היותר flush_interval. אחרי snapshot_every
+    רשומות ביומן נכתב snapshot של כל הסשנים החיים ומתחיל segment חדש.
+    היומן שייך לתהליך אחד - מתאים ל-worker יחיד (כמו memory)
+    
+    שגיאת דיסק (מלא, EIO) לא עוצרת את ה-writer: הקבוצה חוזרת לראש הבאפר
+    ונכתבת שוב אחרי המתנה הולכת וגדלה. אם הבאפר מגיע ל-max_pending רשומות
+    set/delete נכשלים ב-RuntimeError במקום לצבור זיכרון בלי גבול
+    """
+    
+    name = "journal"
+    
+    def __init__(self, directory: str, idle_ttl: float = 0.0,
+                 flush_interval: float = 0.02, snapshot_every: int = 10_000,
+                 max_pending: int = 100_000):
+        super().__init__(idle_ttl)
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.snapshot_every = snapshot_every
+        self.max_pending = max_pending
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = self._acquire_directory_lock()
+        
+        # RLock - set() קורא ל-expire() שגם הוא נועל
+        self._lock = threading.RLock()
+        self._wakeup = threading.Condition(self._lock)
+        self._buffer: List[bytes] = []
+        self._entries_since_snapshot = 0
+        self._closed = False
+        # אחרי כתיבה שנכשלה ייתכן שנשארה שורה חתוכה בסוף היומן
+        self._partial_line = False
+        
+        # מונים
+        self.fsyncs = 0
+        self.snapshots = 0
+        self.restore_ms = 0.0
+        self.write_errors = 0
+        self.last_error: Optional[str] = None
+        
+        self._segment = self._load()
+        self._journal = open(self._segment_path(self._segment), "ab")
+        self._terminate_partial_line()
+        self._writer = threading.Thread(target=self._run_writer, name="state-journal", daemon=True)
+        self._writer.start()
+    
+    # --- קבצים ---
+    
+    def _acquire_directory_lock(self):
+        """נעילה בלעדית על התיקייה - שני תהליכים לא כותבים לאותו יומן"""
+        lock_file = open(os.path.join(self.directory, "LOCK"), "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                raise RuntimeError(
+                    f"State journal {self.directory!r} is used by another process "
+                    "(the journal backend supports a single worker)"
+                )
+        return lock_file
+    
+    def _terminate_partial_line(self):
+        """אם היומן נקטע באמצע שורה (קריסה), השורה הבאה לא תודבק אליה"""
+        if self._journal.tell() == 0:
+            return
+        with open(self._journal.name, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                self._journal.write(b"\n")
+                self._journal.flush()
+    
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"journal-{segment:06d}.log")
+    
+    def _snapshot_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"snapshot-{segment:06d}.json")
+    
+    def _list(self, prefix: str) -> List[Tuple[int, str]]:
+        """קבצי segment/snapshot ממוינים לפי המספר שלהם"""
+        found = []
+        for path in glob.glob(os.path.join(self.directory, prefix + "-*")):
+            match = _SEGMENT_RE.search(path)
+            if match:
+                found.append((int(match.group(1)), path))
+        return sorted(found)
+    
+    # --- שחזור ---
+    
+    @staticmethod
+    def _replay(path: str, latest: Dict[str, Optional[list]]) -> int:
+        """
+        קורא קובץ לתוך latest (הרשומה האחרונה לכל מספר, None = נמחק)
+        
+        כל הקובץ מפוענח בקריאת loads אחת (כמערך) - מהיר פי כמה מפענוח
+        שורה-שורה. אם זה נכשל (שורה אחרונה חתוכה בקריסה באמצע כתיבה) עוברים
+        לפענוח שורה-שורה ומדלגים על השורות הפגומות
+        """
+        with open(path, "rb") as f:
+            lines = f.read().splitlines()
+        try:
+            entries = loads(b"[" + b",".join(lines) + b"]")
+        except ValueError:
+            entries = []
+            for line in lines:
+                try:
+                    entries.append(loads(line))
+                except ValueError:
+                    logger.warning("Skipping corrupt state journal line in %s", path)
+        for entry in entries:
+            latest[entry[0]] = entry if len(entry) > 1 else None
+        return len(entries)
+    
+    def _load(self) -> int:
+        """טוען snapshot אחרון + segments שאחריו. Returns: מספר ה-segment לכתיבה"""
+        started = time.perf_counter()
+        latest: Dict[str, Optional[list]] = {}
+        
+        snapshots = self._list("snapshot")
+        base = 0
+        if snapshots:
+            base, path = snapshots[-1]
+            self._replay(path, latest)
+        
+        replayed = 0
+        segment = base
+        for number, path in self._list("journal"):
+            if number >= base:
+                replayed += self._replay(path, latest)
+                segment = number
+        self._entries_since_snapshot = replayed
+        
+        # בנייה אחת של הרשומות וה-heap בסוף (ולא לכל שורה ביומן)
+        wall_now, mono_now = time.time(), time.monotonic()
+        records = self._records
+        for phone_number, entry in latest.items():
+            if entry is None:
+                continue
+            _, state, data, expires_wall = entry
+            expires_at = 0.0
+            if self.idle_ttl:
+                # רשומה בלי תפוגה נכתבה כשהתפוגה הייתה כבויה - מקבלת TTL מלא
+                remaining = expires_wall - wall_now if expires_wall else self.idle_ttl
+                if remaining <= 0:
+                    continue
+                expires_at = mono_now + remaining
+            records[phone_number] = SessionRecord(state, data or None, expires_at)
+        if self.idle_ttl:
+            self._expiry_heap = [(record.expires_at, phone) for phone, record in records.items()]
+            heapq.heapify(self._expiry_heap)
+        self._recount()
+        
+        self.restore_ms = (time.perf_counter() - started) * 1000
+        logger.info("Restored %d sessions from %s in %.1f ms (%d journal entries)",
+                    len(records), self.directory, self.restore_ms, replayed)
+        return segment
+    
+    # --- כתיבה ---
+    
+    def _check_writable(self):
+        """
+        נקרא כשה-lock מוחזק, לפני שינוי הזיכרון
+        Raises: RuntimeError אם ה-writer נכשל והבאפר מלא
+        """
+        if len(self._buffer) >= self.max_pending:
+            raise RuntimeError(
+                f"State journal {self.directory!r} is not writable ({self.last_error}); "
+                f"{len(self._buffer)} entries are pending"
+            )
+    
+    def _append(self, entry: list):
+        """מוסיף רשומה לבאפר (נקרא כשה-lock מוחזק)"""
+        self._buffer.append(_encode(entry))
+        self._entries_since_snapshot += 1
+        if self._entries_since_snapshot >= self.snapshot_every:
+            self._wakeup.notify()
+    
+    def set(self, phone_number: str, state: str, data: Dict):
+        with self._lock:
+            self._check_writable()
+            super().set(phone_number, state, data)
+            expires_wall = time.time() + self.idle_ttl if self.idle_ttl else 0
+            self._append([phone_number, state, data or None, expires_wall])
+    
+    def delete(self, phone_number: str):
+        with self._lock:
+            if phone_number not in self._records:
+                return
+            self._check_writable()
+            super().delete(phone_number)
+            self._append([phone_number])
+    
+    def expire(self, now: Optional[float] = None) -> int:
+        # פקיעה לא נכתבת ליומן - בשחזור רשומה שפגה מדולגת לפי זמן התפוגה שלה
+        with self._lock:
+            return super().expire(now)
+    
+    def _run_writer(self):
+        """thread ה-writer: group commit אחד לכל flush_interval, ו-snapshot לפי הצורך"""
+        failures = 0
+        while True:
+            with self._lock:
+                if not self._closed:
+                    self._wakeup.wait(min(self.flush_interval * 2 ** failures, 5.0))
+                batch, self._buffer = self._buffer, []
+                closed = self._closed
+                snapshot = None
+                if closed or self._entries_since_snapshot >= self.snapshot_every:
+                    snapshot = self._take_snapshot()
+            try:
+                if batch:
+                    self._write_batch(batch)
+                    batch = []
+                if snapshot is not None:
+                    self._write_snapshot(*snapshot)
+            except Exception as e:
+                failures += 1
+                with self._lock:
+                    # הקבוצה חוזרת לראש הבאפר, לפני מה שנוסף בינתיים
+                    self._buffer[:0] = batch
+                    self.write_errors += 1
+                    self.last_error = f"{type(e).__name__}: {e}"
+                    pending = len(self._buffer)
+                logger.error("State journal write failed in %s (%s); %d entries pending",
+                             self.directory, self.last_error, pending)
+                if closed:
+                    return
+                continue
+            if failures:
+                logger.info("State journal %s is writable again after %d failed attempts",
+                            self.directory, failures)
+                failures = 0
+            if closed:
+                return
+    
+    def _write_batch(self, batch: List[bytes]):
+        """כותב קבוצה ליומן ומבצע fsync אחד"""
+        if self._partial_line:
+            self._journal.write(b"\n")
+        self._partial_line = True
+        self._journal.write(b"".join(batch))
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._partial_line = False
+        self.fsyncs += 1
+    
+    def _take_snapshot(self) -> Tuple[int, list]:
+        """
+        מצלם את הסשנים ופותח segment חדש (נקרא כשה-lock מוחזק)
+        ה-snapshot מכסה את כל ה-segments שלפני ה-segment החדש. רק ההעתקה
+        נעשית תחת ה-lock - הקידוד נעשה אחר כך (data מוחלף ולא משתנה במקום)
+        """
+        records = [(phone_number, record.state, record.data, record.expires_at)
+                   for phone_number, record in self._records.items()]
+        self._segment += 1
+        self._entries_since_snapshot = 0
+        return self._segment, records
+    
+    def _write_snapshot(self, segment: int, records: list):
+        """כותב snapshot לקובץ זמני, מחליף באטומיות ומוחק קבצים ישנים"""
+        wall_now, mono_now = time.time(), time.monotonic()
+        lines = []
+        for phone_number, state, data, expires_at in records:
+            expires_wall = wall_now + (expires_at - mono_now) if self.idle_ttl else 0
+            lines.append(_encode([phone_number, state, data, expires_wall]))
+        
+        # הבאפר של ה-segment הקודם כבר נכתב - מעבר ל-segment החדש
+        old_journal = self._journal
+        self._journal = open(self._segment_path(segment), "ab")
+        old_journal.close()
+        
+        path = self._snapshot_path(segment)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(b"".join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        _fsync_dir(self.directory)
+        self.snapshots += 1
+        
+        for number, old_path in self._list("snapshot") + self._list("journal"):
+            if number < segment:
+                os.remove(old_path)
+        logger.debug("Wrote state snapshot %s (%d sessions)", path, len(lines))
+    
+    def close(self):
+        """כותב את מה שבבאפר ו-snapshot אחרון (כדי שהעלייה הבאה תהיה מהירה)"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._wakeup.notify()
+        self._writer.join()
+        self._journal.close()
+        self._lock_file.close()
+    
+    def count_by_state(self) -> Dict[str, int]:
+        with self._lock:
+            return super().count_by_state()
+    
+    def stats(self) -> dict:
+        with self._lock:
+            stats = super().stats()
+            stats.update({
+                "journal_dir": self.directory,
+                "segment": self._segment,
+                "pending_entries": len(self._buffer),
+                "entries_since_snapshot": self._entries_since_snapshot,
+                "fsyncs": self.fsyncs,
+                "snapshots": self.snapshots,
+                "restore_ms": round(self.restore_ms, 3),
+                "write_errors": self.write_errors,
+                "last_error": self.last_error,
+            })
+        return stats
@@ -0,0 +1,565 @@
+"""
+מצב שיחה בזיכרון משותף (Shared-Memory State Store)
+קובץ ממופה (mmap) שכל ה-workers על אותו שרת פותחים: טבלת hash עם מספר
+קבוע של slots (טלפון -> מצב + מיקום הנתונים), ערימת בלוקים לנתונים וטבעת
+של מזהי הודעות לסינון כפילויות. קריאה וכתיבה הן גישה לזיכרון ונעילת
+fcntl על טווח בתים של ה-stripe, בלי SQL, בלי רשת ובלי שירות חיצוני
+"""
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from app.serialization import dumps, loads
+from app.services.state_store import StateRecord, StateStore
+
+try:
+    import fcntl
+except ImportError:  # Windows - אין נעילות טווח בין תהליכים
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"WABSHM01"
+VERSION = 1
+
+# כותרת הקובץ: magic, version, stripes, slots/stripe, blocks/stripe, block size,
+# dedup buckets/stripe, dedup ways, created_at
+_HEADER = struct.Struct("<8sIIIIIIId")
+HEADER_SIZE = 4096
+# כותרת stripe: ראש רשימת הבלוקים הפנויים, הבלוק הבא שלא נוצל, סשנים, בלוקים פנויים
+_STRIPE = struct.Struct("<IIII")
+STRIPE_HEADER_SIZE = 64
+# slot: status, אורך המפתח, אורך המצב, hash, updated_at (wall clock), הבלוק הראשון,
+# אורך הנתונים, המפתח, המצב
+_SLOT = struct.Struct("<BBBxIdII32s40s")
+MAX_KEY_LENGTH = 32
+MAX_STATE_LENGTH = 40
+# בלוק נתונים: הבלוק הבא בשרשרת + payload
+_NEXT = struct.Struct("<I")
+BLOCK_SIZE = 256
+NO_BLOCK = 0xFFFFFFFF
+# טבעת הכפילויות: bucket = מיקום הכתיבה הבא + ways כניסות של (hash, expires_at)
+_CURSOR = struct.Struct("<I")
+_ENTRY = struct.Struct("<Qd")
+DEDUP_WAYS = 8
+DEDUP_BUCKET_SIZE = 16 + DEDUP_WAYS * _ENTRY.size
+
+EMPTY = 0
+USED = 1
+
+# בתים (מעבר לסוף הקובץ) שמשמשים רק לנעילות fcntl
+_INIT_LOCK = 1 << 40
+_USERS_LOCK = _INIT_LOCK + 1
+_STRIPE_LOCKS = _INIT_LOCK + 16
+
+
+def _hash(key: str) -> int:
+    """hash יציב בין תהליכים (hash() של Python משתנה בכל תהליך)"""
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class _StripeLock:
+    """
+    נעילה של stripe: threading.Lock בין threads של התהליך, ו-fcntl על בית
+    אחד בין תהליכים (נעילות fcntl שייכות לתהליך, לכן צריך את שתיהן).
+    נעילת fcntl משתחררת אוטומטית כשתהליך מת, כך ש-worker שנהרג לא תוקע אחרים
+    """
+    
+    __slots__ = ("fd", "offset", "_lock")
+    
+    def __init__(self, fd: int, offset: int):
+        self.fd = fd
+        self.offset = offset
+        self._lock = threading.Lock()
+    
+    def __enter__(self):
+        self._lock.acquire()
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, self.offset)
+        except BaseException:
+            self._lock.release()
+            raise
+    
+    def __exit__(self, *exc):
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, self.offset)
+        finally:
+            self._lock.release()
+
+
+class SharedMemoryStateStore(StateStore):
+    """
+    אחסון בקובץ ממופה - משותף לכל ה-workers על אותו שרת, במהירות של זיכרון
+    
+    הקובץ מחולק ל-stripes, וכל מפתח שייך ל-stripe אחד לפי ה-hash שלו. כל
+    stripe הוא טבלת hash עצמאית (linear probing בתוך ה-stripe, מחיקה בהזזה
+    לאחור - בלי tombstones) עם ערימת בלוקים משלו לנתונים, ונעילה משלו - כך
+    ש-workers שמטפלים במספרים שונים כמעט אף פעם לא מחכים זה לזה
+    
+    נתונים חדשים נכתבים לבלוקים חדשים לפני שה-slot מצביע עליהם, כך ש-worker
+    שנהרג באמצע כתיבה משאיר לכל היותר בלוקים יתומים. ה-worker הראשון שמתחבר
+    (אחרי שכל ה-workers ירדו) בונה את הטבלאות מחדש ומחזיר אותם. מופע אחד לכל
+    תהליך - נעילות fcntl שייכות לתהליך, וסגירת מופע שני על אותו קובץ הייתה
+    משחררת גם את הנעילות של הראשון
+    """
+    
+    name = "shm"
+    shared = True
+    
+    def __init__(self, path: str, idle_ttl: float = 0.0, sessions: int = 65_536,
+                 data_bytes: int = 64 * 1024 * 1024, stripes: int = 64, dedup_size: int = 262_144):
+        if fcntl is None:
+            raise RuntimeError("STATE_BACKEND=shm needs fcntl byte-range locks (Linux / macOS)")
+        self.path = path
+        self.idle_ttl = idle_ttl
+        self.stripes = stripes
+        self.slots_per_stripe = max(16, -(-sessions // stripes))
+        self.blocks_per_stripe = max(16, data_bytes // stripes // BLOCK_SIZE)
+        self.dedup_buckets = max(1, -(-dedup_size // (DEDUP_WAYS * stripes)))
+        self.payload_size = BLOCK_SIZE - _NEXT.size
+        
+        self.slots_offset = STRIPE_HEADER_SIZE
+        self.blocks_offset = self.slots_offset + self.slots_per_stripe * _SLOT.size
+        self.stripe_size = self.blocks_offset + self.blocks_per_stripe * BLOCK_SIZE
+        self.dedup_offset = HEADER_SIZE + stripes * self.stripe_size
+        self.dedup_stripe_size = self.dedup_buckets * DEDUP_BUCKET_SIZE
+        self.size = self.dedup_offset + stripes * self.dedup_stripe_size
+        
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._mm: Optional[mmap.mmap] = None
+        try:
+            self._attach()
+        except BaseException:
+            os.close(self._fd)
+            raise
+        self._locks = [_StripeLock(self._fd, _STRIPE_LOCKS + i) for i in range(stripes)]
+        self._dedup_locks = [_StripeLock(self._fd, _STRIPE_LOCKS + stripes + i) for i in range(stripes)]
+        
+        # מונים של התהליך
+        self.expired = 0
+        self.dedup_evicted = 0
+    
+    # --- חיבור לקובץ ---
+    
+    def _layout(self) -> tuple:
+        return (MAGIC, VERSION, self.stripes, self.slots_per_stripe, self.blocks_per_stripe,
+                BLOCK_SIZE, self.dedup_buckets, DEDUP_WAYS)
+    
+    def _attach(self):
+        """
+        ממפה את הקובץ. תהליך שמתחבר כשאף worker אחר לא מחובר (נעילת USERS
+        בלעדית מצליחה) יוצר את הקובץ, או בונה מחדש קובץ קיים עם אותו מבנה;
+        כל תהליך מחזיק נעילה משותפת על USERS כל עוד הוא מחובר
+        """
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, _INIT_LOCK)
+        try:
+            try:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, _USERS_LOCK)
+                alone = True
+            except OSError:
+                alone = False
+            matches = self._header_matches()
+            if not matches:
+                if not alone:
+                    raise RuntimeError(
+                        f"Shared state file {self.path!r} is in use with a different layout "
+                        "(STATE_SHM_* settings) - stop all workers or use another STATE_SHM_PATH"
+                    )
+                if os.fstat(self._fd).st_size:
+                    logger.warning("Shared state file %s has a different layout, recreating it", self.path)
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, self.size)
+            self._mm = mmap.mmap(self._fd, self.size)
+            if not matches:
+                self._initialize()
+            elif alone:
+                self._recover()
+            fcntl.lockf(self._fd, fcntl.LOCK_SH, 1, _USERS_LOCK)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, _INIT_LOCK)
+    
+    def _header_matches(self) -> bool:
+        if os.fstat(self._fd).st_size != self.size:
+            return False
+        header = os.pread(self._fd, _HEADER.size, 0)
+        return len(header) == _HEADER.size and _HEADER.unpack(header)[:-1] == self._layout()
+    
+    def _initialize(self):
+        _HEADER.pack_into(self._mm, 0, *self._layout(), time.time())
+        for stripe in range(self.stripes):
+            _STRIPE.pack_into(self._mm, self._stripe_base(stripe), NO_BLOCK, 0, 0, 0)
+        logger.info("Created shared state file %s (%.1f MB, %d session slots)",
+                    self.path, self.size / 1e6, self.stripes * self.slots_per_stripe)
+    
+    def _recover(self):
+        """
+        בונה כל stripe מחדש מהרשומות החיות: משמיט רשומות שפגו, כפולות או
+        עם שרשרת פגומה (worker שנהרג באמצע כתיבה), ובונה את רשימת הבלוקים הפנויים
+        """
+        started = time.perf_counter()
+        cutoff = self._cutoff(time.time())
+        kept = dropped = 0
+        for stripe in range(self.stripes):
+            entries = {}
+            for index in range(self.slots_per_stripe):
+                slot = _SLOT.unpack_from(self._mm, self._slot_offset(stripe, index))
+                if slot[0] != USED:
+                    continue
+                key = slot[7][:slot[1]]
+                chain = self._chain(stripe, slot[5], slot[6])
+                if key in entries or chain is None or slot[4] <= cutoff:
+                    dropped += 1
+                    continue
+                entries[key] = (slot, chain)
+            
+            base = self._stripe_base(stripe)
+            self._mm[base + self.slots_offset:base + self.blocks_offset] = bytes(self.blocks_offset - self.slots_offset)
+            used_blocks = set()
+            for slot, chain in entries.values():
+                index = self._probe(stripe, slot[3], slot[7][:slot[1]])[0]
+                _SLOT.pack_into(self._mm, self._slot_offset(stripe, index), *slot)
+                used_blocks.update(chain)
+            next_unused = _STRIPE.unpack_from(self._mm, base)[1]
+            free_head, free_count = NO_BLOCK, 0
+            for block in range(next_unused - 1, -1, -1):
+                if block not in used_blocks:
+                    _NEXT.pack_into(self._mm, self._block_offset(stripe, block), free_head)
+                    free_head = block
+                    free_count += 1
+            _STRIPE.pack_into(self._mm, base, free_head, next_unused, len(entries), free_count)
+            kept += len(entries)
+        logger.info("Shared state file %s: recovered %d sessions (%d dropped) in %.1f ms",
+                    self.path, kept, dropped, (time.perf_counter() - started) * 1000)
+    
+    # --- מבנה ---
+    
+    def _stripe_base(self, stripe: int) -> int:
+        return HEADER_SIZE + stripe * self.stripe_size
+    
+    def _slot_offset(self, stripe: int, index: int) -> int:
+        return self._stripe_base(stripe) + self.slots_offset + index * _SLOT.size
+    
+    def _block_offset(self, stripe: int, block: int) -> int:
+        return self._stripe_base(stripe) + self.blocks_offset + block * BLOCK_SIZE
+    
+    def _locate(self, key: str) -> Tuple[int, int, bytes]:
+        """(stripe, hash בתוך ה-stripe, המפתח כ-bytes)"""
+        encoded = key.encode("utf-8")
+        if len(encoded) > MAX_KEY_LENGTH:
+            raise ValueError(f"Key longer than {MAX_KEY_LENGTH} bytes: {key!r}")
+        value = _hash(key)
+        return value % self.stripes, (value // self.stripes) & 0xFFFFFFFF, encoded
+    
+    def _cutoff(self, now: float) -> float:
+        """רשומה שעודכנה לפני הזמן הזה פגה (או -1 כשאין תפוגה)"""
+        return now - self.idle_ttl if self.idle_ttl else -1.0
+    
+    # --- טבלת ה-hash (נקרא כשנעילת ה-stripe מוחזקת) ---
+    
+    def _probe(self, stripe: int, slot_hash: int, key: bytes) -> Tuple[Optional[int], bool]:
+        """
+        מחפש את המפתח מה-slot הבית שלו ועד slot ריק
+        Returns: (index, found) - ה-slot של המפתח, או ה-slot הריק שבו ייכנס (None אם ה-stripe מלא)
+        """
+        mm = self._mm
+        index = slot_hash % self.slots_per_stripe
+        for _ in range(self.slots_per_stripe):
+            offset = self._slot_offset(stripe, index)
+            status, key_length, _, stored_hash = struct.unpack_from("<BBBxI", mm, offset)
+            if status == EMPTY:
+                return index, False
+            if stored_hash == slot_hash and key_length == len(key):
+                start = offset + 24
+                if mm[start:start + key_length] == key:
+                    return index, True
+            index = (index + 1) % self.slots_per_stripe
+        return None, False
+    
+    def _remove(self, stripe: int, index: int):
+        """
+        מוחק slot ומזיז אחורה את הרשומות שאחריו באותו רצף (backward shift),
+        כך שחיפוש אף פעם לא נעצר על חור ואין tombstones שמאטים את הטבלה
+        """
+        mm = self._mm
+        slots = self.slots_per_stripe
+        hole = index
+        current = index
+        while True:
+            current = (current + 1) % slots
+            offset = self._slot_offset(stripe, current)
+            status, _, _, stored_hash = struct.unpack_from("<BBBxI", mm, offset)
+            if status == EMPTY:
+                break
+            home = stored_hash % slots
+            # הרשומה נשארת אם הבית שלה נמצא (במעגל) בין החור לבין המיקום שלה
+            if (hole < current and hole < home <= current) or (hole > current and (home > hole or home <= current)):
+                continue
+            hole_offset = self._slot_offset(stripe, hole)
+            mm[hole_offset:hole_offset + _SLOT.size] = mm[offset:offset + _SLOT.size]
+            hole = current
+        hole_offset = self._slot_offset(stripe, hole)
+        mm[hole_offset:hole_offset + _SLOT.size] = bytes(_SLOT.size)
+        base = self._stripe_base(stripe)
+        free_head, next_unused, count, free_count = _STRIPE.unpack_from(mm, base)
+        _STRIPE.pack_into(mm, base, free_head, next_unused, count - 1, free_count)
+    
+    def _chain(self, stripe: int, first: int, length: int) -> Optional[List[int]]:
+        """הבלוקים של הנתונים לפי הסדר, או None אם השרשרת פגומה"""
+        needed = -(-length // self.payload_size)
+        blocks = []
+        block = first
+        for _ in range(needed):
+            if block >= self.blocks_per_stripe or block in blocks:
+                return None
+            blocks.append(block)
+            block = _NEXT.unpack_from(self._mm, self._block_offset(stripe, block))[0]
+        return blocks
+    
+    def _read(self, stripe: int, first: int, length: int) -> bytes:
+        mm = self._mm
+        parts = []
+        block = first
+        remaining = length
+        while remaining > 0:
+            offset = self._block_offset(stripe, block)
+            block = _NEXT.unpack_from(mm, offset)[0]
+            chunk = min(remaining, self.payload_size)
+            parts.append(mm[offset + _NEXT.size:offset + _NEXT.size + chunk])
+            remaining -= chunk
+        return b"".join(parts)
+    
+    def _write(self, stripe: int, data: bytes) -> Optional[int]:
+        """
+        כותב את הנתונים לבלוקים חדשים (מהרשימה הפנויה, ואחריה מהבלוקים שלא נוצלו)
+        Returns: הבלוק הראשון, NO_BLOCK לנתונים ריקים, או None אם אין מספיק מקום
+        """
+        if not data:
+            return NO_BLOCK
+        mm = self._mm
+        base = self._stripe_base(stripe)
+        free_head, next_unused, count, free_count = _STRIPE.unpack_from(mm, base)
+        needed = -(-len(data) // self.payload_size)
+        if needed > free_count + self.blocks_per_stripe - next_unused:
+            return None
+        blocks = []
+        for _ in range(needed):
+            if free_head != NO_BLOCK:
+                blocks.append(free_head)
+                free_head = _NEXT.unpack_from(mm, self._block_offset(stripe, free_head))[0]
+                free_count -= 1
+            else:
+                blocks.append(next_unused)
+                next_unused += 1
+        for i, block in enumerate(blocks):
+            offset = self._block_offset(stripe, block)
+            _NEXT.pack_into(mm, offset, blocks[i + 1] if i + 1 < len(blocks) else NO_BLOCK)
+            chunk = data[i * self.payload_size:(i + 1) * self.payload_size]
+            mm[offset + _NEXT.size:offset + _NEXT.size + len(chunk)] = chunk
+        _STRIPE.pack_into(mm, base, free_head, next_unused, count, free_count)
+        return blocks[0]
+    
+    def _free(self, stripe: int, first: int, length: int):
+        """מחזיר את בלוקי השרשרת לרשימה הפנויה"""
+        if not length:
+            return
+        mm = self._mm
+        base = self._stripe_base(stripe)
+        free_head, next_unused, count, free_count = _STRIPE.unpack_from(mm, base)
+        block = first
+        for _ in range(-(-length // self.payload_size)):
+            offset = self._block_offset(stripe, block)
+            following = _NEXT.unpack_from(mm, offset)[0]
+            _NEXT.pack_into(mm, offset, free_head)
+            free_head = block
+            free_count += 1
+            block = following
+        _STRIPE.pack_into(mm, base, free_head, next_unused, count, free_count)
+    
+    def _delete_at(self, stripe: int, index: int):
+        slot = _SLOT.unpack_from(self._mm, self._slot_offset(stripe, index))
+        self._free(stripe, slot[5], slot[6])
+        self._remove(stripe, index)
+    
+    def _expire_stripe(self, stripe: int, now: float) -> int:
+        """מוחק את הסשנים שפגו ב-stripe (נקרא כשה-stripe מלא)"""
+        if not self.idle_ttl:
+            return 0
+        cutoff = self._cutoff(now)
+        expired = []
+        for index in range(self.slots_per_stripe):
+            slot = _SLOT.unpack_from(self._mm, self._slot_offset(stripe, index))
+            if slot[0] == USED and slot[4] <= cutoff:
+                expired.append((slot[3], slot[7][:slot[1]]))
+        for slot_hash, key in expired:
+            index, found = self._probe(stripe, slot_hash, key)
+            if found:
+                self._delete_at(stripe, index)
+        self.expired += len(expired)
+        return len(expired)
+    
+    # --- StateStore ---
+    
+    def get(self, phone_number: str) -> Optional[StateRecord]:
+        stripe, slot_hash, key = self._locate(phone_number)
+        with self._locks[stripe]:
+            index, found = self._probe(stripe, slot_hash, key)
+            if not found:
+                return None
+            slot = _SLOT.unpack_from(self._mm, self._slot_offset(stripe, index))
+            if slot[4] <= self._cutoff(time.time()):
+                self._delete_at(stripe, index)
+                self.expired += 1
+                return None
+            state = slot[8][:slot[2]].decode("utf-8")
+            data = self._read(stripe, slot[5], slot[6])
+        return state, loads(data) if data else {}
+    
+    def set(self, phone_number: str, state: str, data: Dict):
+        stripe, slot_hash, key = self._locate(phone_number)
+        encoded_state = state.encode("utf-8")
+        if len(encoded_state) > MAX_STATE_LENGTH:
+            raise ValueError(f"State longer than {MAX_STATE_LENGTH} bytes: {state!r}")
+        encoded = dumps(data) if data else b""
+        now = time.time()
+        with self._locks[stripe]:
+            for attempt in range(2):
+                index, found = self._probe(stripe, slot_hash, key)
+                first = self._write(stripe, encoded) if index is not None else None
+                if first is not None:
+                    break
+                if attempt or not self._expire_stripe(stripe, now):
+                    raise RuntimeError(
+                        f"Shared state stripe {stripe} is full - raise STATE_SHM_SESSIONS / STATE_SHM_DATA_MB"
+                    )
+            offset = self._slot_offset(stripe, index)
+            old = _SLOT.unpack_from(self._mm, offset) if found else None
+            _SLOT.pack_into(self._mm, offset, USED, len(key), len(encoded_state), slot_hash, now,
+                            first, len(encoded), key, encoded_state)
+            if old is not None:
+                self._free(stripe, old[5], old[6])
+            else:
+                base = self._stripe_base(stripe)
+                free_head, next_unused, count, free_count = _STRIPE.unpack_from(self._mm, base)
+                _STRIPE.pack_into(self._mm, base, free_head, next_unused, count + 1, free_count)
+    
+    def delete(self, phone_number: str):
+        stripe, slot_hash, key = self._locate(phone_number)
+        with self._locks[stripe]:
+            index, found = self._probe(stripe, slot_hash, key)
+            if found:
+                self._delete_at(stripe, index)
+    
+    # --- טבעת הכפילויות ---
+    
+    def _bucket_offset(self, key: str) -> Tuple[int, int, int]:
+        """(stripe, offset של ה-bucket, hash של המזהה)"""
+        value = _hash(key) or 1
+        bucket = value % (self.stripes * self.dedup_buckets)
+        stripe = bucket // self.dedup_buckets
+        return stripe, self.dedup_offset + bucket * DEDUP_BUCKET_SIZE, value
+    
+    def mark_seen(self, key: str, ttl: float) -> bool:
+        """
+        כל bucket הוא טבעת של DEDUP_WAYS מזהים: מזהה חדש נכתב במקום הוותיק
+        ביותר, כך שהטבעת זוכרת את המזהים האחרונים גם כשהיא מלאה לפני ה-TTL
+        """
+        stripe, offset, value = self._bucket_offset(key)
+        now = time.time()
+        mm = self._mm
+        with self._dedup_locks[stripe]:
+            entries = offset + 16
+            for way in range(DEDUP_WAYS):
+                stored, expires_at = _ENTRY.unpack_from(mm, entries + way * _ENTRY.size)
+                if stored == value and expires_at > now:
+                    return True
+            cursor = _CURSOR.unpack_from(mm, offset)[0] % DEDUP_WAYS
+            if _ENTRY.unpack_from(mm, entries + cursor * _ENTRY.size)[1] > now:
+                self.dedup_evicted += 1
+            _ENTRY.pack_into(mm, entries + cursor * _ENTRY.size, value, now + ttl)
+            _CURSOR.pack_into(mm, offset, (cursor + 1) % DEDUP_WAYS)
+        return False
+    
+    def forget_seen(self, key: str):
+        stripe, offset, value = self._bucket_offset(key)
+        mm = self._mm
+        with self._dedup_locks[stripe]:
+            for way in range(DEDUP_WAYS):
+                entry = offset + 16 + way * _ENTRY.size
+                if _ENTRY.unpack_from(mm, entry)[0] == value:
+                    _ENTRY.pack_into(mm, entry, 0, 0.0)
+    
+    # --- תחזוקה וסטטיסטיקות ---
+    
+    def _scan(self, stripe: int, cutoff: float) -> Tuple[Dict[str, int], int]:
+        """ספירת הסשנים החיים ב-stripe לפי מצב, ומספר בתי הנתונים שלהם"""
+        start = self._slot_offset(stripe, 0)
+        with self._locks[stripe]:
+            region = self._mm[start:start + self.slots_per_stripe * _SLOT.size]
+        counts: Dict[str, int] = {}
+        size = 0
+        for slot in _SLOT.iter_unpack(region):
+            if slot[0] == USED and slot[4] > cutoff:
+                state = slot[8][:slot[2]].decode("utf-8")
+                counts[state] = counts.get(state, 0) + 1
+                size += slot[1] + slot[2] + slot[6]
+        return counts, size
+    
+    def expire(self) -> int:
+        if not self.idle_ttl:
+            return 0
+        now = time.time()
+        removed = 0
+        for stripe in range(self.stripes):
+            with self._locks[stripe]:
+                removed += self._expire_stripe(stripe, now)
+        return removed
+    
+    def count_by_state(self) -> Dict[str, int]:
+        cutoff = self._cutoff(time.time())
+        counts: Dict[str, int] = {}
+        for stripe in range(self.stripes):
+            for state, count in self._scan(stripe, cutoff)[0].items():
+                counts[state] = counts.get(state, 0) + count
+        return counts
+    
+    def stats(self) -> dict:
+        cutoff = self._cutoff(time.time())
+        sessions = size = used_blocks = fullest = 0
+        for stripe in range(self.stripes):
+            counts, stripe_size = self._scan(stripe, cutoff)
+            sessions += sum(counts.values())
+            size += stripe_size
+            with self._locks[stripe]:
+                _, next_unused, count, free_count = _STRIPE.unpack_from(self._mm, self._stripe_base(stripe))
+            used_blocks += next_unused - free_count
+            fullest = max(fullest, count)
+        return {
+            "backend": self.name,
+            "sessions": sessions,
+            "bytes": size,
+            "idle_ttl_seconds": self.idle_ttl or None,
+            "expired": self.expired,
+            "path": self.path,
+            "file_bytes": self.size,
+            "slots": self.stripes * self.slots_per_stripe,
+            "fullest_stripe_load": round(fullest / self.slots_per_stripe, 3),
+            "data_blocks_used": used_blocks,
+            "data_blocks": self.stripes * self.blocks_per_stripe,
+            "dedup_capacity": self.stripes * self.dedup_buckets * DEDUP_WAYS,
+            "dedup_evicted": self.dedup_evicted,
+        }
+    
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+            # סגירת ה-fd משחררת גם את הנעילה המשותפת על USERS
+            os.close(self._fd)
@@ -0,0 +1,344 @@
+"""
+אחסון מצב השיחה (State Store)
+ממשק אחיד ל-backends שונים: זיכרון מקומי (worker יחיד) או SQLite משותף
+כך שכל ה-workers (--workers 4) רואים את אותו מצב שיחה
+"""
+import heapq
+import os
+import sqlite3
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from app.serialization import dumps, loads
+
+
+# רשומת מצב: (state_value, data)
+StateRecord = Tuple[str, Dict]
+
+
+class StateStore:
+    """ממשק בסיס ל-backend של מצב השיחה"""
+    
+    name = "base"
+    # האם ה-backend משותף בין תהליכים (ויכול לשמש גם לסינון כפילויות)
+    shared = False
+    
+    def get(self, phone_number: str) -> Optional[StateRecord]:
+        """מחזיר (state, data) של המשתמש, או None אם אין רשומה"""
+        raise NotImplementedError
+    
+    def set(self, phone_number: str, state: str, data: Dict):
+        """שומר את המצב והנתונים של המשתמש"""
+        raise NotImplementedError
+    
+    def delete(self, phone_number: str):
+        """מוחק את הרשומה של המשתמש"""
+        raise NotImplementedError
+    
+    def mark_seen(self, key: str, ttl: float) -> bool:
+        """
+        מסמן מזהה הודעה כ"נראה" (רק ב-backends משותפים)
+        Returns: True אם המזהה כבר סומן בתוך ה-TTL
+        """
+        raise NotImplementedError
+    
+    def forget_seen(self, key: str):
+        """מבטל סימון של מזהה הודעה (רק ב-backends משותפים)"""
+        raise NotImplementedError
+    
+    def expire(self) -> int:
+        """מוחק סשנים שלא עודכנו במשך ה-idle TTL. Returns: כמה נמחקו"""
+        return 0
+    
+    def stats(self) -> dict:
+        """מחזיר את מספר הסשנים החיים והזיכרון/נפח שהם תופסים"""
+        raise NotImplementedError
+    
+    def count_by_state(self) -> Dict[str, int]:
+        """מחזיר את מספר הסשנים החיים בכל מצב"""
+        raise NotImplementedError
+    
+    def close(self):
+        """משחרר משאבים (חיבורים, קבצים)"""
+
+
+class SessionRecord:
+    """רשומת סשן קומפקטית - מצב, נתונים (None כשאין) וזמן תפוגה"""
+    
+    __slots__ = ("state", "data", "expires_at")
+    
+    def __init__(self, state: str, data: Optional[Dict], expires_at: float):
+        self.state = state
+        self.data = data
+        self.expires_at = expires_at
+
+
+class InMemoryStateStore(StateStore):
+    """
+    אחסון בזיכרון של התהליך - מהיר, אבל לא משותף בין workers
+    מתאים למצב test (worker יחיד). הגישה נעולה: ה-webhooks כותבים מה-event
+    loop, וה-endpoints הסינכרוניים (/sessions, /info, /metrics) קוראים מה-threadpool.
+    הגודל והספירה לפי מצב נשמרים כסכומים רצים שמתעדכנים בכל כתיבה/מחיקה, כך
+    ש-stats() ו-count_by_state() לא עוברים על כל הרשומות כשה-lock מוחזק
+    """
+    
+    name = "memory"
+    
+    def __init__(self, idle_ttl: float = 0.0):
+        # Dictionary: phone_number -> SessionRecord
+        self._records: Dict[str, SessionRecord] = {}
+        # 0 = בלי תפוגה
+        self.idle_ttl = idle_ttl
+        # heap של (expires_at, phone_number) - רשומה ישנה ב-heap מזוהה לפי
+        # expires_at שלא תואם לרשומה העדכנית ומדולגת (מחיקה עצלה)
+        self._expiry_heap: List[Tuple[float, str]] = []
+        self.expired = 0
+        # סכומים רצים על הרשומות החיות
+        self._bytes = 0
+        self._state_counts: Dict[str, int] = {}
+        # RLock - set() ו-stats() קוראים ל-expire() שגם הוא נועל
+        self._lock = threading.RLock()
+    
+    @staticmethod
+    def _record_bytes(phone_number: str, record: SessionRecord) -> int:
+        """הגודל של רשומה (data לא משתנה במקום, כך שאותו ערך מחושב בהוספה ובהסרה)"""
+        size = sys.getsizeof(phone_number) + sys.getsizeof(record)
+        if record.data:
+            size += sys.getsizeof(record.data)
+            for key, value in record.data.items():
+                size += sys.getsizeof(key) + sys.getsizeof(value)
+        return size
+    
+    def _added(self, phone_number: str, record: SessionRecord):
+        """מעדכן את הסכומים אחרי הוספת רשומה (נקרא כשה-lock מוחזק)"""
+        self._bytes += self._record_bytes(phone_number, record)
+        self._state_counts[record.state] = self._state_counts.get(record.state, 0) + 1
+    
+    def _removed(self, phone_number: str, record: SessionRecord):
+        """מעדכן את הסכומים אחרי הסרת רשומה (נקרא כשה-lock מוחזק)"""
+        self._bytes -= self._record_bytes(phone_number, record)
+        count = self._state_counts[record.state] - 1
+        if count:
+            self._state_counts[record.state] = count
+        else:
+            del self._state_counts[record.state]
+    
+    def _recount(self):
+        """מחשב את הסכומים מחדש (אחרי טעינה ישירה של _records, למשל משחזור יומן)"""
+        with self._lock:
+            self._bytes = 0
+            self._state_counts = {}
+            for phone_number, record in self._records.items():
+                self._added(phone_number, record)
+    
+    def get(self, phone_number: str) -> Optional[StateRecord]:
+        with self._lock:
+            record = self._records.get(phone_number)
+            if record is None:
+                return None
+            if self.idle_ttl and record.expires_at <= time.monotonic():
+                del self._records[phone_number]
+                self._removed(phone_number, record)
+                self.expired += 1
+                return None
+            return record.state, dict(record.data) if record.data else {}
+    
+    def set(self, phone_number: str, state: str, data: Dict):
+        record = SessionRecord(state, dict(data) if data else None, 0.0)
+        with self._lock:
+            if self.idle_ttl:
+                now = time.monotonic()
+                self.expire(now)
+                record.expires_at = now + self.idle_ttl
+                heapq.heappush(self._expiry_heap, (record.expires_at, phone_number))
+            old = self._records.get(phone_number)
+            if old is not None:
+                self._removed(phone_number, old)
+            self._records[phone_number] = record
+            self._added(phone_number, record)
+    
+    def delete(self, phone_number: str):
+        with self._lock:
+            record = self._records.pop(phone_number, None)
+            if record is not None:
+                self._removed(phone_number, record)
+    
+    def expire(self, now: Optional[float] = None) -> int:
+        """מוציא מראש ה-heap את כל מה שפג תוקפו - O(log n) לכל רשומה שפגה"""
+        if not self.idle_ttl:
+            return 0
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            heap = self._expiry_heap
+            records = self._records
+            removed = 0
+            while heap and heap[0][0] <= now:
+                expires_at, phone_number = heapq.heappop(heap)
+                record = records.get(phone_number)
+                if record is not None and record.expires_at == expires_at:
+                    del records[phone_number]
+                    self._removed(phone_number, record)
+                    removed += 1
+            # כתיבות חוזרות לאותו מספר משאירות ב-heap כניסות ישנות - בנייה מחדש כשהוא מתנפח
+            if len(heap) > 2 * len(records) + 1024:
+                self._expiry_heap = [(record.expires_at, phone) for phone, record in records.items()]
+                heapq.heapify(self._expiry_heap)
+            self.expired += removed
+        return removed
+    
+    def stats(self) -> dict:
+        with self._lock:
+            self.expire()
+            size = sys.getsizeof(self._records) + sys.getsizeof(self._expiry_heap) + self._bytes
+            sessions = len(self._records)
+        return {
+            "backend": self.name,
+            "sessions": sessions,
+            "bytes": size,
+            "idle_ttl_seconds": self.idle_ttl or None,
+            "expired": self.expired,
+        }
+    
+    def count_by_state(self) -> Dict[str, int]:
+        with self._lock:
+            self.expire()
+            return dict(self._state_counts)
+
+
+class SQLiteStateStore(StateStore):
+    """
+    אחסון ב-SQLite במצב WAL - משותף לכל ה-workers על אותו שרת
+    קריאות וכתיבות מקומיות של מיקרו-שניות, בלי שירות חיצוני
+    """
+    
+    name = "sqlite"
+    shared = True
+    
+    # מחיקת מזהים שפג תוקפם אחת ל-N סימונים
+    SEEN_PURGE_EVERY = 1000
+    # מחיקת סשנים שפג תוקפם אחת ל-N כתיבות
+    SESSION_PURGE_EVERY = 1000
+    
+    def __init__(self, path: str, idle_ttl: float = 0.0):
+        self.path = path
+        self.idle_ttl = idle_ttl
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        # WAL - קוראים לא חוסמים כותבים, ו-NORMAL מספיק לעמידות מול קריסת תהליך
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " phone_number TEXT PRIMARY KEY,"
+            " state TEXT NOT NULL,"
+            " data TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS seen_ids ("
+            " id TEXT PRIMARY KEY,"
+            " expires_at REAL NOT NULL)"
+        )
+        self._seen_writes = 0
+        self._session_writes = 0
+        self.expired = 0
+    
+    def _cutoff(self, now: float) -> float:
+        """רשומה שעודכנה לפני הזמן הזה פגה (או -1 כשאין תפוגה)"""
+        return now - self.idle_ttl if self.idle_ttl else -1.0
+    
+    def get(self, phone_number: str) -> Optional[StateRecord]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT state, data FROM sessions WHERE phone_number = ? AND updated_at > ?",
+                (phone_number, self._cutoff(time.time())),
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], loads(row[1])
+    
+    def set(self, phone_number: str, state: str, data: Dict):
+        encoded = dumps(data).decode("utf-8")
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sessions (phone_number, state, data, updated_at) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT(phone_number) DO UPDATE SET"
+                " state = excluded.state, data = excluded.data, updated_at = excluded.updated_at",
+                (phone_number, state, encoded, now),
+            )
+            self._session_writes += 1
+            if self.idle_ttl and self._session_writes % self.SESSION_PURGE_EVERY == 0:
+                self._expire_locked(now)
+    
+    def delete(self, phone_number: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE phone_number = ?", (phone_number,))
+    
+    def mark_seen(self, key: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            # מזהה חדש או שפג תוקפו נכתב (rowcount=1); מזהה פעיל לא משתנה (rowcount=0)
+            cursor = self._conn.execute(
+                "INSERT INTO seen_ids (id, expires_at) VALUES (?, ?)"
+                " ON CONFLICT(id) DO UPDATE SET expires_at = excluded.expires_at"
+                " WHERE seen_ids.expires_at <= ?",
+                (key, now + ttl, now),
+            )
+            already_seen = cursor.rowcount == 0
+            self._seen_writes += 1
+            if self._seen_writes % self.SEEN_PURGE_EVERY == 0:
+                self._conn.execute("DELETE FROM seen_ids WHERE expires_at <= ?", (now,))
+        return already_seen
+    
+    def forget_seen(self, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM seen_ids WHERE id = ?", (key,))
+    
+    def _expire_locked(self, now: float) -> int:
+        """מוחק סשנים שפגו (דרך האינדקס על updated_at) - נקרא כשה-lock מוחזק"""
+        cursor = self._conn.execute("DELETE FROM sessions WHERE updated_at <= ?", (self._cutoff(now),))
+        self.expired += cursor.rowcount
+        return cursor.rowcount
+    
+    def expire(self) -> int:
+        if not self.idle_ttl:
+            return 0
+        with self._lock:
+            return self._expire_locked(time.time())
+    
+    def stats(self) -> dict:
+        with self._lock:
+            count, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(phone_number) + LENGTH(state) + LENGTH(data)), 0)"
+                " FROM sessions WHERE updated_at > ?",
+                (self._cutoff(time.time()),),
+            ).fetchone()
+        return {
+            "backend": self.name,
+            "sessions": count,
+            "bytes": size,
+            "idle_ttl_seconds": self.idle_ttl or None,
+            "expired": self.expired,
+        }
+    
+    def count_by_state(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT state, COUNT(*) FROM sessions WHERE updated_at > ? GROUP BY state",
+                (self._cutoff(time.time()),),
+            ).fetchall()
+        return dict(rows)
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
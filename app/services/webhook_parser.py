@@ -0,0 +1,138 @@
+"""
+פענוח webhooks נכנסים של WhatsApp
+מעבר יחיד על כל ה-entry/changes/messages/statuses במשלוח, כולל משלוחים
+מקובצים (batched), והחזרת אירועים קלים ומוקלדים לכל הודעה ולכל status
+"""
+from typing import Iterator, Optional, Union
+
+
+class InboundMessage:
+    """הודעה נכנסת ממשתמש"""
+    
+    __slots__ = ("message_id", "phone_number", "type", "text", "choice_id", "timestamp", "raw")
+    
+    def __init__(self, message_id: Optional[str], phone_number: Optional[str], type: str,
+                 text: str = "", choice_id: Optional[str] = None,
+                 timestamp: Optional[str] = None, raw: Optional[dict] = None):
+        self.message_id = message_id
+        self.phone_number = phone_number
+        self.type = type
+        self.text = text
+        self.choice_id = choice_id
+        self.timestamp = timestamp
+        self.raw = raw
+    
+    @classmethod
+    def from_dict(cls, message: dict, fallback_phone: Optional[str] = None) -> "InboundMessage":
+        """בונה אירוע מהודעה בפורמט WhatsApp Business API"""
+        message_type = message.get("type", "")
+        text = ""
+        choice_id = None
+        
+        if message_type == "text":
+            text = (message.get("text") or {}).get("body", "")
+        elif message_type == "interactive":
+            # בחירה מ-List או מכפתור
+            interactive = message.get("interactive") or {}
+            interactive_type = interactive.get("type", "")
+            if interactive_type in ("list_reply", "button_reply"):
+                choice_id = (interactive.get(interactive_type) or {}).get("id")
+        elif message_type == "button":
+            # לחיצה על כפתור של template
+            choice_id = (message.get("button") or {}).get("payload")
+        
+        return cls(
+            message_id=message.get("id"),
+            phone_number=message.get("from") or fallback_phone,
+            type=message_type,
+            text=text,
+            choice_id=choice_id,
+            timestamp=message.get("timestamp"),
+            raw=message,
+        )
+    
+    def __repr__(self) -> str:
+        return (f"InboundMessage(id={self.message_id!r}, from={self.phone_number!r}, "
+                f"type={self.type!r}, choice_id={self.choice_id!r})")
+
+
+class InboundStatus:
+    """עדכון סטטוס של הודעה יוצאת (sent / delivered / read / failed)"""
+    
+    __slots__ = ("status_id", "recipient_id", "status", "timestamp", "raw")
+    
+    def __init__(self, status_id: Optional[str], recipient_id: Optional[str], status: str,
+                 timestamp: Optional[str] = None, raw: Optional[dict] = None):
+        self.status_id = status_id
+        self.recipient_id = recipient_id
+        self.status = status
+        self.timestamp = timestamp
+        self.raw = raw
+    
+    @classmethod
+    def from_dict(cls, status: dict) -> "InboundStatus":
+        """בונה אירוע מ-status בפורמט WhatsApp Business API"""
+        return cls(
+            status_id=status.get("id"),
+            recipient_id=status.get("recipient_id"),
+            status=status.get("status", ""),
+            timestamp=status.get("timestamp"),
+            raw=status,
+        )
+    
+    @property
+    def dedup_key(self) -> Optional[str]:
+        """אותו message id מקבל sent/delivered/read - המפתח כולל גם את הסטטוס"""
+        if not self.status_id:
+            return None
+        return f"{self.status_id}:{self.status}"
+    
+    def __repr__(self) -> str:
+        return f"InboundStatus(id={self.status_id!r}, to={self.recipient_id!r}, status={self.status!r})"
+
+
+InboundEvent = Union[InboundMessage, InboundStatus]
+
+
+def is_status_only(body: bytes) -> bool:
+    """
+    סיווג זול של ה-body הגולמי, בלי לפענח JSON: True אם יש בו statuses
+    ואין בו messages (קבלות sent/delivered/read - רוב התעבורה)
+    """
+    return b'"statuses"' in body and b'"messages"' not in body
+
+
+def _dicts(items) -> Iterator[dict]:
+    """מחזיר רק את האיברים שהם dict (מתעלם ממבנה לא צפוי)"""
+    if isinstance(items, list):
+        for item in items:
+            if isinstance(item, dict):
+                yield item
+
+
+def parse_webhook(data: dict) -> Iterator[InboundEvent]:
+    """
+    עובר פעם אחת על ה-payload ומחזיר אירוע לכל הודעה ולכל status
+    
+    תומך גם ב-payload שעטוף ע"י N8N (data["body"]) וגם ב-payload ישיר של Meta
+    """
+    body = data.get("body", data)
+    if not isinstance(body, dict):
+        return
+    
+    for entry in _dicts(body.get("entry")):
+        for change in _dicts(entry.get("changes")):
+            value = change.get("value")
+            if not isinstance(value, dict):
+                continue
+            
+            # מספר הטלפון מ-contacts משמש כגיבוי אם להודעה אין from
+            fallback_phone = None
+            for contact in _dicts(value.get("contacts")):
+                fallback_phone = contact.get("wa_id")
+                break
+            
+            for message in _dicts(value.get("messages")):
+                yield InboundMessage.from_dict(message, fallback_phone)
+            for status in _dicts(value.get("statuses")):
+                yield InboundStatus.from_dict(status)
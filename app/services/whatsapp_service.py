@@ -1,8 +1,40 @@
 """
 שירות לשליחת הודעות WhatsApp דרך N8N
 """
+import asyncio
+import logging
 import os
-import requests
+import time
+from typing import List, Optional, Tuple
+
+import httpx
+
+from app.config import env_bool, env_float, env_int, env_str
+from app.serialization import dumps
+from app.services.endpoint_pool import create_endpoint_pool
+from app.services.menus import Menu, build_list_payload
+from app.services.metrics import N8N_POST_SECONDS, N8N_RETRIES
+from app.services.n8n_batcher import N8NBatcher
+from app.services.outbox import create_outbox
+from app.services.rate_limiter import create_rate_limiter, retry_delay
+
+logger = logging.getLogger(__name__)
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def encode_payload(payload: dict) -> bytes:
+    """מקודד payload ל-JSON bytes (פעם אחת, לפני התור/הקבוצה)"""
+    return dumps(payload)
+
+
+def _result_status(status_code: int) -> str:
+    """sent (200), queued (202 - נכתב ל-outbox) או error"""
+    if status_code == 200:
+        return "sent"
+    if status_code == 202:
+        return "queued"
+    return "error"
 
 
 class WhatsAppService:
@@ -20,18 +52,230 @@ class WhatsAppService:
             self.n8n_webhook_url = "https://ninsights.app.n8n.cloud/webhook/whatsappout"
         else:
             self.n8n_webhook_url = "https://ninsights.app.n8n.cloud/webhook-test/whatsappout"
+        # דריסה מפורשת (למשל שרת N8N מקומי לבדיקות ו-benchmarks)
+        self.n8n_webhook_url = env_str("N8N_WEBHOOK_URL", self.n8n_webhook_url)
+        # כמה endpoints (N8N_WEBHOOK_URLS) עם בחירה לפי latency ו-circuit breaker;
+        # בלי הגדרה המאגר מכיל רק את ה-URL שלמעלה
+        self._pool = create_endpoint_pool(self.n8n_webhook_url)
+        self.n8n_webhook_url = self._pool.primary.url
         
-        print(f"WhatsAppService initialized in '{self.environment}' mode")
-        print(f"N8N Webhook URL: {self.n8n_webhook_url}")
+        # הגדרות ה-client המשותף (connection pool + timeouts)
+        self.max_connections = env_int("N8N_MAX_CONNECTIONS", 100)
+        self.max_keepalive_connections = env_int("N8N_MAX_KEEPALIVE", 20)
+        self.keepalive_expiry = env_float("N8N_KEEPALIVE_EXPIRY", 30.0)
+        self.connect_timeout = env_float("N8N_CONNECT_TIMEOUT", 5.0)
+        self.request_timeout = env_float("N8N_TIMEOUT", 15.0)
+        
+        # הגבלת קצב וניסיונות חוזרים על 429/5xx ושגיאות רשת
+        self._limiter = create_rate_limiter()
+        self.max_retries = env_int("N8N_MAX_RETRIES", 2)
+        self.retry_base_delay = env_float("N8N_RETRY_BASE_DELAY", 0.5)
+        self.retry_max_delay = env_float("N8N_RETRY_MAX_DELAY", 10.0)
+        self.retries = 0
+        
+        # ה-client נוצר ב-start (או בשליחה הראשונה מחוץ לשרת) - אחד לכל worker
+        self._client: Optional[httpx.AsyncClient] = None
+        
+        # קיבוץ הודעות יוצאות ל-POST אחד של מערך (opt-in)
+        self._batcher: Optional[N8NBatcher] = None
+        self._outbox_batcher: Optional[N8NBatcher] = None
+        batching = env_bool("N8N_BATCH_ENABLED", False)
+        batch_window = env_float("N8N_BATCH_WINDOW_MS", 20.0) / 1000
+        batch_max_size = env_int("N8N_BATCH_MAX_SIZE", 50)
+        if batching:
+            self._batcher = N8NBatcher(self._post_batch, window=batch_window, max_size=batch_max_size)
+        
+        # outbox עמיד - הודעות נכתבות ל-SQLite לפני השליחה ונשלחות ע"י workers (opt-in).
+        # ה-outbox מנסה שוב בעצמו (עם backoff ומונה ניסיונות), לכן הוא שולח בלי ניסיונות חוזרים
+        self._outbox = create_outbox(self._post_once)
+        if batching and self._outbox is not None:
+            self._outbox_batcher = N8NBatcher(
+                self._post_batch_once, window=batch_window, max_size=batch_max_size,
+            )
+        
+        logger.info("WhatsAppService initialized in '%s' mode", self.environment)
+        logger.info("N8N Webhook URL(s): %s", ", ".join(e.url for e in self._pool.endpoints))
+    
+    def _get_client(self) -> httpx.AsyncClient:
+        """מחזיר את ה-client המשותף (keep-alive), ויוצר אותו בפעם הראשונה"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive_connections,
+                    keepalive_expiry=self.keepalive_expiry,
+                ),
+                timeout=httpx.Timeout(self.request_timeout, connect=self.connect_timeout),
+            )
+        return self._client
+    
+    @property
+    def outbox(self):
+        """ה-outbox (או None אם OUTBOX_ENABLED כבוי)"""
+        return self._outbox
     
-    def send_message(self, phone_number: str, text: str) -> dict:
+    async def start(self):
+        """
+        יוצר את ה-client המשותף (כדי שההודעה הראשונה אחרי restart לא תשלם על
+        בניית ה-SSL context), ומפעיל את בדיקות התקינות של ה-endpoints ואת
+        workers של ה-outbox ברקע (נקרא ב-startup)
+        """
+        self._get_client()
+        await self._pool.start(self._get_client)
+        if self._outbox is not None:
+            await self._outbox.start()
+    
+    async def aclose(self):
+        """
+        מרוקן את ה-outbox (מה שלא נשלח נשאר בו לריצה הבאה), שולח את מה שממתין
+        בקבוצה, וסוגר את ה-client ואת כל החיבורים הפתוחים (נקרא ב-shutdown)
+        """
+        if self._outbox is not None:
+            await self._outbox.stop()
+        await self._pool.stop()
+        if self._batcher is not None:
+            await self._batcher.flush()
+        if self._outbox_batcher is not None:
+            await self._outbox_batcher.flush()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        if self._outbox is not None:
+            self._outbox.close()
+    
+    async def _deliver(self, body: bytes, recipient: str) -> Tuple[int, str]:
+        """
+        שליחה דרך ה-outbox אם הוא פעיל (status_code 202 - נכתב ויישלח ברקע),
+        ואחרת שליחה ישירה
+        """
+        if self._outbox is not None:
+            message_id = self._outbox.enqueue(recipient, body)
+            return 202, f"queued in outbox as {message_id}"
+        return await self._post(body, recipient)
+    
+    async def _post(self, body: bytes, recipient: Optional[str] = None, retry: bool = True) -> Tuple[int, str]:
+        """
+        שולח גוף JSON מוכן ל-webhook של N8N דרך ה-client המשותף
+        (או דרך הקבוצה הנוכחית אם הקיבוץ פעיל)
+        
+        כל הודעה ממתינה לתור שלה במגביל הקצב (גלובלי + לפי נמען) - בלי קיבוץ
+        בכל ניסיון מחדש. עם קיבוץ ההודעה ממתינה לפני שהיא נכנסת לקבוצה, בלי
+        להחזיק מקום ב-in-flight בזמן שהקבוצה מתמלאת
+        retry: False - ניסיון אחד בלבד (ל-outbox, שמנסה שוב בעצמו)
+        
+        Returns: (status_code, response_text)
+        """
+        batcher = self._batcher if retry else self._outbox_batcher
+        if batcher is not None:
+            await self._limiter.pace(recipient)
+            return await batcher.submit(body)
+        response = await self._post_with_retry(body, recipient, None if retry else 0)
+        return response.status_code, response.text
+    
+    async def _post_once(self, body: bytes, recipient: Optional[str] = None) -> Tuple[int, str]:
+        """שליחה של ה-outbox - ניסיון אחד לכל ניסיון שנספר ב-outbox"""
+        return await self._post(body, recipient, retry=False)
+    
+    async def _post_batch(self, bodies: List[bytes]) -> httpx.Response:
+        """שולח קבוצת גופי JSON כמערך ב-POST אחד"""
+        content = b"[" + b",".join(bodies) + b"]"
+        return await self._post_with_retry(content, paced=True)
+    
+    async def _post_batch_once(self, bodies: List[bytes]) -> httpx.Response:
+        """קבוצה של הודעות outbox - POST אחד בלי ניסיונות חוזרים"""
+        content = b"[" + b",".join(bodies) + b"]"
+        return await self._post_with_retry(content, max_retries=0, paced=True)
+    
+    async def _post_with_retry(self, content: bytes, recipient: Optional[str] = None,
+                               max_retries: Optional[int] = None, paced: bool = False) -> httpx.Response:
+        """
+        שולח POST ל-endpoint שנבחר מהמאגר ומנסה שוב על 429 / 5xx / שגיאת רשת,
+        עד max_retries (ברירת מחדל N8N_MAX_RETRIES) פעמים. ניסיון חוזר עובר מיד
+        ל-endpoint שעוד לא נכשל בבקשה הזו; רק כשאין כזה ממתינים - לפי
+        Retry-After, ואחרת exponential backoff עם jitter. 429 בלי endpoint
+        חלופי עוצר את כל השליחה מה-worker (hold_off) ולא רק את הבקשה הזו
+        
+        כל ניסיון ממתין מחדש במגביל הקצב ומחזיק מקום ב-in-flight רק לאורך
+        ה-POST, לא לאורך ה-backoff. paced: הניסיון הראשון כבר עבר pace
+        (קבוצה - כל הודעה בה עברה pace לפני שנכנסה)
+        """
+        if max_retries is None:
+            max_retries = self.max_retries
+        attempt = 0
+        failed = []
+        while True:
+            slot = self._limiter.in_flight_slot() if paced and attempt == 0 else self._limiter.slot(recipient)
+            async with slot:
+                endpoint = self._pool.choose(exclude=failed)
+                started = time.perf_counter()
+                retry_after = None
+                throttled = False
+                try:
+                    response = await self._get_client().post(endpoint.url, content=content, headers=_JSON_HEADERS)
+                except httpx.TransportError as e:
+                    elapsed = time.perf_counter() - started
+                    self._pool.record(endpoint, elapsed, ok=False)
+                    N8N_POST_SECONDS.observe(elapsed, "error")
+                    if attempt >= max_retries:
+                        raise
+                    reason = f"failed ({e})"
+                except BaseException:
+                    # ביטול או שגיאה לא צפויה - לא נספרים נגד ה-endpoint
+                    self._pool.release(endpoint)
+                    raise
+                else:
+                    elapsed = time.perf_counter() - started
+                    throttled = response.status_code == 429
+                    retryable = throttled or response.status_code >= 500
+                    self._pool.record(endpoint, elapsed, ok=not retryable)
+                    N8N_POST_SECONDS.observe(elapsed, str(response.status_code))
+                    retry_after = response.headers.get("Retry-After")
+                    if not retryable or attempt >= max_retries:
+                        if throttled and not self._pool.has_alternative(failed + [endpoint]):
+                            self._limiter.hold_off(retry_delay(
+                                attempt, self.retry_base_delay, self.retry_max_delay, retry_after))
+                        return response
+                    reason = f"returned {response.status_code}"
+            
+            failed.append(endpoint)
+            attempt += 1
+            self.retries += 1
+            N8N_RETRIES.inc()
+            if self._pool.has_alternative(failed):
+                logger.warning("N8N %s %s, failing over", endpoint.url, reason)
+                continue
+            delay = retry_delay(attempt - 1, self.retry_base_delay, self.retry_max_delay, retry_after)
+            if throttled:
+                # ה-slot הבא של כל שולח ממתין לסוף ההשהיה
+                self._limiter.hold_off(delay)
+                logger.warning("N8N %s %s, holding all sends for %.2fs", endpoint.url, reason, delay)
+                continue
+            logger.warning("N8N %s %s, retrying in %.2fs", endpoint.url, reason, delay)
+            await asyncio.sleep(delay)
+    
+    def batch_stats(self) -> Optional[dict]:
+        """מחזיר את מוני הקיבוץ, או None אם הקיבוץ כבוי"""
+        return self._batcher.stats() if self._batcher is not None else None
+    
+    def endpoint_stats(self) -> dict:
+        """מחזיר את מצב מאגר ה-endpoints - latency, circuit breaker ומונים לכל endpoint"""
+        return self._pool.stats()
+    
+    def rate_limit_stats(self) -> dict:
+        """מחזיר את מצב מגביל הקצב ומספר הניסיונות החוזרים"""
+        stats = self._limiter.stats()
+        stats["max_retries"] = self.max_retries
+        stats["retries"] = self.retries
+        return stats
+    
+    async def send_message(self, phone_number: str, text: str) -> dict:
         """
         שולח הודעת WhatsApp טקסט רגילה
         
         Args:
             phone_number: מספר הטלפון של הנמען
             text: תוכן ההודעה
-            
+        
         Returns:
             dict עם פרטי התגובה מהשרת
         """
@@ -43,26 +287,22 @@ class WhatsAppService:
             }
         }
         
-        print(f"DEBUG: Sending WhatsApp message to {phone_number}")
-        print(f"DEBUG: Payload: {payload}")
-        print(f"DEBUG: N8N Webhook URL: {self.n8n_webhook_url}")
+        logger.debug("Sending WhatsApp message to %s via %s, payload: %s",
+                     phone_number, self.n8n_webhook_url, payload)
         
         try:
-            response = requests.post(self.n8n_webhook_url, json=payload)
-            print(f"DEBUG: Response status: {response.status_code}")
-            print(f"DEBUG: Response text: {response.text}")
+            status_code, response_text = await self._deliver(encode_payload(payload), phone_number)
+            logger.debug("N8N response: %s %s", status_code, response_text)
             
             return {
-                "status": "sent" if response.status_code == 200 else "error",
-                "status_code": response.status_code,
-                "response_text": response.text,
+                "status": _result_status(status_code),
+                "status_code": status_code,
+                "response_text": response_text,
                 "phone_number": phone_number,
                 "message_text": text
             }
         except Exception as e:
-            print(f"ERROR: Error sending WhatsApp message: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("Error sending WhatsApp message to %s: %s", phone_number, e)
             return {
                 "status": "error",
                 "error": str(e),
@@ -70,8 +310,8 @@ class WhatsAppService:
                 "message_text": text
             }
     
-    def send_interactive_message(self, phone_number: str, body_text: str, 
-                                 options=None, button_text="בחר אפשרות") -> dict:
+    async def send_interactive_message(self, phone_number: str, body_text: str,
+                                       options=None, button_text="בחר אפשרות") -> dict:
         """
         שולח הודעת WhatsApp Interactive List עם רשימת אפשרויות
         
@@ -84,7 +324,7 @@ class WhatsAppService:
                     - "description": תיאור אופציונלי (לא חובה)
                     אם לא מסופק, ישתמש ב-4 אפשרויות ברירת מחדל
             button_text: טקסט הכפתור (ברירת מחדל: "בחר אפשרות")
-            
+        
         Returns:
             dict עם פרטי התגובה מהשרת
         """
@@ -97,61 +337,40 @@ class WhatsAppService:
                 {"id": "new_task", "title": "משימה חדשה"}
             ]
         
-        # בניית rows (שורות) עבור List Message
-        rows = []
-        for option in options:
-            row = {
-                "id": option["id"],
-                "title": option["title"]
-            }
-            # הוספת description אם קיים
-            if "description" in option:
-                row["description"] = option["description"]
-            rows.append(row)
-        
         # בניית payload ל-Interactive List Message
-        # פורמט WhatsApp Business API - List Message
-        payload = {
-            "messaging_product": "whatsapp",
-            "to": phone_number,
-            "type": "interactive",
-            "interactive": {
-                "type": "list",
-                "body": {
-                    "text": body_text
-                },
-                "action": {
-                    "button": button_text,
-                    "sections": [
-                        {
-                            "title": "אפשרויות",
-                            "rows": rows
-                        }
-                    ]
-                }
-            }
-        }
+        # (לתפריטים קבועים עדיף send_menu עם תפריט מקומפל)
+        payload = build_list_payload(phone_number, body_text, options, button_text)
         
-        print(f"DEBUG: Sending WhatsApp interactive message to {phone_number}")
-        print(f"DEBUG: Payload: {payload}")
-        print(f"DEBUG: N8N Webhook URL: {self.n8n_webhook_url}")
+        logger.debug("Sending WhatsApp interactive message to %s via %s, payload: %s",
+                     phone_number, self.n8n_webhook_url, payload)
+        return await self._send_interactive(phone_number, encode_payload(payload))
+    
+    async def send_menu(self, phone_number: str, menu: Menu) -> dict:
+        """
+        שולח תפריט מקומפל מראש (MenuRegistry) - רק מספר הנמען מוכנס
+        ל-JSON bytes השמור, בלי לבנות את ה-payload מחדש
         
+        Returns:
+            dict עם פרטי התגובה מהשרת (כמו send_interactive_message)
+        """
+        logger.debug("Sending menu '%s' to %s via %s", menu.name, phone_number, self.n8n_webhook_url)
+        return await self._send_interactive(phone_number, menu.render(phone_number))
+    
+    async def _send_interactive(self, phone_number: str, body: bytes) -> dict:
+        """שולח הודעת Interactive מקודדת ומחזיר dict תוצאה"""
         try:
-            response = requests.post(self.n8n_webhook_url, json=payload)
-            print(f"DEBUG: Response status: {response.status_code}")
-            print(f"DEBUG: Response text: {response.text}")
+            status_code, response_text = await self._deliver(body, phone_number)
+            logger.debug("N8N response: %s %s", status_code, response_text)
             
             return {
-                "status": "sent" if response.status_code == 200 else "error",
-                "status_code": response.status_code,
-                "response_text": response.text,
+                "status": _result_status(status_code),
+                "status_code": status_code,
+                "response_text": response_text,
                 "phone_number": phone_number,
                 "message_type": "interactive"
             }
         except Exception as e:
-            print(f"ERROR: Error sending WhatsApp interactive message: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("Error sending WhatsApp interactive message to %s: %s", phone_number, e)
             return {
                 "status": "error",
                 "error": str(e),
@@ -166,8 +385,3 @@ class WhatsAppService:
     def get_environment(self) -> str:
         """מחזיר את סביבת הריצה"""
         return self.environment
-
-
-# יצירת instance גלובלי של השירות
-whatsapp_service = WhatsAppService()
-
@@ -0,0 +1,75 @@
+"""
+מדידת ההשפעה של קיבוץ הודעות יוצאות ל-N8N (N8N_BATCH_ENABLED)
+שולח את אותה כמות הודעות מול שרת N8N מדומה, פעם בלי קיבוץ ופעם עם,
+ומדווח זמן כולל, הודעות לשנייה ומספר בקשות ה-HTTP שהגיעו ל-N8N
+
+הרצה:
+    python -m benchmarks.bench_batching --messages 2000 --concurrency 200 --latency-ms 20
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import httpx
+
+from app.logging_config import configure_logging
+from app.services.whatsapp_service import WhatsAppService
+from benchmarks.fake_n8n import run_fake_n8n
+
+
+async def run_once(url: str, batching: bool, messages: int, concurrency: int) -> dict:
+    os.environ["N8N_WEBHOOK_URL"] = url
+    os.environ["N8N_BATCH_ENABLED"] = "true" if batching else "false"
+    # ההגדרות נקראות ממשתני הסביבה בזמן יצירת השירות
+    service = WhatsAppService()
+    base_url = url.rsplit("/webhook/", 1)[0]
+    httpx.post(f"{base_url}/reset")
+    
+    semaphore = asyncio.Semaphore(concurrency)
+    errors = 0
+    
+    async def send(i: int):
+        nonlocal errors
+        async with semaphore:
+            result = await service.send_message(f"9725{i % 10000:08d}", f"הודעה מספר {i}")
+            if result["status"] != "sent":
+                errors += 1
+    
+    started = time.perf_counter()
+    await asyncio.gather(*(send(i) for i in range(messages)))
+    elapsed = time.perf_counter() - started
+    await service.aclose()
+    
+    server_stats = httpx.get(f"{base_url}/stats").json()
+    return {
+        "batching": batching,
+        "seconds": elapsed,
+        "msg_per_sec": messages / elapsed,
+        "http_requests": server_stats["requests"],
+        "items": server_stats["items"],
+        "errors": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    # שגיאות נספרות בתוצאה - אין צורך ב-traceback לכל הודעה
+    os.environ.setdefault("LOG_LEVEL", "CRITICAL")
+    configure_logging()
+    
+    with run_fake_n8n(args.port, args.latency_ms) as url:
+        for batching in (False, True):
+            r = asyncio.run(run_once(url, batching, args.messages, args.concurrency))
+            print(f"batching={'on ' if r['batching'] else 'off'}  {r['seconds']:.2f}s  "
+                  f"{r['msg_per_sec']:,.0f} msg/s  http_requests={r['http_requests']}  "
+                  f"items={r['items']}  errors={r['errors']}")
+
+
+if __name__ == "__main__":
+    main()
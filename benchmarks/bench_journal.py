@@ -0,0 +1,71 @@
+"""
+מדידת השחזור של JournaledStateStore (STATE_BACKEND=journal)
+כותב סשנים באמצע זרימה, "קורס" (בלי close - snapshot תקופתי + זנב היומן)
+או נסגר כרגיל (snapshot מלא), ומודד כמה זמן לוקח ל-worker חדש לשחזר את כולם
+
+הרצה:
+    python -m benchmarks.bench_journal --sessions 50000 --updates 3
+"""
+import argparse
+import shutil
+import sys
+import tempfile
+import time
+
+from app.services.state_journal import JournaledStateStore
+
+STATES = ("proposal_new_name", "proposal_new_participants", "proposal_new_content")
+
+
+def fill(directory: str, sessions: int, updates: int, clean_shutdown: bool) -> float:
+    store = JournaledStateStore(directory, idle_ttl=86_400.0)
+    started = time.perf_counter()
+    for step in range(updates):
+        data = {"type": "proposal", "name": "דיון שבועי על תקציב הרבעון"}
+        if step:
+            data["participants"] = "דנה, יוסי, מיכל"
+        for i in range(sessions):
+            store.set(f"9725{i:08d}", STATES[step % len(STATES)], data)
+    elapsed = time.perf_counter() - started
+    if clean_shutdown:
+        store.close()
+    else:
+        # קריסה: מחכים ל-group commit האחרון ומשחררים את הנעילה בלי snapshot סופי
+        time.sleep(max(1.0, store.flush_interval * 5))
+        store._lock_file.close()
+    return elapsed
+
+
+def restore(directory: str) -> tuple:
+    started = time.perf_counter()
+    store = JournaledStateStore(directory, idle_ttl=86_400.0)
+    elapsed = time.perf_counter() - started
+    count = len(store._records)
+    store.close()
+    return elapsed, count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=50_000)
+    parser.add_argument("--updates", type=int, default=3, help="מעברי מצב לכל סשן")
+    args = parser.parse_args()
+    
+    ok = True
+    for clean_shutdown in (False, True):
+        directory = tempfile.mkdtemp(prefix="bench_journal_")
+        try:
+            write_seconds = fill(directory, args.sessions, args.updates, clean_shutdown)
+            restore_seconds, count = restore(directory)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        source = "clean shutdown" if clean_shutdown else "crash         "
+        writes = args.sessions * args.updates
+        print(f"restore after {source}  sessions={count:,}  restore={restore_seconds * 1000:,.0f} ms  "
+              f"writes={writes:,} ({writes / write_seconds:,.0f}/s)")
+        ok = ok and count == args.sessions
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
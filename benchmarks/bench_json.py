@@ -0,0 +1,110 @@
+"""
+מדידת שכבת ה-JSON (app.serialization): stdlib מול orjson
+על payloads מציאותיים של Meta (כולל טקסט בעברית) - פענוח webhook נכנס,
+קידוד הודעה יוצאת ל-N8N וקידוד תשובת API. מדווח מיקרו-שניות להודעה
+
+הרצה:
+    python -m benchmarks.bench_json --repeat 20000
+"""
+import argparse
+import json
+import timeit
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+HEBREW_TEXT = "שלום, אני רוצה לקבוע דיון על תקציב הרבעון הבא עם דנה, יוסי ומיכל ביום שלישי בבוקר 🙏"
+
+
+def webhook_payload(messages: int) -> dict:
+    """webhook בפורמט Meta עטוף ע"י N8N, עם הודעות טקסט בעברית"""
+    return {
+        "headers": {"content-type": "application/json", "user-agent": "facebookexternalua"},
+        "body": {
+            "object": "whatsapp_business_account",
+            "entry": [{
+                "id": "102290129340398",
+                "changes": [{
+                    "field": "messages",
+                    "value": {
+                        "messaging_product": "whatsapp",
+                        "metadata": {"display_phone_number": "15550783881", "phone_number_id": "106540352242922"},
+                        "contacts": [{"profile": {"name": "ישראל ישראלי"}, "wa_id": "972542202468"}],
+                        "messages": [
+                            {
+                                "from": "972542202468",
+                                "id": f"wamid.HBgMOTcyNTQyMjAyNDY4FQIAEhggQjdGNkU0RTI{i:08d}",
+                                "timestamp": "1700000000",
+                                "type": "text",
+                                "text": {"body": HEBREW_TEXT},
+                            }
+                            for i in range(messages)
+                        ],
+                    },
+                }],
+            }],
+        },
+    }
+
+
+OUTBOUND_TEXT = {
+    "messaging_product": "whatsapp",
+    "to": "972542202468",
+    "text": {"body": "📋 סיכום מצע הדיון:\n\n📝 שם הדיון: תקציב רבעון\n👥 משתתפים: דנה, יוסי, מיכל\n📄 תוכן הדיון:\n" + HEBREW_TEXT},
+}
+
+API_RESPONSE = {"status": "ok", "messages": 1, "statuses": 0, "duplicates": 0, "rejected": 0}
+
+
+def backends() -> dict:
+    stdlib_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+    result = {
+        "stdlib": (lambda obj: stdlib_encoder.encode(obj).encode("utf-8"), json.loads),
+    }
+    if orjson is not None:
+        result["orjson"] = (orjson.dumps, orjson.loads)
+    return result
+
+
+def measure(func, repeat: int) -> float:
+    """מיקרו-שניות לקריאה (הטוב מבין 3 סבבים)"""
+    return min(timeit.repeat(func, number=repeat, repeat=3)) / repeat * 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=20_000)
+    args = parser.parse_args()
+    
+    single = json.dumps(webhook_payload(1), ensure_ascii=False).encode("utf-8")
+    batch = json.dumps(webhook_payload(20), ensure_ascii=False).encode("utf-8")
+    
+    results = {}
+    for name, (dumps, loads) in backends().items():
+        results[name] = {
+            "inbound webhook (1 msg)": measure(lambda: loads(single), args.repeat),
+            "inbound webhook (20 msgs)": measure(lambda: loads(batch), args.repeat // 10) / 20,
+            "outbound n8n body": measure(lambda: dumps(OUTBOUND_TEXT), args.repeat),
+            "api response": measure(lambda: dumps(API_RESPONSE), args.repeat),
+        }
+    
+    names = list(results)
+    print(f"{'µs per message':28}" + "".join(f"{name:>10}" for name in names)
+          + ("   saved" if len(names) > 1 else ""))
+    for operation in results["stdlib"]:
+        row = [results[name][operation] for name in names]
+        line = f"{operation:28}" + "".join(f"{value:10.2f}" for value in row)
+        if len(row) > 1:
+            line += f"  {row[0] - row[1]:6.2f} ({row[0] / row[1]:.1f}x)"
+        print(line)
+    total = {name: results[name]["inbound webhook (1 msg)"] + results[name]["outbound n8n body"]
+             + results[name]["api response"] for name in names}
+    print(f"{'total per message':28}" + "".join(f"{total[name]:10.2f}" for name in names))
+    if orjson is None:
+        print("orjson is not installed - only the stdlib fallback was measured")
+
+
+if __name__ == "__main__":
+    main()
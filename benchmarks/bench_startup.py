@@ -0,0 +1,142 @@
+"""
+מדידת זמן העלייה והירידה של worker
+כל ריצה היא תהליך Python חדש (כמו worker ש-uvicorn מפעיל מחדש), שמודד:
+    - import של app.main (ובודק שה-import לא יצר אף שירות ולא הפעיל threads)
+    - startup של ה-lifespan (יצירת השירותים, קבצי ה-DB וה-client של N8N)
+    - ה-webhook הראשון (הודעת טקסט -> תפריט דרך N8N מדומה) והשני
+    - shutdown (ניקוז וסגירת החיבורים)
+ובנוסף את הזמן מהפעלת uvicorn עם --app-workers ועד שה-/health עונה, ואת
+זמן היציאה אחרי SIGTERM
+
+הרצה:
+    python -m benchmarks.bench_startup --runs 5 --app-workers 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from app import main as app_main
+from benchmarks.fake_n8n import run_fake_n8n
+from benchmarks.load_test import WEBHOOK_PATH, message_webhook, run_app
+
+PHASES = ("import", "startup", "first_webhook", "second_webhook", "shutdown")
+
+# import של app.main במפרש נקי, ובדיקה שאף שירות או thread לא נוצרו בו
+IMPORT_PROBE = """
+import json, threading, time
+started = time.perf_counter()
+import app.main
+elapsed = time.perf_counter() - started
+threads = [t.name for t in threading.enumerate() if t is not threading.main_thread()]
+print(json.dumps({"import": elapsed * 1000, "created": app.main.services.created(), "threads": threads}))
+"""
+
+
+async def _measure_worker() -> dict:
+    """רץ בתהליך הבן: מודד את השלבים של worker אחד ומחזיר ms לכל שלב"""
+    timings = {}
+    app = app_main.app
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        lifespan = app.router.lifespan_context(app)
+        started = time.perf_counter()
+        await lifespan.__aenter__()
+        timings["startup"] = time.perf_counter() - started
+        for i, phase in enumerate(("first_webhook", "second_webhook")):
+            body = message_webhook(f"97250000000{i}", f"wamid.bench.{i}", "text", "שלום")
+            started = time.perf_counter()
+            response = await client.post(WEBHOOK_PATH, content=body)
+            timings[phase] = time.perf_counter() - started
+            response.raise_for_status()
+        started = time.perf_counter()
+        await lifespan.__aexit__(None, None, None)
+        timings["shutdown"] = time.perf_counter() - started
+    return {phase: seconds * 1000 for phase, seconds in timings.items()}
+
+
+def _app_env(work_dir: str, n8n_url: str) -> dict:
+    allowlist_path = os.path.join(work_dir, "allowlist.txt")
+    with open(allowlist_path, "w", encoding="utf-8") as f:
+        f.write("*\n")
+    env = dict(os.environ)
+    env.update({
+        "N8N_WEBHOOK_URL": n8n_url,
+        "ALLOWLIST_PATH": allowlist_path,
+        "LOG_LEVEL": "ERROR",
+        "STATE_DB_PATH": os.path.join(work_dir, "state.db"),
+        "PROPOSAL_DB_PATH": os.path.join(work_dir, "proposals.db"),
+        "REMINDER_DB_PATH": os.path.join(work_dir, "reminders.db"),
+        "BROADCAST_DB_PATH": os.path.join(work_dir, "broadcasts.db"),
+    })
+    return env
+
+
+def _run_json(args: list, env: dict) -> dict:
+    result = subprocess.run([sys.executable, *args], env=env, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def measure_worker(n8n_url: str) -> dict:
+    """
+    מדידה אחת (עם קבצי DB חדשים): ה-import בתהליך נקי, ושאר השלבים בתהליך נוסף
+    Raises: RuntimeError אם ה-import יצר שירותים או הפעיל threads
+    """
+    with tempfile.TemporaryDirectory(prefix="bench-startup-") as work_dir:
+        env = _app_env(work_dir, n8n_url)
+        probe = _run_json(["-c", IMPORT_PROBE], env)
+        if probe["created"]:
+            raise RuntimeError(f"importing app.main created services: {probe['created']}")
+        if probe["threads"]:
+            raise RuntimeError(f"importing app.main started threads: {probe['threads']}")
+        timings = _run_json(["-m", "benchmarks.bench_startup", "--child"], env)
+    timings["import"] = probe["import"]
+    return timings
+
+
+def measure_uvicorn(n8n_url: str, port: int, workers: int) -> tuple:
+    """Returns: (ms עד ש-/health עונה, ms עד שכל התהליכים יצאו אחרי SIGTERM)"""
+    with tempfile.TemporaryDirectory(prefix="bench-startup-") as work_dir:
+        started = time.perf_counter()
+        with run_app(port, n8n_url, workers, work_dir, {}):
+            ready = time.perf_counter() - started
+            started = time.perf_counter()
+        stopped = time.perf_counter() - started
+    return ready * 1000, stopped * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--app-workers", type=int, default=4)
+    parser.add_argument("--app-port", type=int, default=8767)
+    parser.add_argument("--n8n-port", type=int, default=8765)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.child:
+        print(json.dumps(asyncio.run(_measure_worker())))
+        return
+    
+    with run_fake_n8n(args.n8n_port, 0.0, 0.0, 0.0) as n8n_url:
+        runs = [measure_worker(n8n_url) for _ in range(args.runs)]
+        uvicorn_runs = [measure_uvicorn(n8n_url, args.app_port, args.app_workers) for _ in range(args.runs)]
+    
+    print(f"runs={args.runs} (each in a fresh process, new database files)")
+    print(f"{'phase':<28} {'median ms':>10} {'min ms':>8} {'max ms':>8}")
+    rows = [(phase, [run[phase] for run in runs]) for phase in PHASES]
+    rows.append((f"uvicorn ready ({args.app_workers} workers)", [ready for ready, _ in uvicorn_runs]))
+    rows.append(("uvicorn exit after SIGTERM", [stopped for _, stopped in uvicorn_runs]))
+    for label, values in rows:
+        print(f"{label:<28} {statistics.median(values):>10.1f} {min(values):>8.1f} {max(values):>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+מדידת backend המצב המשותף בין workers: shm מול sqlite
+כמה תהליכים (כמו workers של uvicorn) מריצים במקביל צעדי זרימה - get + set
+לכל הודעה על מספרים משלהם - ו-mark_seen על אותם מזהי הודעות. בסוף בודק
+שכל הסשנים של כל התהליכים נראים מתהליך חדש, ושכל מזהה הודעה נספר כחדש
+בדיוק פעם אחת בכל התהליכים יחד
+
+הרצה:
+    python -m benchmarks.bench_state_shm --processes 4 --phones 2000 --steps 5
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+from app.services.state_shm import SharedMemoryStateStore
+from app.services.state_store import SQLiteStateStore
+
+STATES = ("proposal_new_name", "proposal_new_participants", "proposal_new_content")
+BACKENDS = ("sqlite", "shm")
+
+
+def open_store(backend: str, work_dir: str):
+    if backend == "shm":
+        return SharedMemoryStateStore(os.path.join(work_dir, "state.shm"), idle_ttl=86_400.0)
+    return SQLiteStateStore(os.path.join(work_dir, "state.db"), idle_ttl=86_400.0)
+
+
+def phone(worker: int, i: int) -> str:
+    return f"9725{worker:02d}{i:06d}"
+
+
+def run_worker(args: tuple) -> dict:
+    """תהליך אחד: צעדי זרימה על המספרים שלו ו-mark_seen על המזהים המשותפים"""
+    backend, work_dir, worker, phones, steps, message_ids, start_at = args
+    store = open_store(backend, work_dir)
+    time.sleep(max(0.0, start_at - time.time()))
+    data = {"type": "proposal", "name": "דיון שבועי על תקציב הרבעון"}
+    started = time.perf_counter()
+    for step in range(steps):
+        for i in range(phones):
+            store.get(phone(worker, i))
+            store.set(phone(worker, i), STATES[step % len(STATES)], {**data, "step": step})
+    flow_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    new = sum(not store.mark_seen(f"wamid.{i}", 3600.0) for i in range(message_ids))
+    dedup_seconds = time.perf_counter() - started
+    store.close()
+    return {"flow_seconds": flow_seconds, "dedup_seconds": dedup_seconds, "new": new}
+
+
+def run(backend: str, processes: int, phones: int, steps: int, message_ids: int) -> dict:
+    with tempfile.TemporaryDirectory(prefix="bench-state-") as work_dir:
+        open_store(backend, work_dir).close()
+        start_at = time.time() + 1.0
+        jobs = [(backend, work_dir, worker, phones, steps, message_ids, start_at) for worker in range(processes)]
+        with multiprocessing.get_context("spawn").Pool(processes) as pool:
+            results = pool.map(run_worker, jobs)
+        
+        store = open_store(backend, work_dir)
+        missing = 0
+        for worker in range(processes):
+            for i in range(phones):
+                record = store.get(phone(worker, i))
+                if record is None or record[1]["step"] != steps - 1:
+                    missing += 1
+        store.close()
+    
+    flow_ops = processes * phones * steps * 2
+    return {
+        "flow_ops_per_second": flow_ops / max(r["flow_seconds"] for r in results),
+        "flow_us": sum(r["flow_seconds"] for r in results) / flow_ops * 1e6,
+        "dedup_us": sum(r["dedup_seconds"] for r in results) / (processes * message_ids) * 1e6,
+        "missing": missing,
+        "dedup_new": sum(r["new"] for r in results),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--phones", type=int, default=2000, help="מספרים לכל תהליך")
+    parser.add_argument("--steps", type=int, default=5, help="צעדי זרימה לכל מספר")
+    parser.add_argument("--message-ids", type=int, default=20_000, help="מזהי הודעות (משותפים לכל התהליכים)")
+    args = parser.parse_args()
+    
+    print(f"processes={args.processes} phones/process={args.phones} steps={args.steps} "
+          f"message ids={args.message_ids}")
+    print(f"{'backend':<8} {'flow ops/s':>12} {'us/op':>8} {'dedup us':>9} {'missing':>8} {'dedup new':>10}")
+    failed = False
+    for backend in BACKENDS:
+        result = run(backend, args.processes, args.phones, args.steps, args.message_ids)
+        print(f"{backend:<8} {result['flow_ops_per_second']:>12,.0f} {result['flow_us']:>8.1f} "
+              f"{result['dedup_us']:>9.1f} {result['missing']:>8} {result['dedup_new']:>10}")
+        failed |= result["missing"] > 0 or result["dedup_new"] != args.message_ids
+    if failed:
+        raise SystemExit("shared state is inconsistent between processes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+שרת N8N מקומי מדומה (stand-in) ל-benchmarks
+מקבל POST ל-/webhook/whatsappout (payload בודד או מערך), ממתין latency
+מוגדר (עם jitter אופציונלי) ומחזיר תשובה - ומונה בקשות ופריטים כדי למדוד
+את ההשפעה של קיבוץ. error-rate מחזיר שגיאת 5xx לחלק מהבקשות, כדי לבדוק
+את הניסיונות החוזרים תחת עומס
+
+הרצה עצמאית:
+    python -m benchmarks.fake_n8n --port 8765 --latency-ms 20 --jitter-ms 10 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import contextlib
+import random
+import subprocess
+import sys
+import time
+
+import httpx
+from fastapi import FastAPI, Request, Response
+
+app = FastAPI()
+
+settings = {"latency": 0.02, "jitter": 0.0, "error_rate": 0.0, "error_status": 503}
+stats = {"requests": 0, "items": 0, "errors": 0}
+
+
+@app.post("/webhook/whatsappout")
+async def whatsappout(request: Request):
+    body = await request.json()
+    stats["requests"] += 1
+    await asyncio.sleep(settings["latency"] + random.uniform(0, settings["jitter"]))
+    if settings["error_rate"] and random.random() < settings["error_rate"]:
+        stats["errors"] += 1
+        return Response(status_code=settings["error_status"])
+    if isinstance(body, list):
+        stats["items"] += len(body)
+        return [{"status": "sent", "status_code": 200} for _ in body]
+    stats["items"] += 1
+    return {"status": "sent"}
+
+
+@app.get("/stats")
+def get_stats():
+    return stats
+
+
+@app.post("/reset")
+def reset():
+    stats.update(requests=0, items=0, errors=0)
+    return stats
+
+
+@contextlib.contextmanager
+def run_fake_n8n(port: int = 8765, latency_ms: float = 20.0,
+                 jitter_ms: float = 0.0, error_rate: float = 0.0, error_status: int = 503):
+    """
+    מריץ את השרת המדומה בתהליך נפרד (כדי שלא יתחרה על ה-event loop
+    של הצד הנמדד) ומחזיר את ה-URL של ה-webhook
+    """
+    process = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.fake_n8n", "--port", str(port), "--latency-ms", str(latency_ms),
+         "--jitter-ms", str(jitter_ms), "--error-rate", str(error_rate), "--error-status", str(error_status)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + 15
+        while True:
+            try:
+                httpx.get(f"{base_url}/stats", timeout=0.5)
+                break
+            except httpx.TransportError:
+                if time.monotonic() > deadline or process.poll() is not None:
+                    raise RuntimeError("fake n8n server did not start")
+                time.sleep(0.1)
+        yield f"{base_url}/webhook/whatsappout"
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+
+def main():
+    import uvicorn
+    
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="random extra latency, 0..jitter")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with an error")
+    parser.add_argument("--error-status", type=int, default=503)
+    args = parser.parse_args()
+    settings.update(
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+    )
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning", access_log=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+"""
+בדיקת עומס מקצה לקצה מול app.main:app
+מריץ את האפליקציה (uvicorn, worker אחד או יותר) ושרת N8N מדומה בתהליכים
+נפרדים, ומשדר תעבורת webhooks סינתטית בסגנון Meta במקביל גבוה:
+    - זרימות "מצע לדיון" מלאות של הרבה מספרים (הודעה -> תפריט -> בחירות -> 3 שאלות)
+    - סערות status (sent / delivered / read) במשלוחים גדולים
+    - redelivery של הודעות שכבר נשלחו (כפילויות)
+מדווח לכל endpoint / סוג תעבורה: בקשות, בקשות לשנייה, p50/p99/p999 ושגיאות.
+עם --max-p99-ms הסקריפט נכשל (exit code 1) אם p99 של סוג כלשהו חורג - לבדיקת
+רגרסיה לפני deploy
+
+הרצה:
+    python -m benchmarks.load_test --phones 2000 --status-webhooks 5000 --concurrency 200
+    python -m benchmarks.load_test --app-workers 4 --latency-ms 50 --error-rate 0.02 --max-p99-ms 250
+"""
+import argparse
+import asyncio
+import contextlib
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import httpx
+
+from app.serialization import dumps
+from benchmarks.fake_n8n import run_fake_n8n
+
+WEBHOOK_PATH = "/whatsapp/get_message"
+
+# שלבי זרימת "מצע לדיון": (type, ערך) - text או בחירה מ-List
+PROPOSAL_FLOW = [
+    ("text", "שלום"),
+    ("choice", "proposal_for_discussion"),
+    ("choice", "proposal_new"),
+    ("text", "דיון על תקציב הרבעון"),
+    ("text", "דנה, יוסי, מיכל"),
+    ("text", "סקירת ההוצאות והחלטה על סדרי עדיפויות לרבעון הבא"),
+]
+
+
+def _webhook(value: dict) -> bytes:
+    """עוטף value במבנה ה-webhook של Meta"""
+    return dumps({
+        "object": "whatsapp_business_account",
+        "entry": [{"id": "load-test", "changes": [{"field": "messages", "value": value}]}],
+    })
+
+
+def message_webhook(phone_number: str, message_id: str, kind: str, value: str) -> bytes:
+    """webhook עם הודעת טקסט או בחירה מ-List"""
+    message = {"from": phone_number, "id": message_id, "timestamp": str(int(time.time()))}
+    if kind == "text":
+        message.update(type="text", text={"body": value})
+    else:
+        message.update(type="interactive",
+                       interactive={"type": "list_reply", "list_reply": {"id": value, "title": value}})
+    return _webhook({
+        "messaging_product": "whatsapp",
+        "contacts": [{"wa_id": phone_number, "profile": {"name": "Load Test"}}],
+        "messages": [message],
+    })
+
+
+def status_webhook(batch: int, size: int) -> bytes:
+    """webhook עם size קבלות status (sent / delivered / read) למזהים שונים"""
+    now = int(time.time())
+    statuses = []
+    for i in range(size):
+        message_id = f"wamid.out.{batch}.{i // 3}"
+        statuses.append({
+            "id": message_id,
+            "recipient_id": f"97250{(batch * size + i) % 10_000_000:07d}",
+            "status": ("sent", "delivered", "read")[i % 3],
+            "timestamp": str(now + i % 3),
+        })
+    return _webhook({"messaging_product": "whatsapp", "statuses": statuses})
+
+
+class LatencyRecorder:
+    """זמני תגובה ותוצאות לכל סוג תעבורה"""
+    
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+        self.statuses: Dict[str, Dict[int, int]] = {}
+    
+    def record(self, label: str, seconds: float, status_code: int):
+        self.samples.setdefault(label, []).append(seconds)
+        codes = self.statuses.setdefault(label, {})
+        codes[status_code] = codes.get(status_code, 0) + 1
+    
+    def report(self, elapsed: float) -> List[dict]:
+        rows = []
+        for label, samples in sorted(self.samples.items()):
+            values = sorted(samples)
+            
+            def pct(fraction: float) -> float:
+                return values[min(len(values) - 1, int(fraction * len(values)))] * 1000
+            
+            errors = sum(count for code, count in self.statuses[label].items() if code >= 400)
+            rows.append({
+                "label": label,
+                "requests": len(values),
+                "rps": len(values) / elapsed,
+                "p50_ms": pct(0.50),
+                "p99_ms": pct(0.99),
+                "p999_ms": pct(0.999),
+                "max_ms": values[-1] * 1000,
+                "errors": errors,
+                "statuses": dict(sorted(self.statuses[label].items())),
+            })
+        return rows
+
+
+async def post(client: httpx.AsyncClient, recorder: LatencyRecorder, label: str, body: bytes) -> int:
+    started = time.perf_counter()
+    try:
+        response = await client.post(WEBHOOK_PATH, content=body, headers={"Content-Type": "application/json"})
+        status_code = response.status_code
+    except httpx.TransportError:
+        status_code = 599
+    recorder.record(label, time.perf_counter() - started, status_code)
+    return status_code
+
+
+async def run_traffic(base_url: str, phones: int, status_webhooks: int, status_batch: int,
+                      duplicate_rate: float, concurrency: int, seed: int) -> tuple:
+    """משדר את כל התעבורה ומחזיר (recorder, זמן כולל)"""
+    rng = random.Random(seed)
+    recorder = LatencyRecorder()
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60.0) as client:
+        
+        async def proposal_flow(index: int):
+            # הודעות של אותו מספר נשלחות לפי הסדר, כמו משתמש אמיתי
+            phone_number = f"97250{index:07d}"
+            for step, (kind, value) in enumerate(PROPOSAL_FLOW):
+                body = message_webhook(phone_number, f"wamid.in.{index}.{step}", kind, value)
+                async with semaphore:
+                    await post(client, recorder, f"{WEBHOOK_PATH} [message]", body)
+                if rng.random() < duplicate_rate:
+                    async with semaphore:
+                        await post(client, recorder, f"{WEBHOOK_PATH} [duplicate]", body)
+        
+        async def status_storm(batch: int):
+            body = status_webhook(batch, status_batch)
+            async with semaphore:
+                await post(client, recorder, f"{WEBHOOK_PATH} [status]", body)
+        
+        # זרימות וסערות status משולבות באקראי
+        jobs = [proposal_flow(i) for i in range(phones)] + [status_storm(b) for b in range(status_webhooks)]
+        rng.shuffle(jobs)
+        started = time.perf_counter()
+        await asyncio.gather(*jobs)
+        elapsed = time.perf_counter() - started
+        
+        # זמן תגובה של endpoints הקריאה אחרי העומס (למשל /metrics מאחד קבצים מכל ה-workers)
+        for path in ("/health", "/metrics"):
+            for _ in range(20):
+                t = time.perf_counter()
+                response = await client.get(path)
+                recorder.record(f"GET {path}", time.perf_counter() - t, response.status_code)
+    return recorder, elapsed
+
+
+@contextlib.contextmanager
+def run_app(port: int, n8n_url: str, workers: int, work_dir: str, extra_env: Dict[str, str]):
+    """
+    מריץ את app.main:app ב-uvicorn בתהליך נפרד, עם allowlist פתוח ("*") ו-state
+    backend שמתאים למספר ה-workers. Returns: ה-URL הבסיסי
+    """
+    allowlist_path = os.path.join(work_dir, "allowlist.txt")
+    with open(allowlist_path, "w", encoding="utf-8") as f:
+        f.write("*\n")
+    env = dict(os.environ)
+    env.update({
+        "N8N_WEBHOOK_URL": n8n_url,
+        "ALLOWLIST_PATH": allowlist_path,
+        "LOG_LEVEL": "ERROR",
+        "STATE_BACKEND": "memory" if workers == 1 else "sqlite",
+        "STATE_DB_PATH": os.path.join(work_dir, "state.db"),
+        "PROPOSAL_DB_PATH": os.path.join(work_dir, "proposals.db"),
+        "REMINDER_DB_PATH": os.path.join(work_dir, "reminders.db"),
+        "BROADCAST_DB_PATH": os.path.join(work_dir, "broadcasts.db"),
+        "METRICS_DIR": os.path.join(work_dir, "metrics"),
+    })
+    env.update(extra_env)
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning", "--no-access-log"],
+        env=env,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                httpx.get(f"{base_url}/health", timeout=0.5)
+                break
+            except httpx.TransportError:
+                if time.monotonic() > deadline or process.poll() is not None:
+                    raise RuntimeError("app did not start")
+                time.sleep(0.1)
+        yield base_url
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+def _parse_env(pairs: List[str]) -> Dict[str, str]:
+    env = {}
+    for pair in pairs:
+        key, _, value = pair.partition("=")
+        env[key] = value
+    return env
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--phones", type=int, default=1000, help="phones running a full proposal flow")
+    parser.add_argument("--status-webhooks", type=int, default=2000)
+    parser.add_argument("--status-batch", type=int, default=30, help="statuses per status webhook")
+    parser.add_argument("--duplicate-rate", type=float, default=0.1, help="fraction of messages redelivered")
+    parser.add_argument("--concurrency", type=int, default=200, help="requests in flight")
+    parser.add_argument("--app-workers", type=int, default=1)
+    parser.add_argument("--app-port", type=int, default=8766)
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="fake n8n latency")
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of n8n requests that fail")
+    parser.add_argument("--n8n-port", type=int, default=8765)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra environment for the app (e.g. DISPATCH_MODE=queue)")
+    parser.add_argument("--max-p99-ms", type=float, default=0.0, help="fail if any webhook p99 exceeds this")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory(prefix="load-test-") as work_dir, \
+            run_fake_n8n(args.n8n_port, args.latency_ms, args.jitter_ms, args.error_rate) as n8n_url, \
+            run_app(args.app_port, n8n_url, args.app_workers, work_dir, _parse_env(args.env)) as base_url:
+        recorder, elapsed = asyncio.run(run_traffic(
+            base_url, args.phones, args.status_webhooks, args.status_batch,
+            args.duplicate_rate, args.concurrency, args.seed,
+        ))
+        n8n_stats = httpx.get(n8n_url.rsplit("/webhook/", 1)[0] + "/stats").json()
+    
+    print(f"app_workers={args.app_workers} phones={args.phones} status_webhooks={args.status_webhooks}x"
+          f"{args.status_batch} duplicate_rate={args.duplicate_rate} concurrency={args.concurrency} "
+          f"n8n_latency={args.latency_ms}ms error_rate={args.error_rate}")
+    print(f"elapsed {elapsed:.2f}s")
+    print(f"{'endpoint':<40} {'requests':>9} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'p999 ms':>8} "
+          f"{'max ms':>8} {'errors':>7}")
+    failed = False
+    for row in recorder.report(elapsed):
+        print(f"{row['label']:<40} {row['requests']:>9} {row['rps']:>9,.0f} {row['p50_ms']:>8.2f} "
+              f"{row['p99_ms']:>8.2f} {row['p999_ms']:>8.2f} {row['max_ms']:>8.2f} {row['errors']:>7}")
+        if row["errors"]:
+            print(f"{'':<40} status codes: {row['statuses']}")
+        if args.max_p99_ms and row["label"].startswith(WEBHOOK_PATH) and row["p99_ms"] > args.max_p99_ms:
+            failed = True
+    print(f"n8n: requests={n8n_stats['requests']} items={n8n_stats['items']} errors={n8n_stats['errors']}")
+    
+    if failed:
+        print(f"FAIL: webhook p99 above {args.max_p99_ms} ms")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+בדיקת עומס ל-KeyedSequencer
+אלפי שולחים משולבים דרך DispatchQueue עם הרבה workers - מוודא שההודעות של
+כל מספר טלפון עובדו בדיוק לפי הסדר, ושמספרים שונים עובדו במקביל
+
+עם --processes ההודעות של כל מספר מתחלקות בין כמה תהליכים (כמו workers של
+uvicorn) שעושים קריאה-המתנה-כתיבה על SQLiteStateStore משותף, כמו מעבר מצב
+ב-FlowManager - ובודק שאף מעבר לא אבד (--no-process-lock מראה את האובדן)
+
+הרצה:
+    python -m benchmarks.stress_sequencer --senders 5000 --messages 10
+    python -m benchmarks.stress_sequencer --processes 4 --senders 500 --messages 10
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from app.services.dispatch_queue import DispatchQueue
+from app.services.sequencer import KeyedSequencer, ProcessKeyLock
+from app.services.state_store import SQLiteStateStore
+
+
+async def run(senders: int, messages: int, workers: int, seed: int) -> int:
+    rng = random.Random(seed)
+    sequencer = KeyedSequencer()
+    queue = DispatchQueue()
+    queue.maxsize = senders * messages
+    queue.num_workers = workers
+    await queue.start()
+    
+    processed = defaultdict(list)
+    in_flight = 0
+    max_in_flight = 0
+    
+    async def handle(phone: str, seq: int):
+        nonlocal in_flight, max_in_flight
+        async with sequencer.hold(phone):
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            # קריאה-המתנה-כתיבה: בלי סידור, הודעה מאוחרת "עוקפת" את הקודמת
+            seen = len(processed[phone])
+            await asyncio.sleep(rng.random() * 0.001)
+            processed[phone].append(seq)
+            if seen + 1 != len(processed[phone]):
+                raise AssertionError(f"concurrent handling detected for {phone}")
+            in_flight -= 1
+    
+    # שילוב אקראי של ההודעות, תוך שמירת הסדר היחסי של כל שולח
+    pending = {f"9725{i:08d}": 0 for i in range(senders)}
+    phones = list(pending)
+    started = time.perf_counter()
+    total = senders * messages
+    for _ in range(total):
+        phone = rng.choice(phones)
+        seq = pending[phone]
+        await queue.submit(handle, phone, seq)
+        pending[phone] = seq + 1
+        if pending[phone] == messages:
+            phones.remove(phone)
+    await queue.stop(drain_timeout=120)
+    elapsed = time.perf_counter() - started
+    
+    errors = 0
+    for phone, seqs in processed.items():
+        if seqs != sorted(seqs) or len(seqs) != messages:
+            errors += 1
+            print(f"ORDER VIOLATION for {phone}: {seqs}")
+    
+    print(f"senders={senders} messages/sender={messages} workers={workers}")
+    print(f"processed={queue.processed} failed={queue.failed} in {elapsed:.2f}s "
+          f"({queue.processed / elapsed:,.0f} msg/s)")
+    print(f"max concurrent handlers across phones: {max_in_flight}")
+    print(f"locks left after drain: {sequencer.active_keys()}")
+    
+    if errors or queue.failed or sequencer.active_keys():
+        print("FAILED")
+        return 1
+    if max_in_flight < 2:
+        print("FAILED: no parallelism across phones")
+        return 1
+    print("OK: per-phone order preserved")
+    return 0
+
+
+def phone(i: int) -> str:
+    return f"9725{i:08d}"
+
+
+async def run_process(work_dir: str, jobs: list, workers: int, process_lock: bool, seed: int):
+    """תהליך אחד: מעבר מצב (get, המתנה, set) לכל הודעה, דרך sequencer ותור שיגור"""
+    rng = random.Random(seed)
+    store = SQLiteStateStore(os.path.join(work_dir, "state.db"))
+    sequencer = KeyedSequencer()
+    if process_lock:
+        sequencer.process_lock = ProcessKeyLock(os.path.join(work_dir, "phones.lock"))
+    queue = DispatchQueue()
+    queue.maxsize = len(jobs)
+    queue.num_workers = workers
+    await queue.start()
+    
+    async def handle(phone_number: str):
+        async with sequencer.hold(phone_number):
+            record = store.get(phone_number)
+            count = record[1]["n"] if record else 0
+            # ה-flow מחכה ל-N8N בין הקריאה לכתיבה
+            await asyncio.sleep(rng.random() * 0.002)
+            store.set(phone_number, "counting", {"n": count + 1})
+    
+    for phone_number in jobs:
+        await queue.submit(handle, phone_number)
+    await queue.stop(drain_timeout=120)
+    store.close()
+    if sequencer.process_lock is not None:
+        sequencer.process_lock.close()
+    return queue.failed
+
+
+def process_main(args: tuple) -> int:
+    return asyncio.run(run_process(*args))
+
+
+def run_processes(processes: int, senders: int, messages: int, workers: int, seed: int,
+                  process_lock: bool) -> int:
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory(prefix="stress-sequencer-") as work_dir:
+        SQLiteStateStore(os.path.join(work_dir, "state.db")).close()
+        # כל הודעה מגיעה לתהליך אקראי - הודעות של אותו מספר מתפזרות בין התהליכים
+        jobs = [[] for _ in range(processes)]
+        for _ in range(messages):
+            for i in range(senders):
+                jobs[rng.randrange(processes)].append(phone(i))
+        started = time.perf_counter()
+        with multiprocessing.get_context("spawn").Pool(processes) as pool:
+            failed = sum(pool.map(process_main, [
+                (work_dir, process_jobs, workers, process_lock, seed + n) for n, process_jobs in enumerate(jobs)
+            ]))
+        elapsed = time.perf_counter() - started
+        
+        store = SQLiteStateStore(os.path.join(work_dir, "state.db"))
+        lost = 0
+        for i in range(senders):
+            record = store.get(phone(i))
+            lost += messages - (record[1]["n"] if record else 0)
+        store.close()
+    
+    total = senders * messages
+    print(f"processes={processes} senders={senders} messages/sender={messages} workers={workers} "
+          f"process lock={'on' if process_lock else 'off'}")
+    print(f"processed={total} failed={failed} in {elapsed:.2f}s ({total / elapsed:,.0f} msg/s)")
+    print(f"lost state transitions: {lost}")
+    if lost or failed:
+        print("FAILED")
+        return 1
+    print("OK: no transition lost across processes")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--senders", type=int, default=5000)
+    parser.add_argument("--messages", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--processes", type=int, default=1, help="יותר מ-1: בדיקה בין תהליכים על store משותף")
+    parser.add_argument("--no-process-lock", action="store_true", help="בלי הנעילה בין תהליכים (להשוואה)")
+    args = parser.parse_args()
+    if args.processes > 1:
+        sys.exit(run_processes(args.processes, args.senders, args.messages, args.workers, args.seed,
+                               not args.no_process_lock))
+    sys.exit(asyncio.run(run(args.senders, args.messages, args.workers, args.seed)))
+
+
+if __name__ == "__main__":
+    main()
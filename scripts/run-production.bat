@@ -2,5 +2,9 @@
 REM Run the WhatsApp Bot server in PRODUCTION mode (Windows CMD batch file)
 
 set ENVIRONMENT=prod
+set STATE_BACKEND=sqlite
+REM Per-worker metrics snapshots, merged by /metrics (cleared on every start)
+set METRICS_DIR=data\metrics
+if exist %METRICS_DIR% rmdir /s /q %METRICS_DIR%
 uvicorn app.main:app --host 0.0.0.0 --port 8000 --workers 4
 
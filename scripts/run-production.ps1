@@ -1,5 +1,9 @@
 # Run the WhatsApp Bot server in PRODUCTION mode (PowerShell script for Windows)
 
 $env:ENVIRONMENT = "prod"
+$env:STATE_BACKEND = "sqlite"
+# Per-worker metrics snapshots, merged by /metrics (cleared on every start)
+$env:METRICS_DIR = "data/metrics"
+Remove-Item -Recurse -Force $env:METRICS_DIR -ErrorAction SilentlyContinue
 uvicorn app.main:app --host 0.0.0.0 --port 8000 --workers 4
 
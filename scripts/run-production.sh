@@ -2,5 +2,9 @@
 # Run the WhatsApp Bot server in PRODUCTION mode (no reload)
 
 export ENVIRONMENT=prod
+export STATE_BACKEND=sqlite
+# Per-worker metrics snapshots, merged by /metrics (cleared on every start)
+export METRICS_DIR=data/metrics
+rm -rf "$METRICS_DIR"
 uvicorn app.main:app --host 0.0.0.0 --port 8000 --workers 4
 